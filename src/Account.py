@@ -6,18 +6,21 @@ This module defines a basic account
 from __future__ import division
 
 from EventData    import EventData, EVENT_SYS_CLOCK, EVENT_NAME_PREFIX, datetime2float
-from Application  import BaseApplication
+from Application  import BaseApplication, BOOL_STRVAL_TRUE
 from MarketData  import MarketState, PRICE_DISPLAY_ROUND_DECIMALS
 import HistoryData  as hist
 
 from abc import ABCMeta, abstractmethod
 from datetime import datetime, timedelta
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import threading
+import heapq, bisect, math
+import numpy as np
 
 # from itertools import product
 import copy
 import traceback
+import os, struct, pickle, zlib, time
 # from pymongo import ASCENDING
 
 DAYCLOSE_TIME_ERR = timedelta(minutes=15)
@@ -113,6 +116,323 @@ class OrderData(EventData):
     def desc(self) :
         return 'O%s:%s(%s) %dx%s' % (self.reqId, self.direction, self.symbol, self.totalVolume, round(self.price, PRICE_DISPLAY_ROUND_DECIMALS))
 
+########################################################################
+class OrderBookIndex(object):
+    '''
+    The index of the pending limit orders by symbol, where the buy orders are kept in a max-heap by price and the
+    sell orders in a min-heap, so that a market event only touches the orders that can cross.
+    the index holds no ownership of the orders: those no more in the dict of live orders are dropped lazily, either
+    when they come to the top of a heap or by the compaction once the dropped ones dominate
+    '''
+    def __init__(self):
+        self._books = {} # symbol -> ([(-price, seq, order)], [(price, seq, order)], [(seq, order)] of the others)
+        self._seq = 0
+        self._cEntries = 0
+
+    def __len__(self) : return self._cEntries
+
+    def isLive(order, liveOrders) :
+        return liveOrders.get(order.brokerOrderId, None) is order
+
+    def add(self, order, liveOrders=None) :
+        if liveOrders is not None and self._cEntries > 2*len(liveOrders) +64:
+            self.compact(liveOrders)
+
+        self._seq +=1
+        if order.symbol not in self._books:
+            self._books[order.symbol] = ([], [], [])
+        buys, sells, others = self._books[order.symbol]
+        if OrderData.DIRECTION_LONG == order.direction:
+            heapq.heappush(buys, (-order.price, self._seq, order))
+        elif OrderData.DIRECTION_SHORT == order.direction:
+            heapq.heappush(sells, (order.price, self._seq, order))
+        else:
+            others.append((self._seq, order))
+        self._cEntries +=1
+
+    def clear(self) :
+        self._books = {}
+        self._cEntries = 0
+
+    def rebuild(self, liveOrders) :
+        self.clear()
+        for order in liveOrders.values():
+            self.add(order)
+
+    def compact(self, liveOrders) :
+        '''
+        drop the orders that are no more live
+        '''
+        self._cEntries = 0
+        for symbol in list(self._books.keys()):
+            book = tuple([ [ e for e in entries if OrderBookIndex.isLive(e[-1], liveOrders) ] for entries in self._books[symbol] ])
+            heapq.heapify(book[0])
+            heapq.heapify(book[1])
+            cEntries = sum([len(entries) for entries in book])
+            if cEntries <=0:
+                del self._books[symbol]
+                continue
+            self._books[symbol] = book
+            self._cEntries += cEntries
+
+    def popCrossed(self, symbol, buyCrossPrice, sellCrossPrice, liveOrders) :
+        '''
+        pop the orders of symbol that cross: the buys priced at or above buyCrossPrice and the sells priced at or below
+        sellCrossPrice, a cross price <=0 means no cross of that side such as at the price limit
+        @return list of (order, buyCross) in the order that they were added
+        '''
+        if symbol not in self._books:
+            return []
+
+        buys, sells, _ = self._books[symbol]
+        crossed = []
+        while len(buys) >0 and (not OrderBookIndex.isLive(buys[0][2], liveOrders) or (buyCrossPrice >0 and -buys[0][0] >= buyCrossPrice)):
+            _, seq, order = heapq.heappop(buys)
+            self._cEntries -=1
+            if OrderBookIndex.isLive(order, liveOrders):
+                crossed.append((seq, order, True))
+
+        while len(sells) >0 and (not OrderBookIndex.isLive(sells[0][2], liveOrders) or (sellCrossPrice >0 and sells[0][0] <= sellCrossPrice)):
+            _, seq, order = heapq.heappop(sells)
+            self._cEntries -=1
+            if OrderBookIndex.isLive(order, liveOrders):
+                crossed.append((seq, order, False))
+
+        crossed.sort(key=lambda c: c[0])
+        return [ (order, buyCross) for _, order, buyCross in crossed ]
+
+    def pendingOrders(self, symbol, liveOrders) :
+        '''
+        @return list of the live orders of symbol in the order that they were added, which takes O(n) so is expected
+                to be called only when the list is really needed, such as logging
+        '''
+        if symbol not in self._books:
+            return []
+
+        buys, sells, others = self._books[symbol]
+        entries = [ e[1:] for e in buys ] + [ e[1:] for e in sells ] + others
+        entries.sort(key=lambda e: e[0])
+        return [ order for _, order in entries if OrderBookIndex.isLive(order, liveOrders) ]
+
+########################################################################
+class StopTriggerIndex(object):
+    '''
+    The index of the pending stop orders by symbol, where the trigger prices of the buy-stops and the sell-stops are
+    kept sorted, so that the stops triggered by a price move are found by a binary search instead of a scan:
+        - a buy-stop triggers once the market rises to or above its price, the prefix of the ascending buys
+        - a sell-stop triggers once the market falls to or below its price, the suffix of the ascending sells
+    the orders no more in the dict of live orders are dropped lazily as OrderBookIndex does
+    '''
+    def __init__(self):
+        self._books = {} # symbol -> {'buys': ([(price, seq)], [order]), 'sells': ([(price, seq)], [order])}
+        self._seq = 0
+        self._cEntries = 0
+
+    def __len__(self) : return self._cEntries
+
+    def add(self, order, liveOrders=None) :
+        if liveOrders is not None and self._cEntries > 2*len(liveOrders) +64:
+            self.compact(liveOrders)
+
+        if OrderData.DIRECTION_LONG == order.direction:
+            side = 'buys'
+        elif OrderData.DIRECTION_SHORT == order.direction:
+            side = 'sells'
+        else: return # a stop without direction never triggers
+
+        self._seq +=1
+        if order.symbol not in self._books:
+            self._books[order.symbol] = { 'buys': ([], []), 'sells': ([], []) }
+        keys, orders = self._books[order.symbol][side]
+        key = (order.price, self._seq)
+        pos = bisect.bisect_right(keys, key)
+        keys.insert(pos, key)
+        orders.insert(pos, order)
+        self._cEntries +=1
+
+    def clear(self) :
+        self._books = {}
+        self._cEntries = 0
+
+    def compact(self, liveOrders) :
+        self._cEntries = 0
+        for symbol in list(self._books.keys()):
+            book = {}
+            for side, (keys, orders) in self._books[symbol].items():
+                kept = [ i for i in range(len(orders)) if OrderBookIndex.isLive(orders[i], liveOrders) ]
+                book[side] = ([keys[i] for i in kept], [orders[i] for i in kept])
+                self._cEntries += len(kept)
+            self._books[symbol] = book
+
+    def popTriggered(self, symbol, buyTriggerPrice, sellTriggerPrice, liveOrders) :
+        '''
+        pop the stops of symbol that are triggered: the buy-stops priced at or below buyTriggerPrice, usually the high
+        of a KLine, and the sell-stops priced at or above sellTriggerPrice, usually the low. a trigger price <=0 means
+        no trigger of that side
+        @return list of (order, buyCross) in the order that they were added
+        '''
+        if symbol not in self._books:
+            return []
+
+        triggered = []
+        if buyTriggerPrice >0:
+            keys, orders = self._books[symbol]['buys']
+            i = bisect.bisect_right(keys, (buyTriggerPrice, self._seq +1))
+            triggered += [ (keys[k][1], orders[k], True) for k in range(i) ]
+            del keys[:i], orders[:i]
+            self._cEntries -= i
+
+        if sellTriggerPrice >0:
+            keys, orders = self._books[symbol]['sells']
+            i = bisect.bisect_left(keys, (sellTriggerPrice, 0))
+            triggered += [ (keys[k][1], orders[k], False) for k in range(i, len(keys)) ]
+            self._cEntries -= len(keys) - i
+            del keys[i:], orders[i:]
+
+        triggered.sort(key=lambda t: t[0])
+        return [ (order, buyCross) for _, order, buyCross in triggered if OrderBookIndex.isLive(order, liveOrders) ]
+
+    def pendingOrders(self, symbol, liveOrders) :
+        if symbol not in self._books:
+            return []
+
+        entries = []
+        for keys, orders in self._books[symbol].values():
+            entries += [ (keys[k][1], orders[k]) for k in range(len(keys)) ]
+        entries.sort(key=lambda e: e[0])
+        return [ order for _, order in entries if OrderBookIndex.isLive(order, liveOrders) ]
+
+    def fillPrice(order, buyCross, bestCrossPrice, openPrice=0) :
+        '''
+        a triggered stop becomes a market order, filled at the best-cross-price but never better than its stop price.
+        when the market gaps through the stop, such as a KLine opens beyond it, the fill is no better than the open
+        '''
+        if buyCross:
+            return max(order.price, bestCrossPrice, openPrice)
+
+        price = min(order.price, bestCrossPrice)
+        return min(price, openPrice) if openPrice >0 else price
+
+########################################################################
+class AccountJournal(object):
+    '''
+    The append-only journal of the account events with the periodic compacted snapshots
+        - each record is (seq, kind, data) pickled and framed by its length and crc32, so that a tail torn by a crash
+          is detected and truncated at recovery
+        - the records are buffered and written with fsync once per fsyncInterval seconds, 0 to fsync every record
+        - the snapshot is written into a temp file then renamed over the previous one, together with the seq it covers.
+          the journal restarts after the snapshot, and the records already covered are skipped if a crash came in between
+    '''
+    FRAME = struct.Struct('<II') # length, crc32 of the pickled record
+
+    def __init__(self, filepath, fsyncInterval=1.0):
+        self._filepath = filepath
+        self._snapFilepath = filepath + '.snap'
+        self._fsyncInterval = fsyncInterval
+        self._seq = 0
+        self._buffer = []
+        self._stampLastSync = time.time()
+        self._file = None
+        self._lock = threading.Lock()
+        self.cAppended = 0 # the number of records since the latest snapshot
+
+    @property
+    def filepath(self) : return self._filepath
+
+    def append(self, kind, data) :
+        with self._lock :
+            self._seq +=1
+            record = pickle.dumps((self._seq, kind, data), pickle.HIGHEST_PROTOCOL) # pickled right now as data may change later
+            self._buffer.append(AccountJournal.FRAME.pack(len(record), zlib.crc32(record)))
+            self._buffer.append(record)
+            self.cAppended +=1
+
+        if self._fsyncInterval <=0 :
+            self.flush()
+        else :
+            self.flushIfDue()
+
+    def flushIfDue(self) :
+        if len(self._buffer) >0 and time.time() - self._stampLastSync >= self._fsyncInterval :
+            self.flush()
+
+    def flush(self) :
+        with self._lock :
+            self._stampLastSync = time.time()
+            if len(self._buffer) <=0:
+                return
+
+            if not self._file :
+                self._file = open(self._filepath, 'ab')
+            self._file.write(b''.join(self._buffer))
+            self._buffer = []
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def snapshot(self, state) :
+        '''
+        compact the journal into a snapshot of the state
+        '''
+        self.flush()
+        with self._lock :
+            tmpFilepath = self._snapFilepath + '.tmp'
+            with open(tmpFilepath, 'wb') as f:
+                pickle.dump((self._seq, state), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpFilepath, self._snapFilepath)
+
+            if self._file : self._file.close()
+            self._file = open(self._filepath, 'wb')
+            self.cAppended = 0
+
+    def recover(self) :
+        '''
+        read the latest snapshot and the records after it, where the torn tail of the journal is truncated
+        @return (state of the snapshot or None, list of (kind, data) to replay)
+        '''
+        snapSeq, state = 0, None
+        try :
+            with open(self._snapFilepath, 'rb') as f:
+                snapSeq, state = pickle.load(f)
+        except IOError :
+            pass
+
+        records, offsetGood = [], 0
+        try :
+            with open(self._filepath, 'rb') as f:
+                content = f.read()
+        except IOError :
+            content = b''
+
+        while offsetGood + AccountJournal.FRAME.size <= len(content) :
+            size, crc = AccountJournal.FRAME.unpack_from(content, offsetGood)
+            begin = offsetGood + AccountJournal.FRAME.size
+            record = content[begin : begin + size]
+            if len(record) < size or zlib.crc32(record) != crc :
+                break
+
+            seq, kind, data = pickle.loads(record)
+            offsetGood = begin + size
+            if seq > snapSeq:
+                records.append((kind, data))
+                snapSeq = seq
+
+        with self._lock :
+            if offsetGood < len(content) :
+                with open(self._filepath, 'r+b') as f:
+                    f.truncate(offsetGood)
+            self._seq = snapSeq
+            self.cAppended = len(records)
+
+        return state, records
+
+    def close(self) :
+        self.flush()
+        with self._lock :
+            if self._file : self._file.close()
+            self._file = None
+
 ########################################################################
 class MetaAccount(BaseApplication):
     ''' to make sure the child impl don't miss neccessary methods
@@ -152,6 +472,8 @@ class MetaAccount(BaseApplication):
         '''
         raise NotImplementedError
 
+    @abstractmethod 
+    def positionSnapshot(self) : raise NotImplementedError
     @abstractmethod 
     def cashAmount(self): raise NotImplementedError
     @abstractmethod 
@@ -256,6 +578,13 @@ class Account(MetaAccount):
 
     SYMBOL_CASH = '.RMB.'  # the dummy symbol in order to represent cache in _dictPositions
 
+    # the kinds of records in the AccountJournal
+    JOURNAL_PLACED    = 'placed'
+    JOURNAL_CANCELLED = 'cancelled'
+    JOURNAL_DONE      = 'done'
+    JOURNAL_TRADE     = 'trade'
+    JOURNAL_CASH      = 'cash'
+
     BROKER_API_SYNC  = 'brocker.sync'  # sync API to call broker
     BROKER_API_ASYNC = 'brocker.async' # async API to call broker
 
@@ -287,6 +616,13 @@ class Account(MetaAccount):
         self._mode         = Account.BROKER_API_ASYNC
         self._skipSavingByEvent = False
 
+        # the append-only journal of the order/trade/cash events takes the place of saving the whole state into the shelve at every event
+        self._journal = None
+        if str(self.getConfig('journal/enabled', 'False')).lower() in BOOL_STRVAL_TRUE :
+            journalPath = self.getConfig('journal/path', os.path.join(self.outdir, '%s.journal' % self.ident))
+            self._journal = AccountJournal(journalPath, fsyncInterval=float(self.getConfig('journal/fsyncInterval', 1.0)))
+        self._journalSnapshotEvery = int(self.getConfig('journal/snapshotEvery', 1000)) # compact the journal into a snapshot every N records
+
         self._recorder = None
         if self._contractSize <=0:
             self._contractSize =1
@@ -300,7 +636,9 @@ class Account(MetaAccount):
         self._todayResult = None
 
         self._dictOutgoingOrders = {} # the outgoing orders dict from reqId to OrderData that has not been confirmed with broker's orderId
-        self._lstOrdersToCancel = []
+        self._setOrdersToCancel = set() # the brokerOrderIds to cancel
+        self._heapExpiry = [] # the min-heap of (deadline, seq, brokerOrderId) of the orders that have TTL
+        self._seqExpiry = 0
 
         # cached data from broker
         cashpos = PositionData()
@@ -308,6 +646,9 @@ class Account(MetaAccount):
         self._dictPositions = { # dict from symbol to latest PositionData
             self.cashSymbol : cashpos
         }
+        self._posVersion = 0 # bumped by every change of _dictPositions except the mark-to-market prices
+        self._posSnapshot = None # the latest PositionSnapshot, reused until _posVersion moves on
+        self._posState = None # the latest (version, prices, positions, posValue) of positionState()
         self._dictTrades = {} # dict from tradeId to trade confirmed during today
         self._dictStopOrders = {} # dict from broker's orderId to OrderData that has been submitted but not yet traded
         self._dictLimitOrders = {} # dict from broker's orderId to OrderData that has been submitted but not yet traded
@@ -326,59 +667,99 @@ class Account(MetaAccount):
         self._prevPositions, \
         self._todayResult)
 
-        self.program.saveObject(state, objId +'/s1')
-        self.program.saveObject(self._dictOutgoingOrders, objId +'/outOrders')
-        self.program.saveObject(self._lstOrdersToCancel, objId +'/ordersToCancel')
-        self.program.saveObject(self._dictPositions, objId +'/positions')
-        self.program.saveObject(self._dictTrades, objId +'/trades')
-        self.program.saveObject((self._dictStopOrders,self._dictLimitOrders), objId +'/orders')
+        if self._journal :
+            # the snapshot compacts the journal, taken in the same layout as the objects in the shelve
+            with self._lock :
+                self._journal.snapshot((state, self._dictOutgoingOrders, self._setOrdersToCancel, self._dictPositions, self._dictTrades, (self._dictStopOrders,self._dictLimitOrders)))
+        else :
+            self.program.saveObject(state, objId +'/s1')
+            self.program.saveObject(self._dictOutgoingOrders, objId +'/outOrders')
+            self.program.saveObject(self._setOrdersToCancel, objId +'/ordersToCancel')
+            self.program.saveObject(self._dictPositions, objId +'/positions')
+            self.program.saveObject(self._dictTrades, objId +'/trades')
+            self.program.saveObject((self._dictStopOrders,self._dictLimitOrders), objId +'/orders')
 
         cashAvail, cashTotal, positions = self.positionState()
         _, posvalue = self.summrizeBalance(positions, cashTotal)
         poslist = [i.desc for i in list(self._dictPositions.values())]
-        self.info('saved with bal:%.2f+%.2f, %d outgoing-orders, %d order-to-cancel, %d trades, %d postions: %s' % (cashTotal, posvalue, len(self._dictOutgoingOrders), len(self._lstOrdersToCancel), len(self._dictTrades), len(self._dictPositions), ' + '.join(poslist)))
+        self.info('saved with bal:%.2f+%.2f, %d outgoing-orders, %d order-to-cancel, %d trades, %d postions: %s' % (cashTotal, posvalue, len(self._dictOutgoingOrders), len(self._setOrdersToCancel), len(self._dictTrades), len(self._dictPositions), ' + '.join(poslist)))
+
+    def _saveByEvent(self, journalKind, data):
+        '''
+        persist the state changed by a broker event: appended into the journal if enabled, which is compacted into a
+        snapshot every journal/snapshotEvery records; otherwise the whole state is saved unless _skipSavingByEvent
+        '''
+        if not self._journal :
+            if not self._skipSavingByEvent : self.save()
+            return
+
+        self._journal.append(journalKind, data)
+        if self._journal.cAppended >= self._journalSnapshotEvery :
+            self.save()
 
     def restore(self):  
         objId = '%s/%s' % (self.__class__.__name__, self._id)
 
         try:
-            s1 = self.program.loadObject(objId +'/s1')
-            if not s1:
-                return False
-
-            self._dateToday, \
-            self._datePrevClose, \
-            self._prevPositions, \
-            self._todayResult \
-            = s1
-
-            data = self.program.loadObject(objId +'/positions')
-            self._dictPositions= data if data else {}
-            
-            data = self.program.loadObject(objId +'/outOrders')
-            self._dictOutgoingOrders= data if data else {}
-
-            data = self.program.loadObject(objId +'/ordersToCancel')
-            self._lstOrdersToCancel= data if data else []
-
-            data = self.program.loadObject(objId +'/trades')
-            self._dictTrades= data if data else {}
-
-            data, d2 = self.program.loadObject(objId +'/orders')
-            self._dictStopOrders= data if data else {}
-            self._dictLimitOrders= d2 if d2 else {}
+            snapshot, records = self._journal.recover() if self._journal else (None, [])
+            if not snapshot and len(records) <=0:
+                # nothing journaled yet, take the state from the shelve
+                s1 = self.program.loadObject(objId +'/s1')
+                if not s1:
+                    return False
+
+                snapshot = (s1, self.program.loadObject(objId +'/outOrders'), self.program.loadObject(objId +'/ordersToCancel'),
+                    self.program.loadObject(objId +'/positions'), self.program.loadObject(objId +'/trades'), self.program.loadObject(objId +'/orders'))
+
+            if snapshot :
+                s1, outOrders, ordersToCancel, positions, trades, (stopOrders, limitOrders) = snapshot
+                self._dateToday, \
+                self._datePrevClose, \
+                self._prevPositions, \
+                self._todayResult \
+                = s1
+
+                self._dictPositions= positions if positions else {}
+                self._dictOutgoingOrders= outOrders if outOrders else {}
+                self._setOrdersToCancel= set(ordersToCancel) if ordersToCancel else set()
+                self._dictTrades= trades if trades else {}
+                self._dictStopOrders= stopOrders if stopOrders else {}
+                self._dictLimitOrders= limitOrders if limitOrders else {}
+
+            # replay the events journaled after the snapshot
+            for kind, data in records :
+                self._replayJournal(kind, data)
+
+            self._touchPositions()
+            self._rebuildExpiry()
 
             cashAvail, cashTotal, positions = self.positionState()
             _, posvalue = self.summrizeBalance(positions, cashTotal)
             poslist = [i.desc for i in list(self._dictPositions.values())]
 
-            self.info('restored with bal:%.2f+%.2f, %d outgoing-orders, %d order-to-cancel, %d trades, %d postions: %s' % (cashTotal, posvalue, len(self._dictOutgoingOrders), len(self._lstOrdersToCancel), len(self._dictTrades), len(self._dictPositions), ' + '.join(poslist)))
+            self.info('restored with bal:%.2f+%.2f, %d outgoing-orders, %d order-to-cancel, %d trades, %d postions, %d journal records replayed: %s' % (cashTotal, posvalue, len(self._dictOutgoingOrders), len(self._setOrdersToCancel), len(self._dictTrades), len(self._dictPositions), len(records), ' + '.join(poslist)))
             return True
         except Exception as ex:
             self.logexception(ex)
         
         return False
 
+    def _replayJournal(self, kind, data):
+        if Account.JOURNAL_PLACED == kind :
+            self._applyOrderPlaced(data)
+        elif Account.JOURNAL_CANCELLED == kind :
+            self._applyCancelled(data)
+        elif Account.JOURNAL_DONE == kind :
+            self._applyOrderDone(data)
+        elif Account.JOURNAL_TRADE == kind :
+            if not data.brokerTradeId in self._dictTrades:
+                self._applyTrade(data)
+        elif Account.JOURNAL_CASH == kind :
+            with self._lock :
+                self.__changePos(self.cashSymbol, *data)
+        else :
+            self.warn('_replayJournal() unknown record[%s] skipped' % kind)
+
     #----------------------------------------------------------------------
     #  properties
     #----------------------------------------------------------------------
@@ -427,33 +808,84 @@ class Account(MetaAccount):
         @return tuple:
             cashAvail
             cashTotal
-            positions {symbol:PositionData}
+            positions {symbol:PositionData}, which is shared by the callers until either the positions or the
+                      prices change, so must be taken as read-only: neither the dict nor the PositionData in it may be
+                      modified in place, take a copy.copy() of the PositionData to change it
         '''
         cashAvail, cashTotal = self.cashAmount()
+        with self._lock :
+            return cashAvail, cashTotal, self.__markToMarket()[2]
 
-        allpos ={}
+    def positionSnapshot(self) :
+        ''' get the immutable snapshot of the positions excluding cash
+        @return PositionSnapshot, the same object until a trade/order/cash change bumps the version
+        '''
         with self._lock :
-            for s, pos in self._dictPositions.items() :
-                if self.cashSymbol != s:
-                    price = self.trader.marketState.latestPrice(pos.symbol)
-                    if price >0:
-                        pos.price = price
-            allpos = copy.deepcopy(self._dictPositions)
-            del allpos[self.cashSymbol]
-        return cashAvail, cashTotal, allpos
+            return self.__snapshot()
 
     def summrizeBalance(self, positions=None, cashTotal=0) :
         ''' sum up the account capitial including cash and positions
         '''
         if positions is None:
-            _, cashTotal, positions = self.positionState()
-
-        posValueSubtotal =0
-        for s, pos in positions.items():
-            posValueSubtotal += pos.position * pos.price * self.contractSize
+            _, cashTotal = self.cashAmount()
+            with self._lock :
+                posValueSubtotal = self.__markToMarket()[3]
+        else :
+            state = self._posState
+            if state and positions is state[2] :
+                posValueSubtotal = state[3]
+            else :
+                posValueSubtotal =0
+                for s, pos in positions.items():
+                    posValueSubtotal += pos.position * pos.price * self.contractSize
 
         return round(cashTotal,2), round(posValueSubtotal, 2)
 
+    def _touchPositions(self): # thread unsafe
+        self._posVersion +=1
+
+    def __snapshot(self): # thread unsafe
+        snap = self._posSnapshot
+        if snap and snap.version == self._posVersion:
+            return snap
+
+        symbols = tuple([s for s in self._dictPositions.keys() if s != self.cashSymbol])
+        poslist = [self._dictPositions[s] for s in symbols]
+        snap = PositionSnapshot(self._posVersion, symbols,
+                    PositionSnapshot.column([p.position for p in poslist]),
+                    PositionSnapshot.column([p.posAvail for p in poslist]),
+                    PositionSnapshot.column([p.avgPrice for p in poslist]),
+                    PositionSnapshot.column([p.price for p in poslist]))
+        self._posSnapshot = snap
+        return snap
+
+    def __markToMarket(self): # thread unsafe
+        '''
+        value the snapshot by the latest prices, the positions dict is only rebuilt when the version or any price moved
+        @return (version, prices, positions {symbol:PositionData}, posValue)
+        '''
+        snap = self.__snapshot()
+        state = self._posState
+        prevPrices = state[1] if state and state[0] == snap.version else snap.price
+
+        prices = prevPrices
+        if len(snap.symbols) >0:
+            latest = np.array([self.trader.marketState.latestPrice(s) for s in snap.symbols], dtype=np.float64)
+            prices = np.where(latest >0, latest, prevPrices)
+
+        if state and state[0] == snap.version and np.array_equal(state[1], prices) :
+            return state
+
+        allpos ={}
+        for i, s in enumerate(snap.symbols):
+            pos = self._dictPositions[s]
+            pos.price = float(prices[i])
+            allpos[s] = copy.copy(pos)
+
+        prices.flags.writeable = False
+        self._posState = (snap.version, prices, allpos, float(np.dot(snap.position, prices)) * self.contractSize)
+        return self._posState
+
     def tradeBeginOfDay(dt = None):
         return (dt if dt else datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
 
@@ -484,7 +916,11 @@ class Account(MetaAccount):
 
     def cashChange(self, dAvail=0, dTotal=0):
         with self._lock :
-            return self.__changePos(self.cashSymbol, dAvail, dTotal)
+            ret = self.__changePos(self.cashSymbol, dAvail, dTotal)
+
+        if self._journal :
+            self._journal.append(Account.JOURNAL_CASH, (dAvail, dTotal))
+        return ret
 
     def record(self, category, row) :
         if not self._recorder and self.trader :
@@ -537,7 +973,7 @@ class Account(MetaAccount):
         if self._mode == Account.BROKER_API_ASYNC :
             with self._lock:
                 if self._mode == Account.BROKER_API_ASYNC :
-                    self._lstOrdersToCancel.append(brokerOrderId)
+                    self._setOrdersToCancel.add(brokerOrderId)
                     self.debug('enqueued order[%s]' % brokerOrderId)
                     return
 
@@ -562,7 +998,7 @@ class Account(MetaAccount):
         orderData.price       = self.roundByPriceTick(price) # 报单价格
         orderData.totalVolume = volume    # 报单总数量
         orderData.reason      = reason if reason else ''
-        # ???? orderData.msecTTL     = self._msecOrderTTL if self._msecOrderTTL >0 else 0.0
+        orderData.msecTTL     = self._msecOrderTTL if self._msecOrderTTL >0 else 0.0
         
         # 报单方向
         if orderType == OrderData.ORDER_BUY:
@@ -608,6 +1044,14 @@ class Account(MetaAccount):
         if orderData.fstampSubmitted <= 0.1:
             orderData.fstampSubmitted = datetime2float(self.datetimeAsOfMarket()) # self.datetimeAsOfMarket().strftime('%H:%M:%S.%f')[:3]
 
+        self._applyOrderPlaced(orderData)
+        self.info('order[%s] has been placed, got brokerOrderId[%s] reason: %s' % (orderData.desc, orderData.brokerOrderId, orderData.reason))
+
+        self.postEvent_Order(orderData)
+        self._saveByEvent(Account.JOURNAL_PLACED, orderData)
+        self.record(Account.RECCATE_ORDER, orderData)
+
+    def _applyOrderPlaced(self, orderData):
         # order placed, move it from _dictOutgoingOrders to _dictLimitOrders
         with self._lock :
             try :
@@ -618,21 +1062,16 @@ class Account(MetaAccount):
                 self._dictStopOrders[orderData.brokerOrderId] = orderData
             else :
                 self._dictLimitOrders[orderData.brokerOrderId] = orderData
+            self._scheduleExpiry(orderData)
 
-        self.info('order[%s] has been placed, got brokerOrderId[%s] reason: %s' % (orderData.desc, orderData.brokerOrderId, orderData.reason))
-
-        if orderData.direction == OrderData.DIRECTION_LONG:
-            turnover, commission, slippage = self.calcAmountOfTrade(orderData.symbol, orderData.price, orderData.totalVolume)
-            self.__changePos(self.cashSymbol, -(turnover + commission + slippage))
-        elif orderData.direction == OrderData.DIRECTION_SHORT:
-            with self._lock :
+            if orderData.direction == OrderData.DIRECTION_LONG:
+                turnover, commission, slippage = self.calcAmountOfTrade(orderData.symbol, orderData.price, orderData.totalVolume)
+                self.__changePos(self.cashSymbol, -(turnover + commission + slippage))
+            elif orderData.direction == OrderData.DIRECTION_SHORT:
                 pos = self._dictPositions[orderData.symbol]
                 if pos:
                     pos.posAvail = round(pos.posAvail - orderData.totalVolume, 2)
-
-        self.postEvent_Order(orderData)
-        if not self._skipSavingByEvent : self.save()
-        self.record(Account.RECCATE_ORDER, orderData)
+                    self._touchPositions()
 
     def _broker_cancelOrder(self, brokerOrderId):
         """撤单"""
@@ -643,6 +1082,12 @@ class Account(MetaAccount):
         if orderData.fstampCanceled <= 0.1:
             orderData.fstampCanceled = datetime2float(self.datetimeAsOfMarket()) #  self.datetimeAsOfMarket().strftime('%H:%M:%S.%f')[:3]
 
+        self._applyCancelled(orderData)
+        self.info('order.brokerOrderId[%s] canceled' % orderData.brokerOrderId)
+        self.postEvent_Order(orderData)
+        self._saveByEvent(Account.JOURNAL_CANCELLED, orderData)
+
+    def _applyCancelled(self, orderData):
         with self._lock :
             try :
                 if not OrderData.STOPORDERPREFIX in orderData.reqId :
@@ -664,10 +1109,7 @@ class Account(MetaAccount):
                 pos = self._dictPositions[orderData.symbol]
                 if pos:
                     pos.posAvail = round(pos.posAvail + orderData.totalVolume, 2)
-
-        self.info('order.brokerOrderId[%s] canceled' % orderData.brokerOrderId)
-        self.postEvent_Order(orderData)
-        if not self._skipSavingByEvent : self.save()
+                    self._touchPositions()
 
     def findOrdersOfStrategy(self, strategyId, symbol=None):
         ret = []
@@ -689,6 +1131,11 @@ class Account(MetaAccount):
         if orderData.fstampFinished <= 0.1:
             orderData.fstampFinished = datetime2float(self.datetimeAsOfMarket()) #  
 
+        self._applyOrderDone(orderData)
+        self.postEvent_Order(orderData)
+        self._saveByEvent(Account.JOURNAL_DONE, orderData)
+
+    def _applyOrderDone(self, orderData):
         with self._lock :
             try :
                 if not OrderData.STOPORDERPREFIX in orderData.reqId :
@@ -702,15 +1149,22 @@ class Account(MetaAccount):
                 turnover, commission, slippage = self.calcAmountOfTrade(orderData.symbol, orderData.price, orderData.totalVolume)
                 self.__changePos(self.cashSymbol, turnover + commission + slippage)
 
-        self.postEvent_Order(orderData)
-        if not self._skipSavingByEvent : self.save()
-
     def _broker_onTrade(self, trade):
         """交易成功回调"""
         if trade.brokerTradeId in self._dictTrades:
             return
 
         trade.tradeID = "T" +trade.brokerTradeId +"@" + self.ident # to make the tradeID global unique
+        pos, strPrevPos = self._applyTrade(trade)
+
+        cashAvail, cashTotal = self.cashAmount()
+        self.info('broker_onTrade() trade[%s]@%s processed, pos[%s->%s/%s] cash[%.2f/%.2f]' % (trade.desc, trade.asof.strftime('%Y%m%dT%H%M%S'), strPrevPos, pos.posAvail, pos.position, cashAvail, cashTotal))#, pos.desc))
+        self.postEventData(Account.EVENT_TRADE, copy.copy(trade))
+        self._saveByEvent(Account.JOURNAL_TRADE, trade)
+        self.record(Account.RECCATE_TRADE, trade)
+
+    def _applyTrade(self, trade):
+        '''@return (the updated PositionData, the previous posAvail/position in string)'''
         with self._lock :
             self._dictTrades[trade.brokerTradeId] = trade
 
@@ -757,12 +1211,9 @@ class Account(MetaAccount):
                 # TODO: T+0 also need to increase pos.avalPos
                 
             pos.stampByTrader = trade.datetime  # the current position is calculated based on trade
-        
-        cashAvail, cashTotal = self.cashAmount()
-        self.info('broker_onTrade() trade[%s]@%s processed, pos[%s->%s/%s] cash[%.2f/%.2f]' % (trade.desc, trade.asof.strftime('%Y%m%dT%H%M%S'), strPrevPos, pos.posAvail, pos.position, cashAvail, cashTotal))#, pos.desc))
-        self.postEventData(Account.EVENT_TRADE, copy.copy(trade))
-        if not self._skipSavingByEvent : self.save()
-        self.record(Account.RECCATE_TRADE, trade)
+            self._touchPositions()
+
+        return pos, strPrevPos
 
     def _broker_onOpenOrders(self, dictOrders):
         """枚举订单回调"""
@@ -851,6 +1302,11 @@ class Account(MetaAccount):
     #----------------------------------------------------------------------
     # impl of BaseApplication
 
+    def stop(self):
+        super(Account, self).stop()
+        if self._journal :
+            self._journal.close()
+
     def doAppInit(self): # return True if succ
         if not super(Account, self).doAppInit() :
             return False
@@ -888,50 +1344,11 @@ class Account(MetaAccount):
     def doAppStep(self):
 
         # step 1. flush out-going orders and cancels to the broker
-        outgoingOrders = []
-        ordersToCancel = []
-
-        cStep =0
         fstampNow = datetime2float(self.datetimeAsOfMarket())
-        strExpired = ''
-        cExpired=0
-
         with self._lock:
-            outgoingOrders = copy.deepcopy(self._dictOutgoingOrders.values()) if len(self._dictOutgoingOrders) >0 else []
-
-            # find out those expired orders, append them into _lstOrdersToCancel
-            if fstampNow >0.0 :
-                for odid,odata in self._dictLimitOrders.items():
-                    if odata.msecTTL <=0 or odata.fstampSubmitted + odata.msecTTL > fstampNow: continue
-                    if odid in self._lstOrdersToCancel : continue
-                    self._lstOrdersToCancel.append(odid)
-                    strExpired += 'O[%s],' % odata.desc
-                    cExpired +=1
-
-                for odid,odata in self._dictStopOrders.items():
-                    if odata.msecTTL <=0 or odata.fstampSubmitted + odata.msecTTL > fstampNow: continue
-                    if odid in self._lstOrdersToCancel : continue
-                    self._lstOrdersToCancel.append(odid)
-                    strExpired += 'O[%s],' % odata.desc
-                    cExpired +=1
-
-            # find out orderData of canceled orders by brokerOrderId
-            for odid in self._lstOrdersToCancel :
-                orderData = None
-                cStep +=1
-                try :
-                    if OrderData.STOPORDERPREFIX in odid :
-                        orderData = self._dictStopOrders[odid]
-                    else :
-                        orderData = self._dictLimitOrders[odid]
-                except KeyError:
-                    pass
-
-                if orderData :
-                    ordersToCancel.append(copy.copy(orderData))
-
-            self._lstOrdersToCancel = []
+            outgoingOrders, ordersToCancel, expiredOrders = self._flushOrders(fstampNow)
 
+        cStep = len(ordersToCancel)
         for co in ordersToCancel:
             self._broker_cancelOrder(co)
             cStep +=1
@@ -940,8 +1357,8 @@ class Account(MetaAccount):
             self._broker_placeOrder(no)
             cStep +=1
 
-        if (cExpired>0):
-            self.warn('step() placed %d orders, cancelled %d orders including %d expired: %s'% (len(outgoingOrders), len(ordersToCancel), cExpired, strExpired))
+        if len(expiredOrders) >0:
+            self.warn('step() placed %d orders, cancelled %d orders including %d expired: %s'% (len(outgoingOrders), len(ordersToCancel), len(expiredOrders), ''.join(['O[%s],' % o.desc for o in expiredOrders])))
         elif (len(ordersToCancel) + len(outgoingOrders)) >0:
             self.info('step() placed %d orders, cancelled %d orders'% (len(outgoingOrders), len(ordersToCancel)))
 
@@ -952,11 +1369,58 @@ class Account(MetaAccount):
             self._brocker_triggerSync()
             cStep +=1
 
+        if self._journal :
+            self._journal.flushIfDue()
+
         return cStep
 
     # end of BaseApplication routine
     #----------------------------------------------------------------------
 
+    def _expiryOf(orderData):
+        # fstampSubmitted is in seconds
+        return orderData.fstampSubmitted + orderData.msecTTL /1000.0
+
+    def _scheduleExpiry(self, orderData): # thread unsafe
+        if orderData.msecTTL <=0: return
+        self._seqExpiry +=1
+        heapq.heappush(self._heapExpiry, (Account._expiryOf(orderData), self._seqExpiry, orderData.brokerOrderId))
+
+    def _rebuildExpiry(self): # thread unsafe
+        self._heapExpiry = []
+        for o in list(self._dictLimitOrders.values()) + list(self._dictStopOrders.values()):
+            self._scheduleExpiry(o)
+
+    def _pendingOrder(self, brokerOrderId): # thread unsafe
+        dict = self._dictStopOrders if OrderData.STOPORDERPREFIX in brokerOrderId else self._dictLimitOrders
+        return dict.get(brokerOrderId, None)
+
+    def _flushOrders(self, fstampNow): # thread unsafe
+        '''
+        take the outgoing orders and the orders to cancel, where only the orders whose TTL has expired are popped from
+        the expiry heap, and the outgoing queue is swapped out instead of copied
+        @return tuple (list of outgoing orders, list of copies of orders to cancel, list of expired orders)
+        '''
+        outgoingOrders = list(self._dictOutgoingOrders.values())
+        self._dictOutgoingOrders = {}
+
+        expiredOrders = []
+        while fstampNow >0.0 and len(self._heapExpiry) >0 and self._heapExpiry[0][0] <= fstampNow:
+            deadline, _, odid = heapq.heappop(self._heapExpiry)
+            odata = self._pendingOrder(odid)
+            if not odata or Account._expiryOf(odata) != deadline or odid in self._setOrdersToCancel: continue # gone or rescheduled
+            self._setOrdersToCancel.add(odid)
+            expiredOrders.append(odata)
+
+        ordersToCancel = []
+        for odid in self._setOrdersToCancel :
+            odata = self._pendingOrder(odid)
+            if odata :
+                ordersToCancel.append(copy.copy(odata))
+
+        self._setOrdersToCancel = set()
+        return outgoingOrders, ordersToCancel, expiredOrders
+
     def __changePos(self, symbol, dAvail=0, dTotal=0): # thread unsafe
         pos = self._dictPositions[symbol]
         volprice = pos.price * self._contractSize
@@ -984,6 +1448,7 @@ class Account(MetaAccount):
         pos.posAvail = round(newAvail, 3)
         pos.position = round(newTotal, 3)
         pos.stampByTrader = self.datetimeAsOfMarket()
+        self._touchPositions()
         return True
 
     #----------------------------------------------------------------------
@@ -1121,7 +1586,7 @@ class Account(MetaAccount):
             self.onDayClose()
 
         # shift the positions, must do copy each PositionData
-        cashAvail, cashTotal, self._prevPositions = self.positionState()
+        cashAvail, cashTotal, self._prevPositions = self.positionState() # keeps the shared read-only snapshot, must not be modified
         posCap =0
 
         if self._todayResult :
@@ -1139,6 +1604,8 @@ class Account(MetaAccount):
         self._dictTrades.clear() # clean the trade list
         self._state = Account.STATE_OPEN
         self.debug('onDayOpen(%s) updated todayResult: %scash +%spos' % (self._dateToday, self._todayResult.cash, self._todayResult.posValue))
+        if self._journal :
+            self.save() # the journaled records of yesterday are no more to replay onto the new day
     
     def onTimer(self, dt):
         # TODO refresh from BrokerDriver
@@ -1192,7 +1659,7 @@ class Account(MetaAccount):
                 tradesOfSymbol[t.symbol].append(t)
 
         result = []
-        cashAvail, cashTotal, currentPositions = self.positionState() # this is a duplicated copy, so thread-safe
+        cashAvail, cashTotal, currentPositions = self.positionState() # the shared read-only snapshot, never modified here
         for s in currentPositions.keys():
             if not s in tradesOfSymbol.keys():
                 tradesOfSymbol[s] = [] # fill a dummy trade list
@@ -1296,10 +1763,11 @@ class Account_AShare(Account):
         with self._lock :
             # A-share will not keep yesterday's order alive
             # all the out-standing order will be cancelled
-            cOutgoingOrders, cOrdersToCancel, cLimitOrders, cStopOrders = len(self._dictOutgoingOrders), len(self._lstOrdersToCancel), len(self._dictLimitOrders), len(self._dictStopOrders)
+            cOutgoingOrders, cOrdersToCancel, cLimitOrders, cStopOrders = len(self._dictOutgoingOrders), len(self._setOrdersToCancel), len(self._dictLimitOrders), len(self._dictStopOrders)
 
             self._dictOutgoingOrders.clear()
-            self._lstOrdersToCancel =[]
+            self._setOrdersToCancel = set()
+            self._heapExpiry = []
             self._dictLimitOrders.clear()
             self._dictStopOrders.clear()
 
@@ -1312,10 +1780,14 @@ class Account_AShare(Account):
                 if pos.position != pos.posAvail :
                     strshift += '%s[%sov%s], ' % (pos.symbol, pos.position, pos.posAvail)
                 pos.posAvail = pos.position
+            self._touchPositions()
 
             if sum([cOutgoingOrders, cOrdersToCancel, cLimitOrders, cStopOrders])>0 or len(strshift) >0:
                 self.info('onDayOpen(%s) cleared %d,%d,%d,%d orders and shifted avail-positions: %s' % (self._dateToday, cOutgoingOrders, cOrdersToCancel, cLimitOrders, cStopOrders, strshift))
 
+        if self._journal :
+            self.save()
+
         #TODO: sync with broker
 
 # ########################################################################
@@ -1411,6 +1883,26 @@ class PositionData(EventData):
     def desc(self) :
         return 'Pos>%s(%d/%d)@%.3f' % (self.symbol, self.posAvail, self.position, self.price)
 
+########################################################################
+class PositionSnapshot(namedtuple('PositionSnapshot', 'version symbols position posAvail avgPrice price')):
+    '''
+    The immutable snapshot of the positions as of a version of the account, each field but version and symbols is
+    a read-only float64 array aligned with symbols. the price is the latest known price when the snapshot was taken
+    '''
+    __slots__ = ()
+
+    def column(values) :
+        col = np.array(values, dtype=np.float64)
+        col.flags.writeable = False
+        return col
+
+    def index(self, symbol) :
+        '''@return the index of symbol in the arrays, or -1 if not held'''
+        try :
+            return self.symbols.index(symbol)
+        except ValueError :
+            return -1
+
 ########################################################################
 class DailyPosition(EventData):
     '''每日交易的结果'''
@@ -1591,3 +2083,123 @@ class DailyResult(object):
     #     # 汇总
     #     self.totalPnl = round(self.tradingPnl + self.positionPnl, 2)
     #     self.netPnl = round(self.totalPnl - self.commission - self.slippage, 2)
+
+########################################################################
+class EpisodeStats(object):
+    '''
+    The running statistics over the DailyResults pushed day by day, so that the same summary as the DataFrame-based
+    Simulator.calculateSummary() is available in O(1) at any time of an episode
+        - the high-water mark and the max drawdown of endBalance
+        - the mean and the sample std of the daily log-returns by Welford's algorithm
+        - the sums of netPnl, commission, slippage, turnover and trade counts
+    '''
+    def __init__(self):
+        self.totalDays = 0
+        self.startDate, self.endDate = None, None
+        self.profitDays, self.lossDays = 0, 0
+        self.daysHaveTrade, self.tradeDay_1st, self.tradeDay_last = 0, None, None
+        self.__idxTradeDay_last = -1
+
+        self.endBalance, self.highlevel = 0, 0
+        self.maxDrawdown, self.maxDdPercent = 0, 0
+
+        self.totalNetPnl, self.totalCommission, self.totalSlippage, self.totalTurnover = 0, 0, 0, 0
+        self.tcBuys, self.tcSells = 0, 0
+
+        self.__retMean, self.__retM2 = 0.0, 0.0
+
+    def push(self, dr, date=None):
+        '''
+        @param dr - the DailyResult of a closed day
+        @param date - the date to take if dr.date is not set
+        '''
+        if not dr.date: dr.date = date
+
+        if self.totalDays <=0:
+            self.startDate, self.highlevel = dr.date, dr.endBalance
+            ret = 0.0
+        else :
+            ret = float(np.log(dr.endBalance) - np.log(self.endBalance))
+
+        self.totalDays +=1
+        self.endDate = dr.date
+        self.endBalance = dr.endBalance
+
+        # Welford's online mean and M2 of the log-returns
+        delta = ret - self.__retMean
+        self.__retMean += delta / self.totalDays
+        self.__retM2 += delta * (ret - self.__retMean)
+
+        self.highlevel = max(self.highlevel, dr.endBalance)
+        drawdown = dr.endBalance - self.highlevel
+        self.maxDrawdown = min(self.maxDrawdown, drawdown)
+        self.maxDdPercent = min(self.maxDdPercent, drawdown / self.highlevel * 100)
+
+        if dr.netPnl > 0.01: self.profitDays +=1
+        elif dr.netPnl < -0.01: self.lossDays +=1
+
+        if (dr.tcBuy + dr.tcSell) >0:
+            self.daysHaveTrade +=1
+            if self.daysHaveTrade ==1: self.tradeDay_1st = dr.date
+            self.tradeDay_last = dr.date
+            self.__idxTradeDay_last = self.totalDays -1
+
+        self.tcBuys  += dr.tcBuy
+        self.tcSells += dr.tcSell
+        self.totalNetPnl     += dr.netPnl
+        self.totalCommission += dr.commission
+        self.totalSlippage   += dr.slippage
+        self.totalTurnover   += dr.turnover
+
+    @property
+    def dailyReturn(self) :
+        '''@return the mean of daily log-returns in percentage'''
+        return self.__retMean * 100
+
+    @property
+    def returnStd(self) :
+        '''@return the sample std of daily log-returns in percentage, NaN if less than 2 days'''
+        return math.sqrt(self.__retM2 / (self.totalDays -1)) * 100 if self.totalDays >1 else float('nan')
+
+    def summary(self, startBalance):
+        '''
+        @return the summary dict as Simulator.calculateSummary() gives, or None if no day has been pushed
+        '''
+        totalDays = self.totalDays
+        if totalDays <=0:
+            return None
+
+        endBalance = round(self.endBalance, 2)
+        totalTradeCount = self.tcBuys + self.tcSells
+        returnStd = self.returnStd
+        sharpeRatio = self.dailyReturn / returnStd * np.sqrt(240) if returnStd else 0
+
+        return {
+            'startDate': self.startDate,
+            'endDate': self.endDate,
+            'totalDays': totalDays,
+            'profitDays': self.profitDays,
+            'lossDays': self.lossDays,
+            'endBalance': round(endBalance, 3),
+            'maxDrawdown': round(round(self.maxDrawdown, 2), 3),
+            'maxDdPercent': round(round(self.maxDdPercent, 2), 3),
+            'totalNetPnl': round(self.totalNetPnl, 3),
+            'dailyNetPnl': round(self.totalNetPnl / totalDays, 3),
+            'totalCommission': round(self.totalCommission, 3),
+            'dailyCommission': round(self.totalCommission / totalDays, 3),
+            'totalSlippage': round(self.totalSlippage, 3),
+            'dailySlippage': round(self.totalSlippage / totalDays, 3),
+            'totalTurnover': round(self.totalTurnover, 3),
+            'dailyTurnover': round(self.totalTurnover / totalDays, 3),
+            'totalTradeCount': totalTradeCount,
+            'dailyTradeCount': round(totalTradeCount / totalDays, 3),
+            'totalReturn':    round((endBalance/startBalance - 1) * 100, 3),
+            'annualizedReturn': round((math.exp(math.log(endBalance/startBalance) / (totalDays /Account_AShare.ANNUAL_TRADE_DAYS)) -1) *100, 3),
+            'dailyReturn': round(self.dailyReturn, 3),
+            'returnStd': returnStd,
+            'sharpeRatio': sharpeRatio,
+            'daysHaveTrade': self.daysHaveTrade,
+            'tradeDay_1st': self.tradeDay_1st,
+            'tradeDay_last': self.tradeDay_last,
+            'endLazyDays' : totalDays - self.__idxTradeDay_last -1 if self.tradeDay_last else totalDays
+        }
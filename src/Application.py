@@ -2,12 +2,12 @@
 
 from __future__ import division
 
-from EventData import Event, EventData, EVENT_SYS_CLOCK, DT_EPOCH, datetime2float
+from EventData import Event, EventData, EVENT_SYS_CLOCK, EVENT_NAME_PREFIX, DT_EPOCH, datetime2float
 
 import os
 import logging
 from logging.handlers import RotatingFileHandler
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
 import time
 from copy import copy
@@ -518,12 +518,113 @@ else:
     from queue import Queue, Empty
 
 import tempfile
+
+########################################################################
+class HandlerProfiler(object):
+    '''
+    The timing of the handlers called by Program.loop, per app and per what (an event type or doAppStep), where each
+    entry keeps the count, sum, max and a log2 histogram of usec to estimate the percentiles
+    '''
+    RECCATE_PROFILE = 'Prof'
+    COLUMNS = 'stamp,app,what,count,secs,usecAvg,usecMax,usecP50,usecP99'
+    BUCKETS = 32 # bucket b counts the durations of [2^(b-1), 2^b) usec
+
+    def __init__(self) :
+        self._entries = {} # (appId, what) to [count, secs, maxSecs, histogram]
+
+    def record(self, appId, what, secs) :
+        e = self._entries.get((appId, what), None)
+        if e is None:
+            e = self._entries[(appId, what)] = [0, 0.0, 0.0, [0] * HandlerProfiler.BUCKETS]
+        e[0] +=1
+        e[1] += secs
+        if secs > e[2]: e[2] = secs
+        e[3][min(int(secs *1000000).bit_length(), HandlerProfiler.BUCKETS -1)] +=1
+
+    def percentile(histogram, count, pct) :
+        '''
+        @return the upper bound in usec of the bucket where the percentile falls
+        '''
+        threshold, c = count * pct /100.0, 0
+        for b in range(len(histogram)) :
+            c += histogram[b]
+            if c >= threshold :
+                return 1 << b
+        return 1 << len(histogram)
+
+    def summary(self) :
+        '''
+        @return list of dict as rows of COLUMNS, ordered by the time taken
+        '''
+        rows = []
+        stamp = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        for (appId, what), (count, secs, maxSecs, histogram) in self._entries.items() :
+            rows.append({ 'stamp': stamp, 'app': appId, 'what': what, 'count': count, 'secs': round(secs, 6),
+                'usecAvg': round(secs *1000000 / max(1, count), 1), 'usecMax': round(maxSecs *1000000, 1),
+                'usecP50': HandlerProfiler.percentile(histogram, count, 50), 'usecP99': HandlerProfiler.percentile(histogram, count, 99) })
+
+        rows.sort(key=lambda r: -r['secs'])
+        return rows
+
+    def reset(self) :
+        self._entries = {}
+
+########################################################################
+class StackSampler(threading.Thread):
+    '''
+    The sampling profiler that peeks the stack of a thread periodically, so that the hot spots can be found
+    with much less overhead than cProfile
+    '''
+    def __init__(self, threadId, interval=0.005) :
+        super(StackSampler, self).__init__(daemon=True)
+        self._threadId = threadId
+        self._interval = interval
+        self._samples = 0
+        self._counts = defaultdict(int) # function to the number of samples that it is on the stack
+        self._selfCounts = defaultdict(int) # function to the number of samples that it is on the top
+        self._bRun = True
+
+    def __funcName(frame) :
+        code = frame.f_code
+        return '%s:%s(%s)' % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+    def run(self) :
+        while self._bRun :
+            time.sleep(self._interval)
+            frame = sys._current_frames().get(self._threadId, None)
+            if frame is None: continue
+
+            self._samples +=1
+            self._selfCounts[StackSampler.__funcName(frame)] +=1
+            onstack = set()
+            while frame :
+                onstack.add(StackSampler.__funcName(frame))
+                frame = frame.f_back
+            for func in onstack :
+                self._counts[func] +=1
+
+    def stop(self) :
+        self._bRun = False
+
+    def top(self, n=20) :
+        '''
+        @return list of (function, pctOnStack, pctOnTop) of the n functions most on the stack
+        '''
+        total = max(1, self._samples)
+        funcs = sorted(self._counts.items(), key=lambda x: -x[1])[:n]
+        return [ (func, round(c *100.0 / total, 1), round(self._selfCounts.get(func, 0) *100.0 / total, 1)) for func, c in funcs ]
+
 class Program(object):
     ''' main program '''
 
     # 单例模式
     __metaclass__ = Singleton
 
+    # the priorities of event dispatching, the orders/trades of Account.EVENT_PREFIX go ahead of the market data of MarketData.MARKETDATE_EVENT_PREFIX
+    PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+    EVENT_PRIORITIES_BY_PREFIX = [ (EVENT_NAME_PREFIX + 'acc', PRIORITY_HIGH), (EVENT_NAME_PREFIX + 'md', PRIORITY_LOW) ]
+    EVENTS_SNAPSHOT = [ EVENT_NAME_PREFIX + 'mdTick' ] # the market data whose latest of a symbol supersedes the previous ones, such as MarketData.EVENT_TICK
+
     #----------------------------------------------------------------------
     def __init__(self, argvs=None) : # setting_filename=None):
         '''Constructor
@@ -581,7 +682,7 @@ class Program(object):
         self.__logger = None
         self.initLogger()
         
-        # 事件队列
+        # 事件队列, the item is (stampPublished, event)
         self.__queue = Queue()
         self.__dictMetaObjs = OrderedDict()
         self.__activeApps = []
@@ -592,6 +693,27 @@ class Program(object):
         # __subscribers字典，用来保存对应的事件到appId的订阅关系
         # 其中每个键对应的值是一个列表，列表中保存了对该事件进行监听的appId
         self.__subscribers = {}
+        self.__subscriberApps = {} # the cache of event type to the resolved [(appId, app)], reset once subscription or app changes
+
+        # the events drained from __queue by loop(), pending to dispatch by priority
+        self._batchSize   = int(self.getConfig('loop/batchSize', 20)) # the max events to drain and dispatch in a batch
+        self._coalesceAt  = int(self.getConfig('loop/coalesceAt', 300)) # coalesce the superseded market events once this many events are pending
+        self.__evPriorities = {}
+        for k, v in self.getConfig('loop/priorities', {}).items() :
+            self.__evPriorities[k] = int(v)
+        self.__pendings = [ deque() for i in range(Program.PRIORITY_LOW +1) ] # of [stampPublished, event, coalesceKey]
+        self.__cPending = 0
+        self.__coalesceIdx = {} # coalesceKey to the pending item
+        self.__stampLastWarn = 0
+        self.__loopStats = { 'dispatched':0, 'coalesced':0, 'maxQueueDepth':0, 'latencySum':0.0, 'latencyMax':0.0 }
+        self.__hdlrStats = defaultdict(lambda: [0, 0.0]) # appId to [count, seconds] of handling events
+
+        # the profiling of the handlers, which costs nothing but a None-test per call when disabled
+        self.__profiler = HandlerProfiler() if str(self.getConfig('profile/enabled', 'False')).lower() in BOOL_STRVAL_TRUE else None
+        self._profileDumpInterval = float(self.getConfig('profile/dumpInterval', 60)) # seconds between two dumps into logger and recorder
+        self._pyprofile = self.getConfig('profile/pyprofile', '') # '' for none, 'cProfile' or 'sampling'
+        self.__profileRecorder = None
+        self.__stampLastDump = 0
 
         self.info('='*10 + ' %s(%d) starts ' %(self.__progName, self.__pid)  + '='*10)
     
@@ -666,6 +788,7 @@ class Program(object):
         # 创建应用实例
         self.__dictMetaObjs[id] = obj
         self.__dict__[id] = self.__dictMetaObjs[id]
+        self.__subscriberApps = {}
         self.debug('obj[%s] added' % id)
         return obj
 
@@ -676,6 +799,7 @@ class Program(object):
         # del self.__dict__[id]
         o = self.__dictMetaObjs[id]
         del self.__dictMetaObjs[id]
+        self.__subscriberApps = {}
         return o
 
     def addObj(self, obj):
@@ -816,6 +940,8 @@ class Program(object):
                 self.__activeApps.append(app.ident)
                 self.info('initialized app[%s] as %s' % (appId, app.ident))
 
+        self.__subscriberApps = {}
+
         if len(self.__activeApps) <=0 : 
             self._bRun =False
             self.error('no apps started, quitting')
@@ -847,13 +973,162 @@ class Program(object):
     def hasHeartbeat(self) : 
         return (self._heartbeatInterval > 0) # what's wrong!!!!
 
+    def __coalesceKey(self, event) :
+        '''
+        @return the key that a later market event supersedes the pending one with: (type, symbol) of a snapshot such as tick,
+                or (type, symbol, asof) of others such as the KLine being overwritten; None if not coalescible
+        '''
+        try :
+            if event.type in Program.EVENTS_SNAPSHOT :
+                return (event.type, event.data.symbol)
+            return (event.type, event.data.symbol, event.data.asof)
+        except Exception:
+            pass
+        return None
+
+    def __drainQueue(self, block=False, timeout=0) :
+        '''
+        move up to a batch of events from the queue into the pendings by priority, the superseded market events
+        are coalesced once the pendings back up
+        @return the count of events drained
+        '''
+        cDrained = 0
+        while cDrained < self._batchSize :
+            try :
+                stamp, event = self.__queue.get(block = block and cDrained <=0, timeout = timeout)
+            except Empty:
+                break
+            cDrained +=1
+
+            prio = self.eventPriority(event.type)
+            key = None
+            if Program.PRIORITY_LOW == prio and self.__cPending >= self._coalesceAt :
+                key = self.__coalesceKey(event)
+                if key and key in self.__coalesceIdx :
+                    self.__coalesceIdx[key][1] = event # the newer replaces the superseded one in place
+                    self.__loopStats['coalesced'] +=1
+                    continue
+
+            item = [stamp, event, key]
+            if key: self.__coalesceIdx[key] = item
+            self.__pendings[prio].append(item)
+            self.__cPending +=1
+
+        depth = self.__cPending + self.__queue.qsize()
+        if depth > self.__loopStats['maxQueueDepth'] :
+            self.__loopStats['maxQueueDepth'] = depth
+        if depth > max(300, self._coalesceAt) and time.time() - self.__stampLastWarn >60:
+            self.__stampLastWarn = time.time()
+            self.warn("too many pending events: %d, stats: %s" % (depth, self.loopStats))
+
+        return cDrained
+
+    def __popPending(self) :
+        for que in self.__pendings :
+            if len(que) <=0: continue
+            item = que.popleft()
+            self.__cPending -=1
+            if item[2] and self.__coalesceIdx.get(item[2], None) is item:
+                del self.__coalesceIdx[item[2]]
+            return item
+        return None
+
+    def __subscriberAppsOf(self, type_) :
+        if not type_ in self.__subscriberApps :
+            apps = []
+            for appId in self.__subscribers.get(type_, []) :
+                app = self.getApp(appId)
+                if app: apps.append((appId, app))
+            self.__subscriberApps[type_] = apps
+        return self.__subscriberApps[type_]
+
+    def __dispatch(self, item) :
+        stamp, event = item[0], item[1]
+        stampStart = time.time()
+        latency = stampStart - stamp
+        self.__loopStats['dispatched'] +=1
+        self.__loopStats['latencySum'] += latency
+        if latency > self.__loopStats['latencyMax'] :
+            self.__loopStats['latencyMax'] = latency
+
+        # 若存在，则按顺序将事件传递给处理函数执行
+        for appId, app in self.__subscriberAppsOf(event.type) :
+            if not app.isActive:
+                continue
+
+            try:
+                app._procEvent(event)
+            except KeyboardInterrupt:
+                self.error("quit per KeyboardInterrupt")
+                self._bRun = False
+                break
+            except Exception as ex:
+                self.error("app step exception %s %s" % (ex, traceback.format_exc()))
+
+            if not self.__profiler: continue # the handlers are only timed when profiling
+            stampEnd = time.time()
+            st = self.__hdlrStats[appId]
+            st[0] +=1
+            st[1] += stampEnd - stampStart
+            self.__profiler.record(appId, event.type, stampEnd - stampStart)
+            stampStart = stampEnd
+
+    def __stepApps(self) :
+        '''
+        @return the count of active apps
+        '''
+        cApps =0
+        for appId in self.__activeApps :
+            app = self.getObj(appId)
+            # if threaded, it has its own trigger to step()
+            # if isinstance(app, ThreadedAppWrapper)
+            #   continue
+            if not app or not isinstance(app, MetaApp):
+                continue
+
+            if not app.isActive :
+                continue
+            cApps +=1
+
+            if not isinstance(app, BaseApplication):
+                continue
+            
+            try:
+                if self.__profiler :
+                    stampStart = time.time()
+                    app.doAppStep()
+                    self.__profiler.record(appId, 'doAppStep', time.time() - stampStart)
+                else :
+                    app.doAppStep()
+            except KeyboardInterrupt:
+                self.error("quit per KeyboardInterrupt")
+                self._bRun = False
+                break
+            except Exception as ex:
+                self.error("app[%s] step exception %s %s" % (appId, ex, traceback.format_exc()))
+
+        return cApps
+
     def loop(self):
 
         self.info(u'Program start looping')
-        busy = True
         cContinuousEvent =0
 
+        pyprofiler = None
+        if 'cProfile' == self._pyprofile :
+            import cProfile
+            pyprofiler = cProfile.Profile()
+            pyprofiler.enable()
+        elif 'sampling' == self._pyprofile :
+            pyprofiler = StackSampler(threading.get_ident())
+            pyprofiler.start()
+
+        self.__stampLastDump = time.time()
+
         while self._bRun:
+            if self.__profiler and time.time() - self.__stampLastDump > self._profileDumpInterval :
+                self.dumpProfile()
+
             timeout =0
             enabledHB = self.hasHeartbeat
             # enabledHB = False
@@ -876,92 +1151,52 @@ class Program(object):
                     event.setData(ed)
                     self.publish(event)
 
-            # pop the event to dispatch
-            bEmpty = False
-            qsize, maxsize, =0, 0
-            while self._bRun and not bEmpty:
-                event = None
-                try :
-                    if cContinuousEvent >0: timeout = 0.1
-                    event = self.__queue.get(block = enabledHB, timeout = timeout)  # 获取事件的阻塞时间设为0.1秒
-                    bEmpty = False
-                    qsize, maxsize = self.__queue.qsize(), self.__queue.maxsize
-                    
-                    if qsize > max(300, maxsize/2):
-                        self.warn("too many pending events: %d/%d" % (qsize,maxsize) )
-                except Empty:
-                    bEmpty = True
-                except KeyboardInterrupt:
-                    self.error("quit per KeyboardInterrupt")
-                    self._bRun = False
-                    break
-                except Except as ex:
-                    self.logexception(ex)
-                    cContinuousEvent = 0
-                    timeout = max(1.0, self._heartbeatInterval)
-
-                # do the step only when there is no event
-                cApps =0
-                if not event or cContinuousEvent >max(10, qsize*0.6):
+            try :
+                # step 1. drain a batch of events into the pendings, only wait for the events when nothing is pending
+                if cContinuousEvent >0: timeout = min(timeout, 0.1)
+                self.__drainQueue(block = enabledHB and self.__cPending <=0, timeout = timeout)
+
+                # step 2. do the step only when there is no event, or too many events have been dispatched continuously
+                if self.__cPending <=0 or cContinuousEvent >max(10, self.__cPending*0.6):
                     cContinuousEvent =0
-                    # if blocking: # ????
-                    #     continue
-                    for appId in self.__activeApps :
-                        app = self.getObj(appId)
-                        # if threaded, it has its own trigger to step()
-                        # if isinstance(app, ThreadedAppWrapper)
-                        #   continue
-                        if not app or not isinstance(app, MetaApp):
-                            continue
-
-                        if not app.isActive :
-                            continue
-                        cApps +=1
-
-                        if not isinstance(app, BaseApplication):
-                            continue
-                        
-                        try:
-                            app.doAppStep()
-                        except KeyboardInterrupt:
-                            self.error("quit per KeyboardInterrupt")
-                            self._bRun = False
-                            break
-                        except Exception as ex:
-                            self.error("app[%s] step exception %s %s" % (appId, ex, traceback.format_exc()))
-
-                    if cApps <=0:
+                    if self.__stepApps() <=0:
                         self.info("Program has no more active apps running, update running state")
                         self._bRun = False
                         break
-                            
-                if not event :
-                    if cApps <=0:
-                        self.warn("something wrong in program loop: %s %s"%(cApps, cContinuousEvent))
-                    continue
-
-                cContinuousEvent +=1
-
-                # 检查是否存在对该事件进行监听的处理函数
-                if not event.type in self.__subscribers.keys():
-                    continue
 
-                # 若存在，则按顺序将事件传递给处理函数执行
-                for appId in self.__subscribers[event.type] :
-                    app = self.getApp(appId)
-                    if not app or not app.isActive:
+                    if self.__cPending <=0:
                         continue
 
-                    try:
-                        app._procEvent(event)
-                    except KeyboardInterrupt:
-                        self.error("quit per KeyboardInterrupt")
-                        self._bRun = False
-                        break
-                    except Exception as ex:
-                        self.error("app step exception %s %s" % (ex, traceback.format_exc()))
+                # step 3. dispatch a batch of the pendings by priority
+                for i in range(self._batchSize) :
+                    item = self.__popPending()
+                    if not item or not self._bRun: break
+                    cContinuousEvent +=1
+                    self.__dispatch(item)
 
-        self.info(u'Program finish looping')
+            except KeyboardInterrupt:
+                self.error("quit per KeyboardInterrupt")
+                self._bRun = False
+                break
+            except Exception as ex:
+                self.logexception(ex)
+                cContinuousEvent = 0
+
+        self.info(u'Program finish looping, stats: %s' % self.loopStats)
+        self.dumpProfile()
+
+        if isinstance(pyprofiler, StackSampler) :
+            pyprofiler.stop()
+            for func, pctOnStack, pctOnTop in pyprofiler.top(30) :
+                self.info('sampled %s%% on stack, %s%% on top: %s' % (pctOnStack, pctOnTop, func))
+        elif pyprofiler :
+            pyprofiler.disable()
+            fn = os.path.join(self.__outdir, '%s.pstats' % self.progId)
+            try :
+                pyprofiler.dump_stats(fn)
+                self.info('cProfile stats saved into %s' % fn)
+            except Exception as ex:
+                self.logexception(ex)
 
     #----------------------------------------------------------------------
     def daemonize(self, stdin='/dev/null',stdout='/dev/null',stderr='/dev/null'):
@@ -1020,6 +1255,7 @@ class Program(object):
         # 若要注册的处理器不在该事件的处理器列表中，则注册该事件
         if not app.ident in self.__subscribers[type_]:
             self.__subscribers[type_].append(app.ident)
+            self.__subscriberApps.pop(type_, None)
             
     def unsubscribe(self, type_, app):
         '''注销事件处理函数监听'''
@@ -1031,6 +1267,7 @@ class Program(object):
         # 如果该函数存在于列表中，则移除
         if appId in self.__subscribers[type_]:
             self.__subscribers[type_].remove(appId)
+            self.__subscriberApps.pop(type_, None)
 
         # 如果函数列表为空，则从引擎中移除该事件类型
         if len(self.__subscribers[type_]) <=0:
@@ -1038,9 +1275,70 @@ class Program(object):
 
     def publish(self, event):
         '''向事件队列中存入事件'''
-        self.__queue.put(event)
+        self.__queue.put((time.time(), event))
         return self.__queue.qsize(), self.__queue.maxsize
 
+    def setEventPriority(self, type_, priority):
+        '''
+        @param priority - one of PRIORITY_HIGH, PRIORITY_NORMAL and PRIORITY_LOW
+        '''
+        self.__evPriorities[type_] = priority
+
+    def eventPriority(self, type_):
+        if not type_ in self.__evPriorities :
+            prio = Program.PRIORITY_NORMAL
+            for prefix, p in Program.EVENT_PRIORITIES_BY_PREFIX :
+                if prefix == type_[:len(prefix)] :
+                    prio = p
+                    break
+            self.__evPriorities[type_] = prio
+
+        return self.__evPriorities[type_]
+
+    def enableProfile(self, enabled=True):
+        if not enabled :
+            self.__profiler = None
+        elif not self.__profiler :
+            self.__profiler = HandlerProfiler()
+
+    def setProfileRecorder(self, recorder):
+        '''
+        @param recorder - the TaggedCsvRecorder to dump the profile into as category HandlerProfiler.RECCATE_PROFILE
+        '''
+        self.__profileRecorder = recorder
+        if recorder :
+            recorder.registerCategory(HandlerProfiler.RECCATE_PROFILE, params= {'columns' : HandlerProfiler.COLUMNS })
+
+    @property
+    def profile(self):
+        '''
+        @return the rows of HandlerProfiler.summary(), None if profiling is disabled
+        '''
+        return self.__profiler.summary() if self.__profiler else None
+
+    def dumpProfile(self):
+        if not self.__profiler : return
+        self.__stampLastDump = time.time()
+        rows = self.__profiler.summary()
+        self.info('profile of %d handlers, loop stats: %s' % (len(rows), self.loopStats))
+        for r in rows :
+            self.info('profile %s/%s: %dx %ssec avg%s max%s p50<%s p99<%s usec' % (r['app'], r['what'], r['count'], r['secs'], r['usecAvg'], r['usecMax'], r['usecP50'], r['usecP99']))
+            if self.__profileRecorder :
+                self.__profileRecorder.pushRow(HandlerProfiler.RECCATE_PROFILE, r)
+
+    @property
+    def loopStats(self):
+        '''
+        @return dict of the dispatching stats: queue depth, dispatch latency in msec, and the handling time of each app if profiling
+        '''
+        stats = copy(self.__loopStats)
+        dispatched = max(1, stats['dispatched'])
+        stats['queueDepth'] = self.__queue.qsize() + self.__cPending
+        stats['latencyAvg'] = round(stats.pop('latencySum') *1000 / dispatched, 3)
+        stats['latencyMax'] = round(stats['latencyMax'] *1000, 3)
+        stats['apps'] = { appId: { 'events': c, 'msecAvg': round(secs *1000 / max(1, c), 3), 'secs': round(secs, 3) } for appId, (c, secs) in self.__hdlrStats.items() }
+        return stats
+
     def getConfig(self, configName, defaultVal, pop=False) :
         try :
             if self.__jsettings:
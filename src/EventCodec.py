@@ -0,0 +1,156 @@
+# encoding: UTF-8
+'''
+The wire codec of the events delivered to the remote EventEnds
+    - the hot event data types are encoded by fixed struct layouts, led by a magic byte, the type tag and the layout version
+    - the other events fall back to pickle, and the receiver tells the codec of each message by its leading byte, so
+      that the EventEnds of either codec understand each other
+'''
+from __future__ import division
+
+from EventData    import Event
+from MarketData   import TickData, KLineData, MoneyflowData
+from TradeAdvisor import AdviceData
+from Account      import OrderData, TradeData
+
+from datetime import datetime, timedelta
+import struct, pickle, operator
+
+CODEC_PICKLE = 'pickle'
+CODEC_BINARY = 'binary'
+
+WIRE_MAGIC   = 0xEB # never leads a pickle, which starts with b'\x80' since protocol 2
+DT_USEC_NONE = -(1 <<63)  # the datetime of None
+STR_LEN_NONE = 0xFFFF     # the string of None
+DT_ORIGIN    = datetime(1970, 1, 1)
+USEC         = timedelta(microseconds=1)
+ENVELOPE_FIELDS = frozenset(['data', 'publisher', 'sig']) # the keys of Event.dict_ that the binary layout carries
+
+def _tupleGetter(fields) :
+    '''
+    @return the function to take the values of the fields from a dict as a tuple, where operator.itemgetter() of a single
+            field would return the value itself
+    '''
+    if len(fields) == 1 :
+        f = fields[0]
+        return lambda d: (d[f],)
+    if len(fields) <= 0 :
+        return lambda d: ()
+    return operator.itemgetter(*fields)
+
+########################################################################
+class WireSchema(object):
+    '''
+    The fixed layout of an EventData type on the wire:
+        magic, tag, version, numbers in float64, datetimes in int64 usec, lengths of the strings in uint16, then the
+        utf-8 bytes of the strings, where the strings start with the event type, publisher and signature of the Event
+    the data is only encoded if its attributes are exactly the fields of the schema, otherwise None is returned to
+    take pickle instead
+    '''
+    def __init__(self, tag, cls, numbers, datetimes, strings, version=1):
+        self.tag, self.cls, self.version = tag, cls, version
+        self.numbers, self.datetimes, self.strings = tuple(numbers), tuple(datetimes), tuple(strings)
+        self.fields = self.numbers + self.datetimes + self.strings
+        self._layout = struct.Struct('<BBB%dd%dq%dH' % (len(self.numbers), len(self.datetimes), 3 + len(self.strings)))
+        # the getters of the field values from the __dict__ of the data, compiled once instead of looked up per field
+        self._numbersOf, self._datetimesOf, self._stringsOf = _tupleGetter(self.numbers), _tupleGetter(self.datetimes), _tupleGetter(self.strings)
+
+    @property
+    def fixedSize(self) : return self._layout.size
+
+    def encode(self, ev) :
+        '''
+        @return bytes of the event, or None if the event doesn't fit this schema
+        '''
+        d = ev.dict_['data'].__dict__
+        if len(d) != len(self.fields) :
+            return None
+
+        try :
+            dts = [DT_USEC_NONE if v is None else (v - DT_ORIGIN) // USEC for v in self._datetimesOf(d)]
+            strs = (ev.type, ev.dict_.get('publisher'), ev.dict_.get('sig')) + self._stringsOf(d)
+            lens, bstrs = [], []
+            for s in strs :
+                if s is None :
+                    lens.append(STR_LEN_NONE)
+                    continue
+                b = s.encode('utf-8')
+                if len(b) >= STR_LEN_NONE :
+                    return None # too long to fit uint16
+                lens.append(len(b))
+                bstrs.append(b)
+
+            return self._layout.pack(WIRE_MAGIC, self.tag, self.version, *(self._numbersOf(d) + tuple(dts) + tuple(lens))) + b''.join(bstrs)
+        except (KeyError, TypeError, AttributeError, struct.error) :
+            pass # such as a tz-aware datetime, or a number of None
+
+        return None
+
+    def decode(self, msg) :
+        values = self._layout.unpack_from(msg)
+        cNum, cDt = len(self.numbers), len(self.datetimes)
+        offset, strs = self._layout.size, []
+        for l in values[3 + cNum + cDt:] :
+            if STR_LEN_NONE == l :
+                strs.append(None)
+                continue
+            strs.append(msg[offset : offset +l].decode('utf-8'))
+            offset += l
+
+        data = self.cls.__new__(self.cls)
+        data.__dict__ = dict(zip(self.fields, values[3 : 3 + cNum] + tuple([None if v == DT_USEC_NONE else DT_ORIGIN + v *USEC for v in values[3 + cNum : 3 + cNum + cDt]]) + tuple(strs[3:])))
+
+        ev = Event(strs[0])
+        ev.setData(data)
+        if not strs[1] is None: ev.dict_['publisher'] = strs[1]
+        if not strs[2] is None: ev.dict_['sig'] = strs[2]
+        return ev
+
+MARKETDATA_STRINGS = ['symbol', 'vtSymbol', 'exchange', 'date', 'time']
+
+# all the numbers travel as float64, such as the volumes that are taken as float from the most of the sources
+WIRE_SCHEMAS = [
+    WireSchema(1, TickData,
+        ['price', 'volume', 'openInterest', 'open', 'high', 'low', 'prevClose', 'upperLimit', 'lowerLimit',
+         'b1P', 'b2P', 'b3P', 'b4P', 'b5P', 'b1V', 'b2V', 'b3V', 'b4V', 'b5V',
+         'a1P', 'a2P', 'a3P', 'a4P', 'a5P', 'a1V', 'a2V', 'a3V', 'a4V', 'a5V'],
+        ['datetime'], MARKETDATA_STRINGS),
+    WireSchema(2, KLineData, ['open', 'high', 'low', 'close', 'volume', 'openInterest'], ['datetime'], MARKETDATA_STRINGS),
+    WireSchema(3, MoneyflowData, ['price', 'netamount', 'ratioNet', 'r0_ratio', 'r3cate_ratio'], ['datetime'], MARKETDATA_STRINGS),
+    WireSchema(4, AdviceData,
+        ['price', 'dirNONE', 'dirLONG', 'dirSHORT', 'Rdaily', 'Rdstd', 'pdirNONE', 'pdirLONG', 'pdirSHORT', 'pdirPrice'],
+        ['datetime', 'pdirAsOf'], ['advisorId', 'symbol', 'exchange', 'strDir']),
+    WireSchema(5, OrderData,
+        ['price', 'totalVolume', 'tradedVolume', 'msecTTL', 'fstampSubmitted', 'fstampCanceled', 'fstampFinished'],
+        ['datetime'], ['reqId', 'brokerOrderId', 'accountId', 'exchange', 'symbol', 'direction', 'offset', 'status', 'reason']),
+    WireSchema(6, TradeData, ['price', 'volume'], ['datetime'],
+        ['tradeID', 'brokerTradeId', 'accountId', 'exchange', 'symbol', 'orderID', 'direction', 'offset']),
+]
+
+_schemaByCls = { s.cls : s for s in WIRE_SCHEMAS }
+_schemaByTag = { s.tag : s for s in WIRE_SCHEMAS }
+
+def encodeEvent(ev, codec=CODEC_BINARY) :
+    '''
+    @return bytes of the event, by the binary layout if the codec is CODEC_BINARY and the event fits a schema, otherwise by pickle
+    '''
+    if CODEC_BINARY == codec :
+        schema = _schemaByCls.get(type(ev.data))
+        if schema and ENVELOPE_FIELDS.issuperset(ev.dict_) :
+            msg = schema.encode(ev)
+            if msg : return msg
+
+    return pickle.dumps(ev)
+
+def decodeEvent(msg) :
+    '''
+    @return the Event decoded by either the binary layout or pickle per the leading byte of msg
+    @raise ValueError if the binary tag or version is unknown by this end
+    '''
+    if len(msg) <=0 or msg[0] != WIRE_MAGIC :
+        return pickle.loads(msg)
+
+    schema = _schemaByTag.get(msg[1]) if len(msg) >2 else None
+    if not schema or schema.version != msg[2] :
+        raise ValueError('unsupported wire layout tag[%s] version[%s]' % (msg[1] if len(msg) >1 else None, msg[2] if len(msg) >2 else None))
+
+    return schema.decode(msg)
@@ -4,7 +4,7 @@
 '''
 from __future__ import division
 
-from Application import BaseApplication, Iterable
+from Application import BaseApplication, Iterable, BOOL_STRVAL_TRUE
 from EventData import *
 from MarketData import *
 '''
@@ -22,13 +22,31 @@ from abc import ABC, abstractmethod
 
 import sys, re
 if sys.version_info <(3,):
-    from Queue import Queue, Empty
+    from Queue import Queue, Empty, Full
 else:
-    from queue import Queue, Empty
+    from queue import Queue, Empty, Full
 import bz2
+import bisect
+import threading
+import numpy as np
+
+try :
+    import h5py
+except ImportError:
+    h5py = None
 
 EVENT_TOARCHIVE  = EVENT_NAME_PREFIX + 'toArch'
 
+class ArchiveData(EventData):
+    '''the data of EVENT_TOARCHIVE'''
+    def __init__(self, filename):
+        super(ArchiveData, self).__init__()
+        self.filename = filename
+
+    @property
+    def desc(self) :
+        return 'archive:%s' % self.filename
+
 def listAllFiles(folder, depthAllowed=5):
     ret =[]
     if depthAllowed <=0:
@@ -66,6 +84,7 @@ class Recorder(BaseApplication):
 
         # 配置字典
         self._dictDR = OrderedDict() # categroy -> { fieldnames, ....}
+        self._lockDR = threading.Lock() # _dictDR is also read and written by the writer thread of an asynchronous recorder
 
         # 负责执行数据库插入的单独线程相关
         self.__queRowsToRecord = Queue()  # 队列 of (category, Data)
@@ -121,14 +140,16 @@ class Recorder(BaseApplication):
         '''
         if 'columns' in params.keys() and isinstance(params['columns'], str) :
             params['columns'] = params['columns'].split(',')
-        if not category in self._dictDR.keys() :
-            self._dictDR[category] = OrderedDict()
-        coll = self._dictDR[category]
-        coll['params'] = params
+        with self._lockDR :
+            if not category in self._dictDR.keys() :
+                self._dictDR[category] = OrderedDict()
+            coll = self._dictDR[category]
+            coll['params'] = params
         return coll
 
     def findCollection(self, category) :
-        return self._dictDR[category] if category in self._dictDR.keys() else None
+        with self._lockDR :
+            return self._dictDR[category] if category in self._dictDR.keys() else None
 
 ########################################################################
 import csv
@@ -146,6 +167,16 @@ class TaggedCsvRecorder(Recorder):
             "minFlushInterval" : 0.3,
             "daysToRoll" : 1.0,
             "days2archive"  : 0.0028,
+
+            // the asynchronous mode where pushRow() only enqueues, a writer thread formats and writes the rows in
+            // batches and the rotated files are compressed by a background worker
+            "asyncWrite" : "True",
+            "queueSize" : 100000, // the rows pushed beyond this are dropped and counted in droppedRows
+            "batchRows" : 1000,
+
+            // the rotated file is compressed as a series of independent bz2 streams of about blockKB each, and
+            // an index <file>.N.bz2.idx is saved aside for TcsvFilter to seek by category/symbol/time
+            "blockKB" : 1024,
         }
     '''
 
@@ -169,8 +200,12 @@ class TaggedCsvRecorder(Recorder):
         if self._fileMB <=1:
             self._fileMB =10
 
-        # employing the logger
-        self.__fakedcsv   = logging.Logger(name=self.ident) #getLogger()
+        self._async       = str(self.getConfig('asyncWrite', 'False')).lower() in BOOL_STRVAL_TRUE
+        self._queueSize   = int(self.getConfig('queueSize', 100000))
+        self._batchRows   = int(self.getConfig('batchRows', 1000))
+        self._blockKB     = int(self.getConfig('blockKB', 1024))
+
+        self.__fakedcsv   = None
         self.__1stRow   = True     
         
         try :
@@ -183,6 +218,19 @@ class TaggedCsvRecorder(Recorder):
             except:
                 pass
 
+        # the asynchronous writer
+        self.__queAsync, self.__queCompress = None, None
+        self.__thWriter, self.__thCompressor = None, None
+        self.__fout, self.__fileSize, self.__stampFlushed = None, 0, None
+        self.__cDropped, self.__cWritten = 0, 0
+        if self._async :
+            self.__queAsync    = Queue(maxsize=self._queueSize)
+            self.__queCompress = Queue()
+            self.__fakedcsv = True # the writer thread opens the file by itself
+            return
+
+        # employing the logger
+        self.__fakedcsv   = logging.Logger(name=self.ident) #getLogger()
         self.__hdlrFile = logging.handlers.RotatingFileHandler(self._filepath, maxBytes=self._fileMB*1024*1024, backupCount=self._fileCount) # 20MB about to 3MB after bzip2
         self.__hdlrFile.rotator  = self.__rotator
         self.__hdlrFile.namer    = self.__rotating_namer
@@ -190,19 +238,63 @@ class TaggedCsvRecorder(Recorder):
         self.__hdlrFile.setFormatter(logging.Formatter('%(message)s')) # only the message itself with NO stamp and so on
         self.__fakedcsv.addHandler(self.__hdlrFile)
 
+    @property
+    def queueDepth(self) :
+        return self.__queAsync.qsize() if self.__queAsync else 0
+
+    @property
+    def droppedRows(self) : return self.__cDropped
+
+    @property
+    def writtenRows(self) : return self.__cWritten
+
     def __rotating_namer(self, name):
         return name + ".bz2"
 
     def __rotator(self, source, dest):
         self.__1stRow   = True
+        self.__shiftBackups([self.__rotating_namer('') + TcsvFilter.INDEX_SUFFIX]) # RotatingFileHandler has already shifted the .bz2 files
+        self.__compress(source, dest)
+
+    def __shiftBackups(self, suffixes):
+        '''
+        shift <filepath>.i<suffix> to <filepath>.i+1<suffix> as RotatingFileHandler.doRollover() does
+        '''
+        for i in range(self._fileCount -1, 0, -1):
+            for suffix in suffixes :
+                sfn = '%s.%d%s' % (self._filepath, i, suffix)
+                dfn = '%s.%d%s' % (self._filepath, i +1, suffix)
+                if os.path.exists(sfn):
+                    if os.path.exists(dfn): os.remove(dfn)
+                    os.rename(sfn, dfn)
+
+    def __compress(self, source, dest):
+        '''
+        compress the source into a series of independently decompressible bz2 streams, and save the offset index
+        of the streams by category/symbol aside. bz2.open() reads such a multi-stream file the same as a single stream
+        '''
         stampStart = datetime.now()     
-        with open(source, "rb") as sf:
-            data = sf.read()
-            compressed = bz2.compress(data, 9)
-            with open(dest, "wb") as df:
-                df.write(compressed)
+        idx = TcsvFilter.newIndex()
+        blockLines, blockBytes, offset = [], 0, 0
+        with open(source, "rt") as sf, open(dest, "wb") as df:
+            for line in sf :
+                blockLines.append(line)
+                blockBytes += len(line)
+                if blockBytes < self._blockKB *1024:
+                    continue
+
+                offset += TcsvFilter.writeBlock(df, idx, blockLines, offset)
+                blockLines, blockBytes = [], 0
+
+            if len(blockLines) >0:
+                offset += TcsvFilter.writeBlock(df, idx, blockLines, offset)
+
+        idx['size'] = offset
+        fnIdx = dest + TcsvFilter.INDEX_SUFFIX
+        with open(fnIdx, 'w') as f:
+            json.dump(idx, f)
         os.remove(source)
-        self.info('rotated %s to %s, took %s' % (source, dest, (datetime.now() - stampStart)))
+        self.info('rotated %s to %s in %d blocks, took %s' % (source, dest, len(idx['blocks']), (datetime.now() - stampStart)))
 
 
     # impl of BaseApplication
@@ -214,15 +306,57 @@ class TaggedCsvRecorder(Recorder):
         if not self.__fakedcsv :
             return False
 
+        if self._async and not self.__thWriter :
+            self.__thWriter = threading.Thread(target=self.__writerLoop, name='%s.writer' % self.ident, daemon=True)
+            self.__thCompressor = threading.Thread(target=self.__compressorLoop, name='%s.compressor' % self.ident, daemon=True)
+            self.__thWriter.start()
+            self.__thCompressor.start()
+
         return True
 
+    def stop(self):
+        super(TaggedCsvRecorder, self).stop()
+        if self.__thWriter :
+            # flush the rows queued so far, and wait for the compressing of the rotated files
+            self.__queAsync.put((None, None))
+            self.__thWriter.join()
+            self.__queCompress.put(None)
+            self.__thCompressor.join()
+            self.__thWriter, self.__thCompressor = None, None
+            self.info('stopped async writer: %d rows written, %d dropped' % (self.__cWritten, self.__cDropped))
+
     # impl/overwrite of Recorder
     #----------------------------------------------------------------------
+    def pushRow(self, category, row):
+        if not self._async :
+            return super(TaggedCsvRecorder, self).pushRow(category, row)
+
+        if row and not isinstance(row, dict) :
+            row = row.__dict__
+        row = dict(row) if row else {} # take a snapshot as the writer formats it later
+        try :
+            self.__queAsync.put((category, row), block=False)
+        except Full:
+            self.__cDropped +=1
+
     def configIndex(self, category, definition, unique=False):
         """定义某category collection的index"""
         pass # nothing to do as csv doesn't support index
 
     def _saveRow(self, category, row) :
+        line = None
+        with self._lockDR :
+            lines = self.__formatRow(category, row)
+        for line in lines :
+            self.__fakedcsv.info(line)
+        return line
+
+    def __formatRow(self, category, row) :
+        '''
+        @return the list of lines to output for the row, including the header lines if this is the first row of file
+        the caller must hold _lockDR
+        '''
+        lines = []
         columns = None
         if self.__1stRow :
             self.__1stRow = False
@@ -232,7 +366,7 @@ class TaggedCsvRecorder(Recorder):
                 if k == category:
                     columns = v['params']['columns']
                 headerLine = ('!%s,' % k) + ','.join(v['params']['columns'])
-                self.__fakedcsv.info(headerLine)
+                lines.append(headerLine)
 
         if not columns and category in self._dictDR.keys():
             columns = self._dictDR[category]['params']['columns']
@@ -250,14 +384,98 @@ class TaggedCsvRecorder(Recorder):
             colnames = row.keys()
             self._dictDR[category] = { 'params':{'columns': colnames} }
             headerLine = ('!%s,' % category) + ','.join(colnames)
-            self.__fakedcsv.info(headerLine)
+            lines.append(headerLine)
             cols=row.values()
             # for k, v in row.items():
             #     cols.append(v)
             
         line = '%s,%s' % (category, ','.join([str(c) for c in cols]))
-        self.__fakedcsv.info(line)
-        return line
+        lines.append(line)
+        return lines
+
+    # --the asynchronous writer----------------------------------------------------------------
+    def __writerLoop(self) :
+        self.__fout = open(self._filepath, 'a', buffering=1024*1024, encoding='utf-8')
+        self.__fileSize = self.__fout.tell()
+        self.__stampFlushed = datetime.now()
+        maxBytes = self._fileMB*1024*1024
+        bEnd = False
+
+        while not bEnd :
+            items = []
+            try :
+                items.append(self.__queAsync.get(block=True, timeout=0.5))
+                while len(items) < self._batchRows :
+                    items.append(self.__queAsync.get(block=False))
+            except Empty:
+                pass
+
+            buf = []
+            for category, row in items :
+                if category is None :
+                    bEnd = True
+                    continue
+
+                if self.__fileSize >= maxBytes : # the same as RotatingFileHandler, roll before the row that exceeds
+                    self.__writeBuffered(buf)
+                    buf = []
+                    self.__rollover()
+
+                try :
+                    with self._lockDR : # against registerCategory() from the caller's thread
+                        lines = self.__formatRow(category, row)
+                    for line in lines :
+                        line += '\n'
+                        buf.append(line)
+                        self.__fileSize += len(line.encode('utf-8')) # the rollover threshold is of bytes
+                    self.__cWritten +=1
+                except Exception as ex:
+                    self.logexception(ex)
+
+            self.__writeBuffered(buf)
+            if bEnd or (datetime.now() - self.__stampFlushed).total_seconds() > self._minFlushInterval :
+                self.__fout.flush()
+                self.__stampFlushed = datetime.now()
+
+        self.__fout.close()
+        self.__fout = None
+
+    def __writeBuffered(self, buf) :
+        if len(buf) <=0: return
+        try :
+            self.__fout.write(''.join(buf))
+        except Exception as ex:
+            self.logexception(ex)
+
+    def __rollover(self) :
+        '''
+        rename the current file and hand it to the compressor, so that the writer never blocks on bz2
+        '''
+        self.__fout.close()
+        rotated = '%s.%s.rot' % (self._filepath, datetime.now().strftime('%Y%m%dT%H%M%S%f'))
+        try :
+            os.rename(self._filepath, rotated)
+            self.__queCompress.put(rotated)
+        except Exception as ex:
+            self.logexception(ex)
+
+        self.__fout = open(self._filepath, 'a', buffering=1024*1024, encoding='utf-8')
+        self.__fileSize = 0
+        self.__1stRow = True
+
+    def __compressorLoop(self) :
+        while True :
+            source = self.__queCompress.get()
+            if source is None: break
+
+            # shift the backups as RotatingFileHandler.doRollover() does, then compress the rotated into <filepath>.1.bz2
+            try :
+                self.__shiftBackups([self.__rotating_namer(''), self.__rotating_namer('') + TcsvFilter.INDEX_SUFFIX])
+                dest = self.__rotating_namer(self._filepath + '.1')
+                if os.path.exists(dest): os.remove(dest)
+                self.__compress(source, dest)
+            except Exception as ex:
+                self.logexception(ex)
 
     # --private methods----------------------------------------------------------------
     def __checkAndRoll(self, collection) :
@@ -294,7 +512,7 @@ class TaggedCsvRecorder(Recorder):
                     continue
                 if stk[-2] <stampToZip:
                     fn = '%s/%s' % (collection['dir'], name)
-                    self.postEvent(EVENT_TOARCHIVE, fn)
+                    self.postEventData(EVENT_TOARCHIVE, ArchiveData(fn))
                     self.debug('schedule to archive: %s' % fn)
 
         fname = '%s/%s.%s.csv' % (collection['dir'], collection['fn'], stampThis)
@@ -315,17 +533,37 @@ class TaggedCsvRecorder(Recorder):
         return collection
 
 ########################################################################
+def _filterTcsvBlock(task) :
+    '''
+    the worker of TcsvFilter's process pool
+    @return the list of lines filtered from a compressed block
+    '''
+    fn, offset, length, matcher = task
+    return list(TcsvFilter.filterLines(TcsvFilter.readBlock(fn, offset, length), *matcher))
+
 class TcsvFilter(MetaObj):
-    def __init__(self, tcsvFilePath, categroy, symbol=None):
+    '''
+    The reader to extract a category out of a tcsv file and its rotated <file>.N.bz2 files, such as
+        pd.read_csv(TcsvFilter('/tmp/SH510050_P9334.tcsv', 'DRes', 'SH510050'))
+    the rotated files with an index sidecar <file>.N.bz2.idx only have the blocks of the category/symbol/time-window
+    decompressed, optionally by a pool of processes; the others are scanned through
+    startTime/endTime are compared to the 'datetime' or 'date time' columns of rows as strings
+    '''
+    INDEX_SUFFIX = '.idx'
+
+    def __init__(self, tcsvFilePath, categroy, symbol=None, startTime=None, endTime=None, processes=0):
         super(MetaObj, self).__init__()
         self.__gen=None
         self._tcsvFilePath = tcsvFilePath
         self.__category = categroy.strip()
         self.__symbol = symbol.strip() if symbol else None
+        self.__startTime = startTime
+        self.__endTime = endTime
+        self.__processes = processes
 
     def __iter__(self):
         fnlist = TcsvFilter.buildUpFileList(self._tcsvFilePath)
-        self.__gen = TcsvFilter.funcGen(fnlist, self.__category, self.__symbol)
+        self.__gen = TcsvFilter.funcGen(fnlist, self.__category, self.__symbol, self.__startTime, self.__endTime, self.__processes)
         return self
 
     def __next__(self):
@@ -359,7 +597,7 @@ class TcsvFilter(MetaObj):
                 if len(suffix) <=0:
                     fnlist.append(name)
                     continue
-                m = re.match(r'\.([0-9]*)\.bz2', suffix)
+                m = re.match(r'\.([0-9]*)\.bz2$', suffix)
                 if m :
                     bz2dict[int(m.group(1))] = name
 
@@ -373,15 +611,167 @@ class TcsvFilter(MetaObj):
         fnlist = [os.path.join(dirname, x) for x in fnlist]
         return fnlist
 
-    def funcGen(fnlist, tag, symbol=None):
+    # --the offset index of compressed blocks----------------------------------------------
+    def newIndex() :
+        '''
+        @return an empty index, where
+            headers: {category: [columns]}
+            blocks:  [[offset, length]] of the independent bz2 streams
+            entries: {category: {symbol: [[firstStamp, lastStamp, offset, length]]}}
+        '''
+        return { 'size':0, 'headers':{}, 'blocks':[], 'entries':{} }
+
+    def columnsOf(headers) :
+        '''
+        @return (idxSymbol, idxStamps) of the columns, -1 and [] if not found
+        '''
+        idxSymbol = headers.index('symbol') if 'symbol' in headers else -1
+        if 'datetime' in headers:
+            idxStamps = [headers.index('datetime')]
+        elif 'date' in headers and 'time' in headers:
+            idxStamps = [headers.index('date'), headers.index('time')]
+        else : idxStamps = []
+        return idxSymbol, idxStamps
+
+    def stampOf(cols, idxStamps) :
+        return ' '.join([cols[i] for i in idxStamps if i < len(cols)])
+
+    def writeBlock(fout, idx, lines, offset) :
+        '''
+        compress the lines as an independent bz2 stream into fout and index it
+        @return the length of the compressed block
+        '''
+        compressed = bz2.compress(''.join(lines).encode(), 9)
+        fout.write(compressed)
+        length = len(compressed)
+        idx['blocks'].append([offset, length])
+
+        # take the headers first, as the row that triggered a rollover of RotatingFileHandler precedes the headers
+        for line in lines:
+            if '!' == line[0]:
+                hdr = line.strip()[1:].split(',')
+                if not hdr[0] in idx['headers']:
+                    idx['headers'][hdr[0]] = hdr[1:]
+
+        colsByCategory = {}
+        for line in lines:
+            line = line.strip()
+            if len(line) <=0 or '!' == line[0]: continue
+
+            cols = line.split(',')
+            category = cols[0]
+            if not category in colsByCategory :
+                colsByCategory[category] = TcsvFilter.columnsOf(idx['headers'].get(category, []))
+            idxSymbol, idxStamps = colsByCategory[category]
+            symbol = cols[1+idxSymbol] if idxSymbol >=0 and 1+idxSymbol < len(cols) else ''
+            stamp = TcsvFilter.stampOf(cols[1:], idxStamps)
+
+            entries = idx['entries'].setdefault(category, {}).setdefault(symbol, [])
+            if len(entries) >0 and entries[-1][2] == offset:
+                entries[-1][0] = min(entries[-1][0], stamp)
+                entries[-1][1] = max(entries[-1][1], stamp)
+            else:
+                entries.append([stamp, stamp, offset, length])
+
+        return length
+
+    def loadIndex(fn) :
+        '''
+        @return the index of a rotated file, None if not available or not matching the file
+        '''
+        try :
+            with open(fn + TcsvFilter.INDEX_SUFFIX, 'r') as f:
+                idx = json.load(f)
+            if idx['size'] == os.path.getsize(fn):
+                return idx
+        except Exception:
+            pass
+        return None
+
+    def readBlock(fn, offset, length) :
+        '''
+        @return the lines of a compressed block
+        '''
+        with open(fn, 'rb') as f:
+            f.seek(offset)
+            return bz2.decompress(f.read(length)).decode().splitlines()
+
+    def selectBlocks(idx, category, symbol=None, startTime=None, endTime=None) :
+        '''
+        @return the sorted list of (offset, length) of the blocks that may contain the rows wished
+        '''
+        bySymbol = idx['entries'].get(category, {})
+        if symbol and 'symbol' in idx['headers'].get(category, []):
+            candidates = bySymbol.get(symbol, [])
+        else :
+            candidates = [e for l in bySymbol.values() for e in l]
+
+        blocks = set()
+        for first, last, offset, length in candidates:
+            if startTime and len(last) >0 and last < startTime: continue
+            if endTime and len(first) >0 and first > endTime: continue
+            blocks.add((offset, length))
+
+        return sorted(blocks)
+
+    def filterLines(lines, tag, idxSymbol, symbol, idxStamps, startTime, endTime) :
+        '''
+        the generator of the rows of a category, with the tag stripped
+        '''
+        taglen = len(tag)
+        for row in lines:
+            row = row.strip()
+            if len(row) <=0 or tag != row[:taglen]:
+                continue
+
+            if idxSymbol>=0 or (idxStamps and (startTime or endTime)):
+                cols = row.split(',')
+                if idxSymbol>=0 and cols[1+idxSymbol] !=symbol:
+                    continue
+                if idxStamps and (startTime or endTime):
+                    stamp = TcsvFilter.stampOf(cols[1:], idxStamps)
+                    if (startTime and stamp < startTime) or (endTime and stamp > endTime):
+                        continue
+
+            yield row[taglen:] +'\n'
+
+    def funcGen(fnlist, tag, symbol=None, startTime=None, endTime=None, processes=0):
         headers = None
+        category = tag.strip(',')
         if ',' != tag[-1]: tag +=','
         taglen = len(tag)
-        idxSymbol =-1
+        idxSymbol, idxStamps =-1, []
         if symbol and len(symbol) <=0:
-            self.__symbol =None
+            symbol =None
 
+        pool = None
         for fn in fnlist:
+            idx = TcsvFilter.loadIndex(fn) if fn[-4:] == '.bz2' else None
+            if idx :
+                if not headers and category in idx['headers']:
+                    headers = idx['headers'][category]
+                    yield ','.join(headers) +'\n'
+                    idxSymbol, idxStamps = TcsvFilter.columnsOf(headers)
+                    if not symbol: idxSymbol =-1
+                if not headers:
+                    continue
+
+                matcher = (tag, idxSymbol, symbol, idxStamps, startTime, endTime)
+                blocks = TcsvFilter.selectBlocks(idx, category, symbol, startTime, endTime)
+                if processes and processes >1 and len(blocks) >1:
+                    if not pool:
+                        import multiprocessing
+                        pool = multiprocessing.Pool(processes=processes)
+                    for rows in pool.imap(_filterTcsvBlock, [(fn, offset, length, matcher) for offset, length in blocks]):
+                        for row in rows: yield row
+                    continue
+
+                for offset, length in blocks:
+                    for row in TcsvFilter.filterLines(TcsvFilter.readBlock(fn, offset, length), *matcher):
+                        yield row
+                continue
+
+            # no index available, scan through the file
             if fn[-4:] == '.bz2':
                 stream = bz2.open(fn, mode='rt')
             elif fn[-5:] == '.tcsv':
@@ -409,21 +799,19 @@ class TcsvFilter(MetaObj):
                     del(headers[0])
                     yield row[taglen+1:]+'\n'
 
-                    if idxSymbol<0 and symbol and 'symbol' in headers:
-                        idxSymbol = headers.index('symbol')
-
+                    idxSymbol, idxStamps = TcsvFilter.columnsOf(headers)
+                    if not symbol: idxSymbol =-1
                     continue
                 
                 if not headers or tag != row[:taglen]:
                     continue
 
-                if idxSymbol>=0 and row.split(',')[1+idxSymbol] !=symbol:
-                    continue
-
-                row = row[taglen:] +'\n'
-                yield row
+                for line in TcsvFilter.filterLines([row], tag, idxSymbol, symbol, idxStamps, startTime, endTime):
+                    yield line
 
-        raise StopIteration
+        if pool:
+            pool.close()
+            pool.join()
 
 ########################################################################
 class Playback(Iterable):
@@ -448,12 +836,19 @@ class Playback(Iterable):
         self._startDate = startDate if startDate else Playback.DUMMY_DATE_START
         self._endDate   = endDate if endDate else Playback.DUMMY_DATE_END
 
+        self._merger1minTo5min = None
+        self._merger5minTo1Day = None
+        self._dtEndOfDay = None
+
     # -- impl of Iterable --------------------------------------------------------------
     @abstractmethod
     def resetRead(self):
         """For this generator, we want to rewind only when the end of the data is reached.
         """
         self.__lastMarketClk = None
+        self._merger1minTo5min = KlineToXminMerger(self._cbMergedKLine5min, xmin=5)
+        self._merger5minTo1Day = KlineToXminMerger(self._cbMergedKLine1Day, xmin=60*24-10)
+        self._dtEndOfDay = None
 
     @abstractmethod
     def readNext(self):
@@ -484,6 +879,50 @@ class Playback(Iterable):
         self.enquePending(evMH)
         return evdMH
 
+    def _cbMergedKLine5min(self, klinedata):
+        if not klinedata: return
+        ev = Event(EVENT_KLINE_5MIN)
+        ev.setData(klinedata)
+        self.enquePending(ev)
+        asofDay = klinedata.asof.replace(hour=23, minute=59, second=59)
+        if self._merger5minTo1Day :
+            self._merger5minTo1Day.pushKLineData(klinedata, asofDay)
+
+    def _cbMergedKLine1Day(self, klinedata):
+        if not klinedata: return
+        ev = Event(EVENT_KLINE_1DAY)
+        # klinedata.datetime = klinedata.datetime.replace(hour=23, minute=59, second=59)
+        ev.setData(klinedata)
+        self.enquePending(ev)
+
+    def _mergeKLine1min(self, ev):
+        '''
+        generate the market-hour event and merge the 1min KLine into 5min and 1day ones
+        @return the event to deliver, which might be one of the pendings generated previously
+        '''
+        evdMH = self._testAndGenerateMarketHourEvent(ev)
+        if  self._merger1minTo5min :
+            self._merger1minTo5min.pushKLineEvent(ev)
+
+        if evdMH :
+            if self._dtEndOfDay and self._dtEndOfDay < evdMH.asof :
+                if  self._merger1minTo5min :
+                    self._merger1minTo5min.flush()
+                if  self._merger5minTo1Day :
+                    self._merger5minTo1Day.flush()
+                self._dtEndOfDay = None
+
+            if not self._dtEndOfDay :
+                self._dtEndOfDay = evdMH.asof.replace(hour=23,minute=59,second=59)
+
+        # because the generated is always as of the previous event, so always deliver those pendings in queue first
+        if self.pendingSize >0 :
+            evout = self.popPending()
+            self.enquePending(ev)
+            return evout
+
+        return ev
+
 ########################################################################
 class PlaybackApp(BaseApplication):
     
@@ -542,39 +981,16 @@ class CsvPlayback(Playback):
         self._csvfiles =[]
         self._cvsToEvent = DictToKLine(self._category, symbol)
 
-        self._merger1minTo5min = None
-        self._merger5minTo1Day = None
-        self._dtEndOfDay = None
-
 #        if not self._fields and 'mdKL' in self._category:
 #            self._fields ='' #TODO
         self._fieldnames = self._fields.split(',') if self._fields else None
 
-    def _cbMergedKLine5min(self, klinedata):
-        if not klinedata: return
-        ev = Event(EVENT_KLINE_5MIN)
-        ev.setData(klinedata)
-        self.enquePending(ev)
-        asofDay = klinedata.asof.replace(hour=23, minute=59, second=59)
-        if self._merger5minTo1Day :
-            self._merger5minTo1Day.pushKLineData(klinedata, asofDay)
-
-    def _cbMergedKLine1Day(self, klinedata):
-        if not klinedata: return
-        ev = Event(EVENT_KLINE_1DAY)
-        # klinedata.datetime = klinedata.datetime.replace(hour=23, minute=59, second=59)
-        ev.setData(klinedata)
-        self.enquePending(ev)
-
     # -- Impl of Playback --------------------------------------------------------------
     def resetRead(self):
         super(CsvPlayback, self).resetRead()
 
         self._csvfiles =[]
         self._reader =None
-        self._merger1minTo5min = KlineToXminMerger(self._cbMergedKLine5min, xmin=5)
-        self._merger5minTo1Day = KlineToXminMerger(self._cbMergedKLine1Day, xmin=60*24-10)
-        self._dtEndOfDay = None
 
         # filter the csv files
         self.debug('search dir %s for csv files' % self._folder)
@@ -671,32 +1087,429 @@ class CsvPlayback(Playback):
                 # print('line: %s' % (line))
                 ev = self._cvsToEvent.convert(row, self._exchange, self._symbol)
                 if ev:
-                    evdMH = self._testAndGenerateMarketHourEvent(ev)
-                    if  self._merger1minTo5min :
-                        self._merger1minTo5min.pushKLineEvent(ev)
-
-                    if evdMH :
-                        if self._dtEndOfDay and self._dtEndOfDay < evdMH.asof :
-                            if  self._merger1minTo5min :
-                                self._merger1minTo5min.flush()
-                            if  self._merger5minTo1Day :
-                                self._merger5minTo1Day.flush()
-                            self._dtEndOfDay = None
-
-                        if not self._dtEndOfDay :
-                            self._dtEndOfDay = evdMH.asof.replace(hour=23,minute=59,second=59)
-
-                    # because the generated is always as of the previous event, so always deliver those pendings in queue first
-                    if self.pendingSize >0 :
-                        evout = self.popPending()
-                        self.enquePending(ev)
-                        return evout
+                    return self._mergeKLine1min(ev)
 
         except Exception as ex:
             self.logexception(ex)
 
         return ev
 
+########################################################################
+class ColumnarPlayback(Playback):
+    '''
+    The playback of 1min KLines from the columnar store, where each day of a symbol is a numpy
+    file <folder>/<symbol>/<YYYYMMDD>.npy of the record type DTYPE, taken by memory-map.
+    The store can be built from the csv/bz2 files by csvToColumnar()
+    '''
+    COLUMNS = 'stamp,open,high,low,close,volume,amount' # stamp is the datetime2float() of the KLine
+    DTYPE   = np.dtype([(c, '<f8') for c in COLUMNS.split(',')])
+
+    #----------------------------------------------------------------------
+    def __init__(self, symbol, folder, category =None, startDate =Playback.DUMMY_DATE_START, endDate=Playback.DUMMY_DATE_END, **kwargs) :
+
+        super(ColumnarPlayback, self).__init__(symbol, startDate, endDate, category, **kwargs)
+        self._folder = folder
+        self._days = []
+        self._block = None
+        self._idxRow, self._endRow = 0, 0
+
+        self._fstampStart = ColumnarPlayback.__toFstamp(self._startDate)
+        self._fstampEnd   = ColumnarPlayback.__toFstamp(self._endDate, endOfDay=True)
+
+    def __toFstamp(stampstr, endOfDay=False):
+        try :
+            return datetime2float(datetime.strptime(stampstr, '%Y%m%dT%H%M%S'))
+        except ValueError:
+            pass
+
+        for fmt in ['%Y%m%d', '%Y-%m-%d']: # a date only covers the whole day
+            try :
+                dt = datetime.strptime(stampstr, fmt)
+                return datetime2float(dt.replace(hour=23, minute=59, second=59) if endOfDay else dt)
+            except ValueError:
+                pass
+        raise ValueError('ColumnarPlayback unknown date[%s]' % stampstr)
+
+    def dayFilename(folder, symbol, day):
+        return os.path.join(folder, symbol, '%s.npy' % day)
+
+    # -- Impl of Playback --------------------------------------------------------------
+    def resetRead(self):
+        super(ColumnarPlayback, self).resetRead()
+
+        self._block = None
+        self._idxRow, self._endRow = 0, 0
+        self._days = []
+
+        dirSymbol = os.path.join(self._folder, self._symbol)
+        try :
+            days = [fn[:-4] for fn in os.listdir(dirSymbol) if '.npy' == fn[-4:]]
+        except Exception as ex:
+            self.error('failed to list %s: %s' % (dirSymbol, ex))
+            return False
+
+        # seek the date range by binary search on the sorted day list
+        days.sort()
+        dayStart = (DT_EPOCH + timedelta(seconds=self._fstampStart)).strftime('%Y%m%d')
+        dayEnd   = (DT_EPOCH + timedelta(seconds=self._fstampEnd)).strftime('%Y%m%d')
+        self._days = days[bisect.bisect_left(days, dayStart) : bisect.bisect_right(days, dayEnd)]
+
+        self.info('associated %d days in %s: %s~%s' % (len(self._days), dirSymbol, self._days[0] if len(self._days) >0 else '', self._days[-1] if len(self._days) >0 else ''))
+        return len(self._days) >0
+
+    def readNext(self):
+        try :
+            ev = self.popPending(block = False, timeout = 0.1)
+            if ev: return ev
+        except Exception:
+            pass
+
+        while self._idxRow >= self._endRow:
+            if len(self._days) <=0:
+                self._block = None
+                self._iterableEnd = True
+                return None
+
+            fn = ColumnarPlayback.dayFilename(self._folder, self._symbol, self._days[0])
+            del(self._days[0])
+            try :
+                self._block = np.load(fn, mmap_mode='r')
+            except Exception as ex:
+                self.error('failed to load %s: %s' % (fn, ex))
+                continue
+
+            stamps = self._block['stamp']
+            self._idxRow = int(np.searchsorted(stamps, self._fstampStart, side='left'))
+            self._endRow = int(np.searchsorted(stamps, self._fstampEnd, side='right'))
+            self.debug('loaded %s, rows[%d:%d]' % (fn, self._idxRow, self._endRow))
+
+        row = self._block[self._idxRow]
+        self._idxRow +=1
+
+        kl = KLineData(self._exchange, self._symbol)
+        kl.open, kl.high, kl.low, kl.close, kl.volume = float(row['open']), float(row['high']), float(row['low']), float(row['close']), float(row['volume'])
+        kl.datetime = DT_EPOCH + timedelta(seconds=round(float(row['stamp'])))
+        kl.date = kl.datetime.strftime('%Y-%m-%d')
+        kl.time = kl.datetime.strftime('%H:%M:%S')
+
+        ev = Event(self._category)
+        ev.setData(kl)
+        return self._mergeKLine1min(ev)
+
+########################################################################
+class PreloadedPlayback(Playback):
+    '''
+    The playback of the events that were read from another playback into memory once by preload(), so that
+    the forked processes, such as the workers of an optimization, share the history without reading and merging it again
+    '''
+    #----------------------------------------------------------------------
+    def __init__(self, playback, **kwargs) :
+
+        super(PreloadedPlayback, self).__init__(playback._symbol, playback._startDate, playback._endDate, playback._category, playback._exchange, **kwargs)
+        self._source = playback
+        self._events = None
+        self._idxRead = 0
+
+    def preload(self):
+        '''
+        @return the number of the events preloaded
+        '''
+        if self._events is not None:
+            return len(self._events)
+
+        self._events = []
+        if self._source.resetRead() :
+            while not self._source._iterableEnd:
+                try :
+                    ev = self._source.readNext()
+                except StopIteration:
+                    break
+                if ev: self._events.append(ev)
+
+        self.info('preloaded %d events of symbol[%s]' % (len(self._events), self._symbol))
+        return len(self._events)
+
+    # -- Impl of Playback --------------------------------------------------------------
+    def resetRead(self):
+        self.preload()
+        self._idxRead = 0
+        self._iterableEnd = False
+        return len(self._events) >0
+
+    def readNext(self):
+        if self._idxRead >= len(self._events):
+            self._iterableEnd = True
+            return None
+
+        ev = self._events[self._idxRead]
+        self._idxRead +=1
+        return ev
+
+########################################################################
+class CompactEventStream(object):
+    '''
+    The decoded event stream of a playback recorded compactly as the rows of DTYPE, where the repeating strings,
+    such as event type, exchange, date and time, are interned into small tables
+    '''
+    DTYPE = np.dtype([('meta', '<i4'), ('date', '<i4'), ('time', '<i4'), ('usec', '<i8')] + [(c, '<f8') for c in 'open,high,low,close,volume,openInterest'.split(',')])
+    USEC_NONE = -(1<<63) # the datetime of None
+
+    #----------------------------------------------------------------------
+    def __init__(self) :
+        self._metas, self._dictMetas = [], {} # (evType, dataClass, exchange, symbol, vtSymbol)
+        self._strs,  self._dictStrs  = [], {}
+        self._rows  = [] # the rows being recorded, becomes _block after seal()
+        self._block = None
+        self._extras = {} # rowNo -> (evType, data) for the data of other than MarketData and KLineData
+
+    def __len__(self) :
+        return len(self._block) if self._block is not None else len(self._rows)
+
+    @property
+    def nbytes(self) :
+        nbytes = self._block.nbytes if self._block is not None else len(self._rows) * CompactEventStream.DTYPE.itemsize
+        return nbytes + sum([len(s) +50 for s in self._strs]) + 200 *(len(self._metas) + len(self._extras))
+
+    def __intern(self, table, dictIdx, item) :
+        if not item in dictIdx :
+            dictIdx[item] = len(table)
+            table.append(item)
+        return dictIdx[item]
+
+    def append(self, ev) :
+        d = ev.data
+        if not type(d) in [MarketData, KLineData] :
+            self._extras[len(self._rows)] = (ev.type, copy.copy(d))
+            self._rows.append((-1, -1, -1, 0) + (0.0,) *6)
+            return
+
+        meta = self.__intern(self._metas, self._dictMetas, (ev.type, type(d), d.exchange, d.symbol, d.vtSymbol))
+        usec = round((d.datetime - DT_EPOCH).total_seconds() *1000000) if d.datetime else CompactEventStream.USEC_NONE
+        ohlc = (d.open, d.high, d.low, d.close, d.volume, d.openInterest) if isinstance(d, KLineData) else (0.0,) *6
+        self._rows.append((meta, self.__intern(self._strs, self._dictStrs, d.date), self.__intern(self._strs, self._dictStrs, d.time), usec) + ohlc)
+
+    def seal(self) :
+        '''
+        convert the recorded rows into the compact block
+        '''
+        if self._block is None :
+            self._block = np.array(self._rows, dtype=CompactEventStream.DTYPE)
+            self._rows = None
+            self._dictMetas, self._dictStrs = None, None
+        return self
+
+    def event(self, idx) :
+        '''
+        @return a new Event rebuilt from the row idx
+        '''
+        if idx in self._extras :
+            evType, d = self._extras[idx]
+            d = copy.copy(d)
+        else :
+            meta, date, time, usec, o, h, l, c, v, oi = self._block[idx].item() # item() takes the python scalars in one call
+            evType, dataClass, exchange, symbol, vtSymbol = self._metas[meta]
+            d = dataClass(exchange, symbol)
+            d.vtSymbol, d.date, d.time = vtSymbol, self._strs[date], self._strs[time]
+            d.datetime = None if CompactEventStream.USEC_NONE == usec else DT_EPOCH + timedelta(microseconds=usec)
+            if KLineData == dataClass :
+                d.open, d.high, d.low, d.close, d.volume, d.openInterest = o, h, l, c, v, oi
+
+        ev = Event(evType)
+        ev.setData(d)
+        return ev
+
+########################################################################
+class EventCache(object):
+    '''
+    The LRU cache of the CompactEventStreams recorded by CachedPlayback, shared by the playbacks in the process
+    and bounded by the memory capacity across all the symbols
+    '''
+    #----------------------------------------------------------------------
+    def __init__(self, capMB=512) :
+        self._capBytes = int(capMB *1024*1024)
+        self._streams = OrderedDict() # key -> CompactEventStream, the least recently used first
+        self._bytes = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self) : return len(self._streams)
+
+    @property
+    def sizeMB(self) : return round(self._bytes /1024.0 /1024, 3)
+
+    def setCapacity(self, capMB) :
+        with self.__lock :
+            self._capBytes = int(capMB *1024*1024)
+            self.__evict()
+
+    def get(self, key) :
+        '''
+        @return the cached CompactEventStream, None if not cached
+        '''
+        with self.__lock :
+            stream = self._streams.get(key, None)
+            if stream is not None :
+                self._streams.move_to_end(key)
+            return stream
+
+    def put(self, key, stream) :
+        '''
+        @return True if the stream is cached, False if it exceeds the capacity alone
+        '''
+        nbytes = stream.nbytes
+        with self.__lock :
+            if key in self._streams :
+                self._bytes -= self._streams.pop(key).nbytes
+            if nbytes > self._capBytes :
+                return False
+
+            self._streams[key] = stream
+            self._bytes += nbytes
+            self.__evict()
+        return True
+
+    def __evict(self) :
+        while self._bytes > self._capBytes and len(self._streams) >0:
+            _, stream = self._streams.popitem(last=False)
+            self._bytes -= stream.nbytes
+
+EVENT_CACHE = EventCache() # the default cache of the process
+
+########################################################################
+class CachedPlayback(Playback):
+    '''
+    The playback that records the decoded event stream of another playback during its first pass, then replays
+    the later passes, such as the episodes of BackTestApp, from the EventCache at memory speed
+    '''
+    #----------------------------------------------------------------------
+    def __init__(self, playback, cache=None, **kwargs) :
+
+        super(CachedPlayback, self).__init__(playback._symbol, playback._startDate, playback._endDate, playback._category, playback._exchange, **kwargs)
+        self._source = playback
+        self._cache = cache if cache is not None else EVENT_CACHE
+        self._key = '%s:%s/%s@%s~%s' % (playback.__class__.__name__, getattr(playback, '_folder', ''), self._symbol, self._startDate, self._endDate)
+        self._stream = None    # the cached stream to replay
+        self._recording = None # the stream being recorded from the source
+        self._idxRead = 0
+
+    def __finishRecording(self, drain=False) :
+        '''
+        @param drain - True to read the rest of the source, in the case the pass quit before the end of the playback
+        '''
+        stream, self._recording = self._recording, None
+        while drain and not self._source._iterableEnd:
+            try :
+                ev = self._source.readNext()
+            except StopIteration:
+                break
+            if ev: stream.append(ev)
+
+        cached = self._cache.put(self._key, stream.seal())
+        self.info('recorded %d events of %s, %sKB, cached[%s] %d streams %sMB' % (len(stream), self._key, int(stream.nbytes /1024), cached, len(self._cache), self._cache.sizeMB))
+
+    # -- Impl of Playback --------------------------------------------------------------
+    def resetRead(self):
+        if self._recording is not None:
+            self.__finishRecording(drain=True)
+
+        self._idxRead = 0
+        self._iterableEnd = False
+        self._stream = self._cache.get(self._key)
+        if self._stream is not None:
+            return len(self._stream) >0
+
+        self._recording = CompactEventStream()
+        self._source._iterableEnd = False
+        return self._source.resetRead()
+
+    def readNext(self):
+        if self._stream is not None:
+            if self._idxRead >= len(self._stream):
+                self._iterableEnd = True
+                return None
+
+            self._idxRead +=1
+            return self._stream.event(self._idxRead -1)
+
+        if self._recording is None:
+            self._iterableEnd = True
+            return None
+
+        try :
+            ev = self._source.readNext()
+        except StopIteration:
+            ev = None
+            self._source._iterableEnd = True
+
+        if ev: self._recording.append(ev)
+        if self._source._iterableEnd:
+            self.__finishRecording()
+            self._iterableEnd = True
+
+        return ev
+
+def _saveColumnarDay(folder, symbol, day, rows, merge=False) :
+    '''
+    save the rows of a day into the file of ColumnarPlayback, sorted by stamp where the later row wins on duplicated stamps
+    @param merge True to merge the rows into the file already written, such as the day split across two csv files
+    '''
+    block = np.array(rows, dtype=ColumnarPlayback.DTYPE)
+    fn = ColumnarPlayback.dayFilename(folder, symbol, day)
+    if merge :
+        block = np.concatenate([np.load(fn), block])
+
+    block.sort(order='stamp', kind='stable')
+    _, idxUnique = np.unique(block['stamp'][::-1], return_index=True)
+    block = block[len(block) -1 - idxUnique]
+
+    with open(fn + '.tmp', 'wb') as f:
+        np.save(f, block)
+    os.replace(fn + '.tmp', fn)
+
+def csvToColumnar(symbol, csvFolder, columnarFolder, fields='date,time,open,high,low,close,volume,ammount', program=None) :
+    '''
+    convert the csv/bz2 files of a symbol, which are taken by CsvPlayback, into the store of ColumnarPlayback.
+    the rows are parsed by the same converter as CsvPlayback, and each day is saved once its rows end, so that
+    no more than a day is kept in memory
+    @return the number of days written
+    '''
+    csvpb = CsvPlayback(symbol=symbol, folder=csvFolder, fields=fields, program=program)
+    if not csvpb.resetRead():
+        return 0
+
+    dirSymbol = os.path.join(columnarFolder, symbol)
+    try :
+        os.makedirs(dirSymbol)
+    except:
+        pass
+
+    daysWritten = set()
+    day, rows = None, []
+    for fn in csvpb._csvfiles:
+        csvpb.info('converting %s' % fn)
+        with (bz2.open(fn, mode='rt') if 'bz2' == fn.split('.')[-1] else open(fn, 'rt')) as stream:
+            for row in csv.DictReader(stream, csvpb._fieldnames, lineterminator='\n'):
+                try :
+                    kl = csvpb._cvsToEvent.convert(row, csvpb._exchange, symbol).data
+                    amount = float(row['ammount']) if 'ammount' in row and row['ammount'] else 0.0
+                    rec = (datetime2float(kl.datetime), kl.open, kl.high, kl.low, kl.close, kl.volume, amount)
+                except Exception:
+                    continue # such as the header line
+
+                dayOfRow = kl.datetime.strftime('%Y%m%d')
+                if dayOfRow != day :
+                    if len(rows) >0:
+                        _saveColumnarDay(columnarFolder, symbol, day, rows, day in daysWritten)
+                        daysWritten.add(day)
+                    day, rows = dayOfRow, []
+                rows.append(rec)
+
+    if len(rows) >0:
+        _saveColumnarDay(columnarFolder, symbol, day, rows, day in daysWritten)
+        daysWritten.add(day)
+
+    csvpb.info('converted %d days of %s into %s' % (len(daysWritten), symbol, dirSymbol))
+    return len(daysWritten)
+
 ########################################################################
 class MongoRecorder(Recorder):
     """数据记录引擎
@@ -860,55 +1673,515 @@ class MarketRecorder(BaseApplication):
         self._recorder.pushRow(category, row)
 
 ########################################################################
-import bz2
+import bz2, gzip, lzma
+import multiprocessing
+
+ARCHIVE_CODECS = {
+    # codec: (suffix, compress(data, level)), each compressed block is an independent stream/member, so that
+    # the concatenated blocks can still be read by bz2.open(), gzip.open() and lzma.open()
+    'bz2'  : ('.bz2', lambda data, level: bz2.compress(data, level)),
+    'gzip' : ('.gz',  lambda data, level: gzip.compress(data, level)),
+    'lzma' : ('.xz',  lambda data, level: lzma.compress(data, preset=level)),
+}
+
+def _compressBlock(task) :
+    '''
+    the worker of Zipper's process pool
+    @return the compressed block
+    '''
+    codec, level, data = task
+    return ARCHIVE_CODECS[codec][1](data, level)
 
 class Zipper(BaseApplication):
-    """数据记录引擎"""
-    def __init__(self, program, settings):
-        super(Zipper, self).__init__(program, settings)
+    '''
+    The archiver compresses the files posted by EVENT_TOARCHIVE, each file is cut into blocks that are compressed
+    in parallel by a pool of processes
+    configuration:
+        "zipper": {
+            "codec" : "bz2",     // bz2, gzip or lzma
+            "level" : 9,
+            "blockKB" : 4096,
+            "processes" : 0,     // 0 for the cpu count
+            "maxBacklog" : 200,  // the files posted beyond this are deferred, the poster will post them again at its next roll
+        }
+    '''
+    def __init__(self, program, **kwargs):
+        super(Zipper, self).__init__(program, **kwargs)
         self._threadWished = True  # this App must be Threaded
 
+        self._codec      = self.getConfig('codec', 'bz2')
+        if not self._codec in ARCHIVE_CODECS.keys():
+            self._codec = 'bz2'
+        self._level      = int(self.getConfig('level', 9))
+        self._blockKB    = int(self.getConfig('blockKB', 4096))
+        self._processes  = int(self.getConfig('processes', 0))
+        if self._processes <=0:
+            self._processes = multiprocessing.cpu_count()
+        self._maxBacklog = int(self.getConfig('maxBacklog', 200))
+
         self._queue = Queue()                    # 队列
-        self.subscribeEvent(EVENT_TOARCHIVE, self.onToArchive)
+        self.__pending = set() # the files either in the queue or being compressed, to dedup the repeated posts
+        self.__lock = threading.Lock()
+        self.__pool = None
+        self.__stats = {'files':0, 'bytesIn':0, 'bytesOut':0, 'seconds':0.0, 'deferred':0}
+
+    @property
+    def backlog(self) : return len(self.__pending)
+
+    @property
+    def stats(self) : return copy.copy(self.__stats)
 
     # impl of BaseApplication
     #----------------------------------------------------------------------
+    def doAppInit(self): # return True if succ
+        if not super(Zipper, self).doAppInit() :
+            return False
+
+        self.subscribeEvents([EVENT_TOARCHIVE])
+        return True
+
+    def stop(self):
+        super(Zipper, self).stop()
+        if self.__pool :
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def OnEvent(self, event):
+        if EVENT_TOARCHIVE == event.type:
+            self._push(event.data.filename if isinstance(event.data, ArchiveData) else event.data)
+
     def doAppStep(self):
         cStep =0
         while self.isActive:
             try:
                 fn = self._queue.get(block=True, timeout=0.2)
-                f = file(fn, 'rb')
-                ofn = fn + '.bz2'
-                try :
-                    os.stat(ofn)
-                    continue # output file exists, skip
-                except:
-                    pass
-
-                self.debug('zipping: %s to %s' % (fn, ofn))
-                everGood = False
-                with f:
-                    with bz2.BZ2File(ofn, 'w') as z:
-                        while True:
-                            data = None
-                            data = f.read(1024000)
-                            if data != None :
-                                everGood = True
-                            if len(data) <=0 : break
-                            z.write(data)
-
-                if everGood: os.remove(fn)
-                cStep +=1
-            except: # Empty:
+            except Empty:
                 break
 
-        return False # this doesn't matter as this is threaded
+            try :
+                if self.archive(fn) :
+                    cStep +=1
+            except Exception as ex:
+                self.logexception(ex)
+
+            with self.__lock:
+                self.__pending.discard(fn)
 
-    def onToArchive(self, event) :
-        self._push(event.data)
+        return cStep >0
 
     def _push(self, filename) :
+        with self.__lock:
+            if filename in self.__pending:
+                return
+            if len(self.__pending) >= self._maxBacklog:
+                self.__stats['deferred'] +=1
+                self.warn('backlog %d reached, deferred archiving %s' % (len(self.__pending), filename))
+                return
+            self.__pending.add(filename)
+
         self._queue.put(filename)
 
+    def archive(self, fn) :
+        '''
+        compress fn into fn.<suffix> block by block, then remove fn
+        @return True if archived
+        '''
+        suffix, _ = ARCHIVE_CODECS[self._codec]
+        ofn = fn + suffix
+        if os.path.exists(ofn) or not os.path.exists(fn):
+            return False # output file exists, skip
+
+        if not self.__pool and self._processes >1:
+            self.__pool = multiprocessing.Pool(processes=self._processes)
+
+        self.debug('zipping: %s to %s' % (fn, ofn))
+        stampStart = datetime.now()
+        bytesIn, bytesOut = 0, 0
+        tmpfn = ofn + '.tmp'
+        with open(fn, 'rb') as f, open(tmpfn, 'wb') as z:
+            while True:
+                # read only a window of blocks at a time, so that the memory is bound to processes*2 blocks for huge files
+                tasks = []
+                while len(tasks) < self._processes *2:
+                    data = f.read(self._blockKB *1024)
+                    if len(data) <=0 : break
+                    tasks.append((self._codec, self._level, data))
+                    bytesIn += len(data)
+
+                if len(tasks) <=0 : break
+
+                compressed = self.__pool.map(_compressBlock, tasks) if self.__pool else [_compressBlock(t) for t in tasks]
+                for c in compressed:
+                    z.write(c)
+                    bytesOut += len(c)
+
+        os.rename(tmpfn, ofn)
+        os.remove(fn)
+
+        elapsed = (datetime.now() - stampStart).total_seconds()
+        self.__stats['files'] +=1
+        self.__stats['bytesIn'] += bytesIn
+        self.__stats['bytesOut'] += bytesOut
+        self.__stats['seconds'] += elapsed
+        self.info('zipped %s to %s: %sKB->%sKB took %.2fs, %.1fMB/s, backlog %d' % (fn, ofn, bytesIn//1024, bytesOut//1024, elapsed, bytesIn/1024/1024/max(elapsed, 0.001), len(self.__pending)))
+        return True
 
+
+
+########################################################################
+class ReplayFrameReader(object):
+    '''
+    The reader of the ReplayFrames in H5 files, which reads the datasets directly into contiguous arrays that are
+    reused across frames, instead of converting them into lists of rows
+        reader = ReplayFrameReader()
+        frameDict = reader.read('RFrm_SH510050.h5', 'ReplayFrame:RF001')
+        selected = ReplayFrameReader.balanceMask(frameDict['action'])
+        batches = ReplayFrameReader.toBatches(frameDict, 128, selected)
+    the arrays returned by read() are views of the buffers that will be overwritten by the next read(), so the
+    caller should take copies, such as the batches made by toBatches()
+    '''
+    def __init__(self, cols=['state','action'], dtype='float32'):
+        self._cols = cols
+        self._dtype = np.dtype(dtype)
+        self.__buffers = {} # col -> preallocated ndarray
+
+    def read(self, h5fileName, frameName):
+        '''
+        @return dict of {col: ndarray} of the frame
+        '''
+        frameDict ={}
+        with h5py.File(h5fileName, 'r') as h5f:
+            frame = h5f[frameName]
+            for col in self._cols :
+                ds = frame[col]
+                buf = self.__buffers.get(col, None)
+                if buf is None or buf.shape[0] < ds.shape[0] or buf.shape[1:] != ds.shape[1:]:
+                    buf = np.empty(ds.shape, dtype=self._dtype)
+                    self.__buffers[col] = buf
+
+                view = buf[:ds.shape[0]]
+                if ds.shape[0] >0:
+                    ds.read_direct(view)
+                frameDict[col] = view
+
+        return frameDict
+
+    def balanceMask(action, maxRatio=1.6) :
+        '''
+        reduce the dominant action, usually HOLD, to at most maxRatio times of the others
+        @return the boolean mask of the rows to keep
+        '''
+        mask = np.ones(len(action), dtype=bool)
+        if len(action) <=0:
+            return mask
+
+        actIdx = np.argmax(action, axis=1)
+        hot = action[np.arange(len(action)), actIdx] >=0.99 # to match 1 because action is float read from RFrames
+        kI = np.bincount(actIdx[hot], minlength=action.shape[1])
+        idxMax = int(np.argmax(kI))
+        cToReduce = int(kI[idxMax] - int(maxRatio *(kI.sum() -kI[idxMax])))
+        if cToReduce >0:
+            idxItems = np.flatnonzero(hot & (actIdx == idxMax))
+            mask[np.random.choice(idxItems, cToReduce, replace=False)] = False
+
+        return mask
+
+    def toBatches(frameDict, batchSize, mask=None, permutation=None) :
+        '''
+        shuffle the rows selected by mask within the frame, and cut them into batches by fancy-indexing
+        @return list of {col: ndarray[batchSize, ...]}, the rows that could not make a full batch are dropped
+        '''
+        framelen = min([len(v) for v in frameDict.values()])
+        if permutation is None:
+            permutation = np.flatnonzero(mask) if mask is not None else np.arange(framelen)
+            permutation = np.random.permutation(permutation)
+
+        bths = []
+        for i in range(len(permutation) // batchSize):
+            rows = permutation[batchSize*i: batchSize*(i+1)]
+            bths.append({ col: v[rows] for col, v in frameDict.items() })
+
+        return bths
+
+########################################################################
+def _readAheadWorker(taskQ, freeQ, readyQ, shmNames, dims, slots, batchSize, dtype, balance) :
+    '''
+    the worker process of ReplayFrameReadAhead, which reads the frames from taskQ, and writes each batch into a free
+    slot of the shared memory then notifies readyQ with (slot, frameTag)
+    '''
+    from multiprocessing import shared_memory
+    shms = { col: shared_memory.SharedMemory(name=shmNames[col]) for col in dims.keys() }
+    arrays = { col: np.ndarray((slots, batchSize, dim), dtype=dtype, buffer=shms[col].buf) for col, dim in dims.items() }
+    reader = ReplayFrameReader(cols=list(dims.keys()), dtype=dtype)
+
+    while True:
+        task = taskQ.get()
+        if task is None: break
+
+        h5fileName, frameName = task
+        frameTag = '%s@%s' % (frameName, os.path.basename(h5fileName))
+        lenFrame, cBths, err = 0, 0, None
+        try :
+            frameDict = reader.read(h5fileName, frameName)
+            lenFrame = len(frameDict[list(dims.keys())[0]])
+            mask = ReplayFrameReader.balanceMask(frameDict['action']) if balance and 'action' in frameDict.keys() else None
+            permutation = np.random.permutation(np.flatnonzero(mask) if mask is not None else lenFrame)
+            for i in range(len(permutation) // batchSize):
+                rows = permutation[batchSize*i: batchSize*(i+1)]
+                slot = freeQ.get() # blocks here if the trainer is slower than the readers
+                for col in dims.keys():
+                    np.take(frameDict[col], rows, axis=0, out=arrays[col][slot]) # fancy-index directly into the slot
+                readyQ.put((slot, frameTag))
+                cBths +=1
+        except Exception as ex:
+            err = '%s' % ex
+
+        readyQ.put((-1, (frameTag, lenFrame, cBths, err))) # the frame is done
+
+    arrays = None
+    for shm in shms.values(): shm.close()
+
+class ReplayFrameReadAhead(object):
+    '''
+    The read-ahead service of ReplayFrames that takes a pool of processes, each of which decodes the frames submitted
+    and hands the batches over via the slots of shared memory, so that neither the decompressing nor the pickling
+    competes with the trainer for the GIL
+        ra = ReplayFrameReadAhead({'state': 1548, 'action': 3}, batchSize=128, processes=4)
+        ra.start()
+        ra.submit('RFrm_SH510050.h5', 'ReplayFrame:RF001')
+        batch, frameTag = ra.get()
+        ra.stop()
+    '''
+    def __init__(self, dims, batchSize, processes=2, slots=0, dtype='float32', balance=True, mpContext='fork'):
+        self._dims = OrderedDict(dims)
+        self._batchSize = int(batchSize)
+        self._processes = max(1, int(processes))
+        self._slots = int(slots) if slots and slots >0 else self._processes *8
+        self._dtype = np.dtype(dtype)
+        self._balance = balance
+        self._mpContext = mpContext
+
+        self.__shms, self.__arrays, self.__workers = {}, {}, []
+        self.__taskQ, self.__freeQ, self.__readyQ = None, None, None
+        self.__cSubmitted, self.__cFramesDone = 0, 0
+        self.__framesDone = []
+
+    @property
+    def pendingFrames(self) :
+        '''@return the number of frames submitted but not yet done'''
+        return self.__cSubmitted - self.__cFramesDone
+
+    @property
+    def isActive(self) : return len(self.__workers) >0
+
+    def start(self) :
+        import multiprocessing
+        from multiprocessing import shared_memory
+        ctx = multiprocessing.get_context(self._mpContext)
+        for col, dim in self._dims.items():
+            shm = shared_memory.SharedMemory(create=True, size=self._slots *self._batchSize *dim *self._dtype.itemsize)
+            self.__shms[col] = shm
+            self.__arrays[col] = np.ndarray((self._slots, self._batchSize, dim), dtype=self._dtype, buffer=shm.buf)
+
+        self.__taskQ, self.__freeQ, self.__readyQ = ctx.Queue(), ctx.Queue(), ctx.Queue()
+        for i in range(self._slots):
+            self.__freeQ.put(i)
+
+        shmNames = { col: shm.name for col, shm in self.__shms.items() }
+        for i in range(self._processes):
+            p = ctx.Process(target=_readAheadWorker, name='ReadAhead%d' % i, daemon=True,
+                args=(self.__taskQ, self.__freeQ, self.__readyQ, shmNames, self._dims, self._slots, self._batchSize, self._dtype.str, self._balance))
+            p.start()
+            self.__workers.append(p)
+
+    def stop(self) :
+        for p in self.__workers:
+            self.__taskQ.put(None)
+        for p in self.__workers:
+            p.join(timeout=5)
+            if p.is_alive(): p.terminate()
+        self.__workers = []
+
+        self.__arrays = {}
+        for shm in self.__shms.values():
+            shm.close()
+            shm.unlink()
+        self.__shms = {}
+
+    def submit(self, h5fileName, frameName) :
+        self.__taskQ.put((h5fileName, frameName))
+        self.__cSubmitted +=1
+
+    def framesDone(self) :
+        '''
+        @return the list of (frameTag, lenFrame, batches, error) done since the last call
+        '''
+        ret, self.__framesDone = self.__framesDone, []
+        return ret
+
+    def get(self, timeout=None) :
+        '''
+        @param timeout None to block until a batch is ready, 0 to not block
+        @return (batch, frameTag), or (None, None) if no batch is ready in time or no frame is pending
+        '''
+        while self.pendingFrames >0 or not self.__readyQ.empty():
+            try :
+                if timeout is None:
+                    slot, frameTag = self.__readyQ.get(block=True)
+                else:
+                    slot, frameTag = self.__readyQ.get(block=timeout>0, timeout=timeout if timeout>0 else None)
+            except Empty:
+                break
+
+            if slot <0:
+                self.__cFramesDone +=1
+                self.__framesDone.append(frameTag)
+                continue
+
+            # copy out of the slot so that the batch can be kept, such as by the recycle pool of the trainer
+            batch = { col: np.array(arr[slot]) for col, arr in self.__arrays.items() }
+            self.__freeQ.put(slot)
+            return batch, frameTag
+
+        return None, None
+
+########################################################################
+def _rebalanceWorker(args) :
+    filepathIn, filepathOut, kwargs = args
+    try :
+        return (filepathIn,) + ReplayFrameRebalancer(**kwargs).rebalance(filepathIn, filepathOut) + (None,)
+    except Exception as ex:
+        return filepathIn, 0, [], '%s' % ex
+
+class ReplayFrameRebalancer(object):
+    '''
+    The streaming rebalancer of the ReplayFrames in H5 files, whose memory is bounded by a chunk and an output frame
+    no matter how large the input file is
+        - the input frames are read chunk by chunk into the reused buffers
+        - the dominant action of each chunk is reduced to at most maxRatio times of the others by balanceMask()
+        - the kept rows are copied into a preallocated output frame, which is saved once it has outFrameSize rows
+        rb = ReplayFrameRebalancer(outFrameSize=8*1024, signature=EXPORT_SIGNATURE)
+        frames, actSubtotal = rb.rebalance('RFrm_SH510050.h5', 'RFrm_SH510050.h5b')
+        ReplayFrameRebalancer.rebalanceFiles([('a.h5', 'a.h5b'), ('b.h5', 'b.h5b')], processes=2, signature=EXPORT_SIGNATURE)
+    '''
+    def __init__(self, outFrameSize=8*1024, chunkSize=0, maxRatio=1.2, compress=True, signature=None,
+                 prefixes=['ReplayFrame:', 'RF'], outPrefix='ReplayFrame:', logger=print):
+        self._outFrameSize = int(outFrameSize)
+        self._chunkSize = int(chunkSize) if chunkSize and chunkSize >0 else self._outFrameSize
+        self._maxRatio = maxRatio
+        self._dsargs = { 'compression': 'lzf' } if compress else {} # 'gzip' for HDFExplorer
+        self._signature = signature
+        self._prefixes, self._outPrefix = prefixes, outPrefix
+        self._logger = logger
+
+        self.__chunks, self.__outs = {}, {} # col -> the reused buffers
+        self.__cOut = 0
+
+    def __log(self, msg) :
+        if self._logger: self._logger(msg)
+
+    def framesOf(self, h5f) :
+        return sorted([ name for name in h5f.keys() if any([ name[:len(prefix)] == prefix for prefix in self._prefixes ]) ])
+
+    def rebalance(self, filepathIn, filepathOut) :
+        '''
+        @return (count of frames saved, list of the action subtotals of the saved rows)
+        '''
+        frmId, self.__cOut = 0, 0
+        subtotal = None
+        with h5py.File(filepathIn, 'r') as h5f, h5py.File(filepathOut, 'w') as h5out:
+            framesIn = self.framesOf(h5f)
+            self.__log('rebalancing %s frames of %s to %s' % (len(framesIn), filepathIn, filepathOut))
+            for frmInName in framesIn :
+                frm = h5f[frmInName]
+                dsState, dsAction = frm['state'], frm['action']
+                signature = frm.attrs.get('signature', self._signature)
+                if subtotal is None:
+                    subtotal = np.zeros(dsAction.shape[1], dtype=np.int64)
+
+                cKept, frmLen = 0, min(dsState.shape[0], dsAction.shape[0])
+                for offset in range(0, frmLen, self._chunkSize) :
+                    n = min(self._chunkSize, frmLen - offset)
+                    col_state  = self.__readChunk('state', dsState, offset, n)
+                    col_action = self.__readChunk('action', dsAction, offset, n)
+                    rows = np.flatnonzero(ReplayFrameReader.balanceMask(col_action, self._maxRatio))
+                    cKept += len(rows)
+
+                    while len(rows) >0 :
+                        out_state, out_action = self.__outBuffer('state', dsState), self.__outBuffer('action', dsAction)
+                        m = min(len(rows), self._outFrameSize - self.__cOut)
+                        np.take(col_state, rows[:m], axis=0, out=out_state[self.__cOut: self.__cOut +m])
+                        np.take(col_action, rows[:m], axis=0, out=out_action[self.__cOut: self.__cOut +m])
+                        self.__cOut += m
+                        rows = rows[m:]
+                        if self.__cOut >= self._outFrameSize:
+                            subtotal += self.__saveFrame(h5out, frmId, signature)
+                            frmId +=1
+
+                self.__log('frmIn[%s] %d rows, kept %d, pending %d' % (frmInName, frmLen, cKept, self.__cOut))
+
+            if self.__cOut >0: # the last frame
+                subtotal += self.__saveFrame(h5out, frmId, signature)
+                frmId +=1
+
+        subtotal = subtotal.tolist() if subtotal is not None else []
+        self.__log('rebalanced %s to %s: %d frameOut, actSubtotal%s' % (filepathIn, filepathOut, frmId, subtotal))
+        return frmId, subtotal
+
+    def __readChunk(self, col, ds, offset, n) :
+        buf = self.__chunks.get(col, None)
+        if buf is None or buf.shape[1:] != ds.shape[1:] or buf.dtype != ds.dtype:
+            buf = np.empty((self._chunkSize,) + ds.shape[1:], dtype=ds.dtype)
+            self.__chunks[col] = buf
+
+        view = buf[:n]
+        ds.read_direct(view, np.s_[offset: offset +n])
+        return view
+
+    def __outBuffer(self, col, ds) :
+        buf = self.__outs.get(col, None)
+        if buf is None or buf.shape[1:] != ds.shape[1:] or buf.dtype != ds.dtype:
+            if self.__cOut >0:
+                raise ValueError('column[%s] %s%s mismatches the pending rows' % (col, ds.dtype, ds.shape[1:]))
+            buf = np.empty((self._outFrameSize,) + ds.shape[1:], dtype=ds.dtype)
+            self.__outs[col] = buf
+        return buf
+
+    def __saveFrame(self, h5out, frmId, signature) :
+        col_state, col_action = self.__outs['state'][:self.__cOut], self.__outs['action'][:self.__cOut]
+        kIout = np.bincount(np.argmax(col_action, axis=1)[col_action.max(axis=1) >=0.99], minlength=col_action.shape[1])
+
+        frmName ='%s%s' % (self._outPrefix, frmId)
+        g = h5out.create_group(frmName)
+        g.create_dataset(u'title', data= 'compressed replay frame[%s]' % (frmId))
+        g.attrs['state'] = 'state'
+        g.attrs['action'] = 'action'
+        g.attrs[u'default'] = 'state'
+        g.attrs['size'] = col_state.shape[0]
+        if signature is not None:
+            g.attrs['signature'] = signature
+
+        st = g.create_dataset('state', data= col_state, **self._dsargs)
+        st.attrs['dim'] = col_state.shape[1]
+        ac = g.create_dataset('action', data= col_action, **self._dsargs)
+        ac.attrs['dim'] = col_action.shape[1]
+        self.__log('outfrm[%s] actCounts%s saved' % (frmName, kIout.tolist()))
+
+        self.__cOut = 0
+        return kIout
+
+    def rebalanceFiles(pairs, processes=0, **kwargs) :
+        '''
+        rebalance multiple files in parallel, one process per file
+        @param pairs list of (filepathIn, filepathOut)
+        @return list of (filepathIn, count of frames saved, list of action subtotals, error) in the order of completion
+        '''
+        import multiprocessing
+        tasks = [ (fin, fout, kwargs) for fin, fout in pairs ]
+        processes = min(len(tasks), int(processes) if processes and processes >0 else multiprocessing.cpu_count())
+        if processes <=1:
+            return [ _rebalanceWorker(t) for t in tasks ]
+
+        with multiprocessing.Pool(processes=processes) as pool:
+            return list(pool.imap_unordered(_rebalanceWorker, tasks))
@@ -13,8 +13,13 @@ PRICE_DISPLAY_ROUND_DECIMALS = 3
 def floatNormalize_M1X5(var, base=1.0):
     return (float(var/base) -1) *5.0 + 0.5
 
-NORMALIZE_ID        = 'D%sM1X5' % EXPORT_FLOATS_DIMS
-FUNC_floatNormalize = floatNormalize_M1X5
+def floatsNormalize_M1X5(arr, base=1.0):
+    # the element-wise floatNormalize_M1X5() over a numpy array, takes the same float operations
+    return (arr /base -1) *5.0 + 0.5
+
+NORMALIZE_ID         = 'D%sM1X5' % EXPORT_FLOATS_DIMS
+FUNC_floatNormalize  = floatNormalize_M1X5
+FUNC_floatsNormalize = floatsNormalize_M1X5
 
 # Market相关events
 EVENT_TICK          = MARKETDATE_EVENT_PREFIX + 'Tick'                   # TICK行情事件，可后接具体的vtSymbol
@@ -577,15 +582,18 @@ class MarketState(MetaObj):
         raise NotImplementedError
 
     @abstractmethod
-    def exportKLFloats(self, symbol=None) :
+    def exportKLFloats(self, symbol=None, out=None, incremental=False) :
         '''@return an array_like data as toNNFloats, maybe [] or numpy.array
+        @param out an optional preallocated float buffer to export into
+        @param incremental True to allow returning a cached state that is only patched on the changes
         '''
         raise NotImplementedError
 
     @abstractmethod
-    def exportFloatsD4(self, symbol, d4wished= { 'asof':1, EVENT_KLINE_1DAY:20 } ) :
+    def exportFloatsD4(self, symbol, d4wished= { 'asof':1, EVENT_KLINE_1DAY:20 }, out=None) :
         '''
         @param d4wished to specify number of most recent 4-float of the event category to export
+        @param out an optional preallocated float buffer to export into
         @return an array_like data as toNNFloats
         '''
         raise NotImplementedError
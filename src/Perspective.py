@@ -13,6 +13,7 @@ import traceback
 import bz2
 import csv
 import copy
+import numpy as np
 # import tensorflow as tf
 
 EVENT_Perspective  = MARKETDATE_EVENT_PREFIX + 'Persp'   # 错误回报事件
@@ -28,79 +29,137 @@ EXPORT_SIGNATURE= '%dT%dM%dF%dD.%s:200109T17' % (DEFAULT_KLDEPTH_TICK, DEFAULT_K
 DEFAULT_MFDEPTH_1min = 240
 DEFAULT_MFDEPTH_1day = 120
 
+NN_FLOAT = 'float32'
+
 ########################################################################
 class EvictableStack(object):
+    '''
+    a fixed-capacity ring buffer where [0]/top is the most recently pushed item.
+    if the nildata is a KLineData, the OHLCV and datetime of the items are also kept in
+    preallocated numpy columns, see column()
+    '''
+    KLINE_COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'openInterest', 'datetime']
+
     def __init__(self, evictSize=0, nildata=None):
         '''Constructor'''
         super(EvictableStack, self).__init__()
-        self.__data =[]
-        self.__evictSize = evictSize
         self.__dataNIL = copy.copy(nildata) if nildata else None
+        self.__colNames = EvictableStack.KLINE_COLUMNS if isinstance(nildata, KLineData) else []
         self.__stampUpdated = None
-        # if self.__dataNIL and self.__evictSize and self.__evictSize >0 :
-        #     for i in range(self.__evictSize) :
-        #         self.__data.insert(0, nildata)
+        self.__allocate(evictSize)
+
+    def __allocate(self, evictSize):
+        self.__evictSize = max(0, int(evictSize))
+        self.__data = [None] * self.__evictSize
+        self.__cursor, self.__size = 0, 0
+        self.__cPushed, self.__dirtyIndexes = self.__evictSize, set() # every slot is dirty after allocated
+        # each column is doubled in length and every value is written twice, at slot and slot+evictSize,
+        # so that the most recent items always lay on a contiguous range of the column
+        self.__columns = { c: np.zeros(2 * self.__evictSize, dtype=np.float64) for c in self.__colNames }
+
+    def __slotOf(self, index):
+        if index <0: index += self.__size
+        if index <0 or index >= self.__size:
+            raise IndexError('EvictableStack index[%s] out of range[%d]' % (index, self.__size))
+        return (self.__cursor - index) % self.__evictSize
+
+    def __setSlot(self, slot, item):
+        self.__data[slot] = item
+        for c, col in self.__columns.items():
+            v = getattr(item, c, None)
+            if 'datetime' == c :
+                v = datetime2float(v)
+            col[slot] = col[slot + self.__evictSize] = float(v) if v else 0.0
 
     def __getitem__(self, index):
-        return self.__data[index]
+        return self.__data[self.__slotOf(index)]
 
     def __setitem__(self, index, value):
-        self.__data[index] = value
+        self.__setSlot(self.__slotOf(index), value)
+        self.__dirtyIndexes.add(index if index >=0 else index + self.__size)
     
     @property
     def top(self):
-        return self.__data[0] if len(self.__data) >0 else None
+        return self.__data[self.__cursor] if self.__size >0 else None
 
     @property
     def evictSize(self):
-        if self.__evictSize <0 : self.__evictSize =0
         return self.__evictSize
 
     @property
     def size(self):
-        return len(self.__data) if self.__data else 0
+        return self.__size
 
     def resize(self, evictSize):
-        self.__evictSize = int(evictSize)
-
-        while self.evictSize >=0 and self.size > self.evictSize:
-            del(self.__data[-1])
+        items = [self[i] for i in range(min(self.__size, max(0, int(evictSize))))]
+        self.__allocate(evictSize)
+        for item in reversed(items):
+            self.__append(item)
 
         return self.evictSize
 
     @property
     def exportList(self):
-        return _exportList(self, nilFilled=True)
+        return self._exportList(nilFilled=True)
 
     @property
     def stampUpdated(self):
         return self.__stampUpdated if self.__stampUpdated else DT_EPOCH
 
+    @property
+    def columnNames(self):
+        return list(self.__columns.keys())
+
+    @property
+    def dirty(self):
+        '''
+        @return (cPushed, indexes) the count of items pushed and the set of item indexes overwritten since the last markClean()
+        '''
+        return self.__cPushed, self.__dirtyIndexes
+
+    def markClean(self):
+        self.__cPushed, self.__dirtyIndexes = 0, set()
+
+    def column(self, name):
+        '''
+        @return a read-only numpy view of the column where [0] is the top item, no data copied
+        '''
+        end = self.__cursor + self.__evictSize +1
+        view = self.__columns[name][end - self.__size : end][::-1]
+        view.flags.writeable = False
+        return view
+
     def _exportList(self, nilFilled=False):
+        result = [self[i] for i in range(self.__size)]
         if nilFilled :
-            fillsize = (self.evictSize - self.size) if self.evictSize >=0 else 0
-            return self.__data + [self.__dataNIL] *fillsize
-        return self.__data
+            result += [self.__dataNIL] * (self.evictSize - self.size)
+        return result
 
     def overwrite(self, item):
-        self.__data[0] =item
+        self[0] = item
 
     def insert(self, index, item):
-        if index <0 or index >= len(self.__data):
+        if index <0 or index >= self.__size:
             return
-        self.__data[index] =item
-        while self.evictSize >=0 and self.size > self.evictSize:
-            del(self.__data[-1])
+        self[index] = item
         self.__stampUpdated = datetime.now()
 
     # no pop here: def pop(self):
     #    del(self.__data[-1])
 
+    def __append(self, item):
+        if self.__evictSize <=0:
+            return
+        self.__cursor = (self.__cursor +1) % self.__evictSize
+        self.__size = min(self.__size +1, self.__evictSize)
+        self.__setSlot(self.__cursor, item)
+
     def push(self, item):
-        self.__data.insert(0, item)
-        while self.evictSize >=0 and self.size > self.evictSize:
-            del(self.__data[-1])
+        self.__append(item)
         self.__stampUpdated = datetime.now()
+        self.__cPushed = min(self.__cPushed +1, self.__evictSize)
+        if len(self.__dirtyIndexes) >0:
+            self.__dirtyIndexes = set(i +1 for i in self.__dirtyIndexes if i +1 < self.__evictSize)
 
 ########################################################################
 class Perspective(MarketData):
@@ -141,6 +200,9 @@ class Perspective(MarketData):
         self.__focusLast = None
         self.__dayOHLC = None
 
+        self.__cachedState = None # the normalized state cached by exportS1548I4(incremental=True)
+        self.__cachedBaseline = None
+
     @property
     def desc(self) :
         str = '%s>%s ' % (self.focus[len(MARKETDATE_EVENT_PREFIX):], self.getAsOf(self.focus).strftime('%Y-%m-%dT%H:%M:%S'))
@@ -273,7 +335,7 @@ class Perspective(MarketData):
 
         evd = ev.data
         if not self.__dayOHLC :
-            self.__dayOHLC = evd
+            self.__dayOHLC = copy.copy(evd) # a copy to avoid modifying the item that has been pushed into the stack
             return ev
 
         if evd.asof > self.__dayOHLC.asof:
@@ -322,9 +384,7 @@ class Perspective(MarketData):
                 self._stacks[ev.type].insert(i, ev.data)
             return ev
         
-        self._stacks[ev.type].insert(-1, ev.data)
-        while self._stacks[ev.type].evictSize >=0 and self._stacks[ev.type].size > self._stacks[ev.type].evictSize:
-            del(self._stacks[ev.type]._data[-1])
+        self._stacks[ev.type].insert(-1, ev.data) # the stack is fixed-capacity, no more eviction needed here
 
         if self._stacks[ev.type].size >0:
             self.__focusLast = ev.type
@@ -351,8 +411,9 @@ class Perspective(MarketData):
         klbaseline = self._stacks[EVENT_KLINE_1DAY].top
         return self.__exportS1548I4(baseline_Price=klbaseline.close, baseline_Volume=klbaseline.volume)
     
-    def floatsD4(self, d4wished= { 'asof':1, EVENT_KLINE_1DAY:20 } ) :
-        '''@return an array_like data as toNNFloats, maybe [] or numpy.array
+    def floatsD4(self, d4wished= { 'asof':1, EVENT_KLINE_1DAY:20 }, out=None) :
+        '''@return a float32 numpy.array as toNNFloats, None if not available
+        @param out an optional preallocated float32 buffer to export into
         '''
         if self._stacks[EVENT_KLINE_1DAY].size <=0:
             return None # toNNFloats not available
@@ -363,33 +424,30 @@ class Perspective(MarketData):
         if baseline_Price <0.01: baseline_Price=1.0
         if baseline_Volume <0.001: baseline_Volume=1.0
 
-        result = []
+        size =0
         for k, v in d4wished.items():
-            if 'asof' ==k and int(v) >0:
-                fAsOf = [0.0] * EXPORT_FLOATS_DIMS
-                try :
-                    stampAsof = self.asof
-                    fAsOf[0] = stampAsof.month
-                    fAsOf[1] = stampAsof.day
-                    fAsOf[2] = stampAsof.weekday()
-                    fAsOf[3] = stampAsof.hour *60 +stampAsof.minute
-                except: pass
-                result += fAsOf # datetime as the first item
-                continue
-
-            if not k in [EVENT_KLINE_1MIN, EVENT_KLINE_5MIN, EVENT_KLINE_1DAY]:
+            if 'asof' ==k :
+                size += EXPORT_FLOATS_DIMS if int(v) >0 else 0
+            elif k in [EVENT_KLINE_1MIN, EVENT_KLINE_5MIN, EVENT_KLINE_1DAY]:
+                size += EXPORT_FLOATS_DIMS * int(v)
+            else :
                 raise ValueError('Perspective.floatsD4() unknown etype[%s]' %k )
 
-            stk = self._stacks[k]
-            bV= (baseline_Volume / self._evsPerDay[k])
-            for i in range(int(v)):
-                if i >= stk.size:
-                    result += [0.0] * EXPORT_FLOATS_DIMS
-                else:
-                    fval = stk[i].toNNFloats(baseline_Price=baseline_Price, baseline_Volume= bV)
-                    result += fval
+        if out is None:
+            out = np.zeros(size, dtype=NN_FLOAT)
 
-        return result
+        offset =0
+        for k, v in d4wished.items():
+            if 'asof' ==k :
+                if int(v) >0:
+                    self.__fillAsOfFloats(out[offset:]) # datetime as the first item
+                    offset += EXPORT_FLOATS_DIMS
+                continue
+
+            self.__fillKLFloats(out[offset:], k, int(v), baseline_Price, baseline_Volume)
+            offset += EXPORT_FLOATS_DIMS * int(v)
+
+        return out
 
     # def engorged(self, symbol=None) :
     #     '''@return dict {fieldName, engorged percentage} to represent the engorged percentage of state data
@@ -453,6 +511,124 @@ class Perspective(MarketData):
 
         return result
 
+    def exportS1548I4(self, out=None, incremental=False) :
+        '''the vectorized version of _S1548I4, the normalized floats are written into out by whole-column operations
+        @param out an optional preallocated float32 buffer of NNFloatsSize to export into
+        @param incremental True to patch and return the cached state where only the slots changed since
+                the previous incremental export are renormalized. The cached array should be taken as read-only
+        @return out, a float32 numpy.array in the layout of EXPORT_SIGNATURE
+        '''
+        if incremental:
+            self.__patchCachedState()
+            if out is None:
+                return self.__cachedState
+            out[:self.NNFloatsSize] = self.__cachedState
+            return out
+
+        if out is None:
+            out = np.zeros(self.NNFloatsSize, dtype=NN_FLOAT)
+
+        baseline = self.__baseline()
+        if not baseline:
+            out[:self.NNFloatsSize] = 0.0 # toNNFloats not available
+            return out
+
+        self.__fillAsOfFloats(out)
+        offset = EXPORT_FLOATS_DIMS
+        for et in [EVENT_KLINE_1MIN, EVENT_KLINE_5MIN, EVENT_KLINE_1DAY]:
+            count = self._stacks[et].evictSize
+            self.__fillKLFloats(out[offset:], et, count, baseline[0], baseline[1])
+            offset += EXPORT_FLOATS_DIMS * count
+
+        out[offset:self.NNFloatsSize] = 0.0
+        return out
+
+    def __baseline(self) :
+        '''@return (baseline_Price, baseline_Volume) taken from the latest 1day KLine, None if not available'''
+        if self._stacks[EVENT_KLINE_1DAY].size <=0:
+            return None
+
+        klbaseline = self._stacks[EVENT_KLINE_1DAY].top
+        baseline_Price, baseline_Volume = klbaseline.close, klbaseline.volume
+        if baseline_Price <0.01: baseline_Price=1.0
+        if baseline_Volume <0.001: baseline_Volume=1.0
+        return baseline_Price, baseline_Volume
+
+    def __patchCachedState(self) :
+        baseline = self.__baseline()
+        if self.__cachedState is None or len(self.__cachedState) != self.NNFloatsSize or baseline != self.__cachedBaseline:
+            # full renormalize if the daily baseline has been changed
+            self.__cachedState = self.exportS1548I4(out=self.__cachedState if self.__cachedState is not None and len(self.__cachedState) == self.NNFloatsSize else None)
+            self.__cachedBaseline = baseline
+            for et in [EVENT_KLINE_1MIN, EVENT_KLINE_5MIN, EVENT_KLINE_1DAY]:
+                self._stacks[et].markClean()
+            return
+
+        if not baseline:
+            return # the cached state has already been all zeros
+
+        self.__fillAsOfFloats(self.__cachedState)
+        offset = EXPORT_FLOATS_DIMS
+        for et in [EVENT_KLINE_1MIN, EVENT_KLINE_5MIN, EVENT_KLINE_1DAY]:
+            stk = self._stacks[et]
+            count = stk.evictSize
+            cPushed, dirtyIndexes = stk.dirty
+            block = self.__cachedState[offset : offset + EXPORT_FLOATS_DIMS * count]
+            offset += EXPORT_FLOATS_DIMS * count
+
+            if cPushed >= count:
+                self.__fillKLFloats(block, et, count, baseline[0], baseline[1])
+            else:
+                if cPushed >0:
+                    # the existing items moved down by cPushed, so do their normalized floats
+                    block[cPushed * EXPORT_FLOATS_DIMS:] = block[:(count - cPushed) * EXPORT_FLOATS_DIMS]
+                    self.__fillKLFloats(block, et, count, baseline[0], baseline[1], rowEnd=cPushed)
+                for i in dirtyIndexes:
+                    if i >= cPushed:
+                        self.__fillKLFloats(block, et, count, baseline[0], baseline[1], rowStart=i, rowEnd=i+1)
+
+            stk.markClean()
+
+    def __fillAsOfFloats(self, out) :
+        out[:EXPORT_FLOATS_DIMS] = 0.0
+        try :
+            stampAsof = self.asof
+            out[0] = stampAsof.month
+            out[1] = stampAsof.day
+            out[2] = stampAsof.weekday()
+            out[3] = stampAsof.hour *60 +stampAsof.minute
+        except: pass
+
+    def __fillKLFloats(self, out, evType, count, baseline_Price, baseline_Volume, rowStart=0, rowEnd=None) :
+        '''fill the most recent count KLines of the stack into out as KLineData.toNNFloats() does, zeros for the missing ones
+        @param rowStart, rowEnd to only fill the rows of the given range
+        '''
+        stk = self._stacks[evType]
+        bV = baseline_Volume / self._evsPerDay[evType]
+        if baseline_Price <=0: baseline_Price=1.0
+        if bV <=0: bV=1.0
+
+        block = out[:count * EXPORT_FLOATS_DIMS].reshape(count, EXPORT_FLOATS_DIMS)
+        if rowEnd is None or rowEnd > count: rowEnd = count
+        n = min(rowEnd, stk.size)
+        block[max(rowStart, n):rowEnd] = 0.0
+        if n <= rowStart:
+            return
+
+        # the basic dims, min=4
+        rows = block[rowStart:n]
+        rows[:, 0] = FUNC_floatsNormalize(stk.column('close')[rowStart:n], baseline_Price)
+        rows[:, 1] = FUNC_floatsNormalize(stk.column('volume')[rowStart:n], bV)
+        rows[:, 2] = FUNC_floatsNormalize(stk.column('high')[rowStart:n], baseline_Price)
+        rows[:, 3] = FUNC_floatsNormalize(stk.column('low')[rowStart:n], baseline_Price)
+
+        # the optional dims
+        rows[:, 4:] = 0.0
+        if EXPORT_FLOATS_DIMS > 4:
+            rows[:, 4] = FUNC_floatsNormalize(stk.column('open')[rowStart:n], baseline_Price)
+        if EXPORT_FLOATS_DIMS > 5:
+            rows[:, 5] = FUNC_floatsNormalize(stk.column('openInterest')[rowStart:n], baseline_Price)
+
     def __data2export(self, mdata, fields) :
         fdata = []
         for f in fields:
@@ -546,9 +722,7 @@ class MoneyflowPerspective(MarketData):
                 self._stacks[ev.type].insert(i, ev.data)
             return ev
         
-        self._stacks[ev.type].insert(-1, ev.data)
-        while self._stacks[ev.type].evictSize >=0 and self._stacks[ev.type].size > self._stacks[ev.type].evictSize:
-            del(self._stacks[ev.type]._data[-1])
+        self._stacks[ev.type].insert(-1, ev.data) # the stack is fixed-capacity, no more eviction needed here
 
         if self._stacks[ev.type].size >0:
             self.__focusLast = ev.type
@@ -741,24 +915,47 @@ class PerspectiveState(MarketState):
             self.__dictMoneyflow[s].push(ev)
 
     __dummy = None
-    def exportKLFloats(self, symbol=None) :
-        '''@return an array_like data as toNNFloats, maybe [] or numpy.array
+    def exportKLFloats(self, symbol=None, out=None, incremental=False) :
+        '''@return a float32 numpy.array as toNNFloats
+        @param out an optional preallocated float32 buffer to export into
+        @param incremental True to return the cached state of the symbol that is patched only on the changed slots,
+                the returned array should be taken as read-only if out is not given
         '''
         if symbol and symbol in self.__dictPerspective.keys():
-            return self.__dictPerspective[symbol]._S1548I4
+            return self.__dictPerspective[symbol].exportS1548I4(out, incremental=incremental)
 
         if not PerspectiveState.__dummy:
             PerspectiveState.__dummy = Perspective(self.exchange, 'Dummy')
 
-        return [0.0] * PerspectiveState.__dummy.NNFloatsSize
+        if out is None:
+            return np.zeros(PerspectiveState.__dummy.NNFloatsSize, dtype=NN_FLOAT)
+
+        out[:PerspectiveState.__dummy.NNFloatsSize] = 0.0
+        return out
+
+    def exportKLFloatsBatch(self, symbols, out=None) :
+        '''export the states of multiple symbols in one call
+        @param out an optional preallocated float32 matrix of (len(symbols), NNFloatsSize) to export into
+        @return the float32 matrix where the row i is exportKLFloats(symbols[i])
+        '''
+        if out is None:
+            if not PerspectiveState.__dummy:
+                PerspectiveState.__dummy = Perspective(self.exchange, 'Dummy')
+            out = np.zeros((len(symbols), PerspectiveState.__dummy.NNFloatsSize), dtype=NN_FLOAT)
+
+        for i, s in enumerate(symbols):
+            self.exportKLFloats(s, out=out[i])
+
+        return out
 
-    def exportFloatsD4(self, symbol, d4wished= { 'asof':1, EVENT_KLINE_1DAY:20 } ) :
+    def exportFloatsD4(self, symbol, d4wished= { 'asof':1, EVENT_KLINE_1DAY:20 }, out=None) :
         '''
         @param d4wished to specify number of most recent 4-float of the event category to export
+        @param out an optional preallocated float32 buffer to export into
         @return an array_like data as toNNFloats
         '''
         if symbol and symbol in self.__dictPerspective.keys():
-            return self.__dictPerspective[symbol].floatsD4(d4wished)
+            return self.__dictPerspective[symbol].floatsD4(d4wished, out=out)
 
         raise ValueError('Perspective.floatsD4() unknown symbol[%s]' %symbol )
 
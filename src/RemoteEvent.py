@@ -8,6 +8,7 @@ from EventData    import *
 from MarketData   import *
 from TradeAdvisor  import EVENT_ADVICE, EVENT_TICK_OF_ADVICE
 from Application  import BaseApplication, BOOL_STRVAL_TRUE
+from EventCodec   import encodeEvent, decodeEvent, CODEC_PICKLE
 
 import os
 import pickle, json   # to save params
@@ -41,6 +42,9 @@ class EventEnd(BaseApplication):
         self._topicsOutgoing   = self.getConfig('outgoing', [])
         self._topicsIncomming  = self.getConfig('incoming', [])
         self._topicsBySymbol   = self.getConfig('bySymbols', EventEnd.ALL_SYMBOL_ORIENT_EVENTS)
+        # the codec to send, the receiving always tells the codec of each message so that the ends of either codec work together.
+        # pickle by default to keep talking to the ends that only know pickle, take 'binary' once all the ends are upgraded
+        self._codec            = self.getConfig('codec', CODEC_PICKLE)
         self._subQuit   = False
         self._symbolsOfSub    = []
 
@@ -56,6 +60,10 @@ class EventEnd(BaseApplication):
     def recv(self, secTimeout=0.1):
         return None
 
+    @property
+    def codec(self):
+        return self._codec
+
     def topicOfEvent(self, ev):
         return ev.type
 
@@ -207,7 +215,7 @@ class ZmqEE(EventEnd):
             self.__soPub.connect(self.__epPUB)
             self.info('connected pub to evch[%s]'% (self.__epPUB))
 
-        pklstr = pickle.dumps(ev) # this is bytes
+        pklstr = encodeEvent(ev, self._codec) # this is bytes
         #NO such API: self.__soPub.connect()
         msg = self.topicOfEvent(ev).encode() + ZMQ_DELIMITOR_TOPIC.encode() + pklstr # this is bytes
         self.__soPub.send(msg) # send must take bytes
@@ -246,7 +254,12 @@ class ZmqEE(EventEnd):
 
         # necessary to filter arrivals as topicfilter covered it: 
         # if topic in self._topicsIncomming:
-        ev = pickle.loads(pklstr)
+        try :
+            ev = decodeEvent(pklstr)
+        except ValueError as ex: # the layout of a newer peer, not to reset the connection
+            self.warn('recv from evch[%s] skipped: %s'% (self.__epSUB, ex))
+            return None
+
         self.debug('recv from evch[%s]: %s'% (self.__epSUB, ev.desc))
         return ev
 
@@ -424,7 +437,7 @@ class RedisEE(EventEnd):
         if not self.__redisConn:
             return
 
-        pklstr = pickle.dumps(ev) # this is bytes
+        pklstr = encodeEvent(ev, self._codec) # this is bytes
         try :
             topic = ev.type
             if ev.type in self._topicsBySymbol:
@@ -552,7 +565,11 @@ class RedisEE(EventEnd):
                         continue
 
                     pklstr = msg['data'] 
-                    ev = pickle.loads(pklstr)
+                    try :
+                        ev = decodeEvent(pklstr)
+                    except ValueError as ex: # the layout of a newer peer, not to reset the connection
+                        self.warn('remoteEvent from evch[%s@%s:%s] skipped: %s' % (ch, self._redisHost, self._redisPort, ex))
+                        continue
                     if not ev : continue
 
                     self._queIncoming.put(ev)
@@ -18,6 +18,7 @@ from datetime import datetime, timedelta
 from collections import OrderedDict
 from itertools import product
 import multiprocessing
+import logging, random
 import copy
 
 import os
@@ -79,6 +80,13 @@ class BackTestApp(MetaTrader):
         self._pctMaxDrawDown = self.getConfig('backTest/pctMaxDrawDown', 21) # we allow 30% lost during a episode
         self._warmupDays     = self.getConfig('backTest/warmupDays', 5) # observe for a week by default to make the market state not so empty
         self._plotReport     = self.getConfig('backTest/plotReport', 'False').lower() in BOOL_STRVAL_TRUE
+        self._pctEarlyStop   = self.getConfig('backTest/earlyStopDdPcnt', 0) # stop the episode once the drawdown so far exceeds this percentage, 0 to disable
+        self._cacheMB        = self.getConfig('backTest/cacheMB', 512) # the memory cap of the history cached across episodes, 0 to disable
+
+        # the episodes replay the history from the cache instead of re-reading the files
+        if self._episodes >1 and self._cacheMB >0 and isinstance(histdata, hist.Playback) and not isinstance(histdata, (hist.PreloadedPlayback, hist.CachedPlayback)) :
+            hist.EVENT_CACHE.setCapacity(self._cacheMB)
+            self._wkHistData = hist.CachedPlayback(histdata, program=program)
 
         self._episodeNo = 1 # count start from 1 to ease reading
         self._stepNoInEpisode =0
@@ -99,6 +107,7 @@ class BackTestApp(MetaTrader):
             pass
 
         self.__dtLastData = self._btStartDate
+        self.__dateEarlyStop = None
         self._bGameOver = False
         self._openDays = 0
 
@@ -124,6 +133,25 @@ class BackTestApp(MetaTrader):
             
         return self._recorder
 
+    def applySetting(self, setting) :
+        '''
+        apply a setting of OptimizationSetting, each {name: value} of the setting overwrites the attribute
+        of the trader-template if it has, otherwise that of this BackTestApp
+        @return the names that are not known
+        '''
+        unknown = []
+        for name, value in setting.items() :
+            if hasattr(self._initTrader, name) :
+                setattr(self._initTrader, name, value)
+            elif hasattr(self, name) :
+                setattr(self, name, value)
+            else :
+                unknown.append(name)
+
+        if len(unknown) >0:
+            self.warn('applySetting() unknown parameters: %s' % unknown)
+        return unknown
+
     #----------------------------------------------------------------------
     # impl/overwrite of BaseApplication
     @property
@@ -217,6 +245,11 @@ class BackTestApp(MetaTrader):
                 ev = next(self._wkHistData)
                 if not ev or ev.data.datetime < self._btStartDate: return
                 if ev.data.datetime <= self._btEndDate:
+                    if self._pctEarlyStop >0 and self.__dateEarlyStop != ev.data.date :
+                        self.__dateEarlyStop = ev.data.date
+                        # the KO is tested before the first event of a new day is posted, the event is dropped on purpose:
+                        # the episode is over since the previous day, the trader must not act on a day beyond its summary
+                        if self.__testEarlyStop() : return
                     self._marketState.updateByEvent(ev)
                     s = ev.data.symbol
                     self.debug('hist-read: symbol[%s]%s asof[%s] lastPrice[%s] OHLC%s' % (s, ev.type[len(MARKETDATE_EVENT_PREFIX):], self._marketState.getAsOf(s).strftime('%Y%m%dT%H%M'), self._marketState.latestPrice(s), self._marketState.dailyOHLC_sofar(s)))
@@ -268,6 +301,25 @@ class BackTestApp(MetaTrader):
         self.resetEpisode()
         self._bGameOver =False
 
+    def __testEarlyStop(self) :
+        '''
+        test the drawdown so far once a day, a hopeless episode is KO-ed to save the rest of the playback
+        @return True if the episode has been KO-ed
+        '''
+        cash, posvalue = self._account.summrizeBalance()
+        balance = cash + posvalue
+        if balance > self._maxBalance :
+            self._maxBalance = balance
+            return False
+
+        if (self._maxBalance - balance) *100 < self._maxBalance * self._pctEarlyStop :
+            return False
+
+        self._bGameOver = True
+        self._episodeSummary['reason'] = 'early-stop: %s cash +%s pv drewdown over %s%% of maxBalance[%s]' % (cash, posvalue, self._pctEarlyStop, self._maxBalance)
+        self.warn('episode[%s] has been KO-ed: %s' % (self.episodeId, self._episodeSummary['reason']))
+        return True
+
     def OnEvent(self, ev): 
         # step 2. 收到行情后，在启动策略前的处理
         evd = ev.data
@@ -328,7 +380,13 @@ class BackTestApp(MetaTrader):
         self.info('OnEpisodeDone() episode[%d/%d], processed %d events in %d opendays took %ssec, composing summary' % 
             (additionAttrs['episodeNo'], additionAttrs['episodes'], additionAttrs['stepsInEpisode'], additionAttrs['openDays'], additionAttrs['episodeDuration']) )
 
-        tradeDays, summary = calculateSummary(self._startBalance, self._account.dailyResultDict)
+        # the summary is taken from the running stats, the DataFrame is only built for the plot
+        summary = self._account.episodeStats.summary(self._startBalance)
+        if not summary:
+            summary = 'NULL dayResultDict'
+        tradeDays = None
+        if self._plotReport :
+            tradeDays, _ = calculateSummary(self._startBalance, self._account.dailyResultDict)
 
         self._account.OnPlaybackEnd()
 
@@ -397,6 +455,7 @@ class BackTestApp(MetaTrader):
             self.info('doAppInit() wrappered account[%s] to [%s] with startBalance[%d]' % (self._originAcc.ident, self._account.ident, self._startBalance))
 
         self._maxBalance = self._startBalance
+        self.__dateEarlyStop = None
         self._wkHistData.resetRead()
            
         self._dataBegin_date, self._dataEnd_date = None, None
@@ -533,74 +592,6 @@ class BackTestApp(MetaTrader):
         plt.show()
         plt.close()
        
-    #----------------------------------------------------------------------
-    def runOptimization(self, strategyClass, optimizationSetting):
-        """优化参数"""
-        # 获取优化设置        
-        settingList = optimizationSetting.generateSetting()
-        targetName = optimizationSetting.optimizeTarget
-        
-        # 检查参数设置问题
-        if not settingList or not targetName:
-            self.debug(u'优化设置有问题，请检查')
-        
-        # 遍历优化
-        self.resultList =[]
-        for setting in settingList:
-            self.clearBackTesting()
-            self.debug('-' * 30)
-            self.debug('setting: %s' %str(setting))
-            self.initStrategy(strategyClass, setting)
-            self.runBacktesting()
-
-            df, d = calculateSummary(self._startBalance, self._account.dailyResultDict)
-            try:
-                targetValue = d[targetName]
-            except KeyError:
-                targetValue = 0
-            self.resultList.append(([str(setting)], targetValue, d))
-        
-        # 显示结果
-        self.resultList.sort(reverse=True, key=lambda result:result[1])
-        self.debug('-' * 30)
-        self.debug(u'优化结果：')
-        for result in self.resultList:
-            self.debug(u'参数：%s，目标：%s' %(result[0], result[1]))    
-        return self.resultList
-            
-    #----------------------------------------------------------------------
-    def runParallelOptimization(self, strategyClass, optimizationSetting):
-        """并行优化参数"""
-        # 获取优化设置        
-        settingList = optimizationSetting.generateSetting()
-        targetName = optimizationSetting.optimizeTarget
-        
-        # 检查参数设置问题
-        if not settingList or not targetName:
-            self.debug(u'优化设置有问题，请检查')
-        
-        # 多进程优化，启动一个对应CPU核心数量的进程池
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        l = []
-
-        for setting in settingList:
-            l.append(pool.apply_async(optimize, (strategyClass, setting,
-                                                 targetName, self.mode, 
-                                                 self.startDate, self.initDays, self.endDate,
-                                                 self.dbName, self.symbol)))
-        pool.close()
-        pool.join()
-        
-        # 显示结果
-        resultList = [res.get() for res in l]
-        resultList.sort(reverse=True, key=lambda result:result[1])
-        self.debug('-' * 30)
-        self.debug(u'优化结果：')
-        for result in resultList:
-            self.debug(u'参数：%s，目标：%s' %(result[0], result[1]))    
-            
-        return resultList
-
     #----------------------------------------------------------------------
     def calculateTransactions(self):
         """
@@ -1017,6 +1008,7 @@ class OptimizationSetting(object):
         self.paramDict = OrderedDict()
         
         self.optimizeTarget = ''        # 优化目标字段
+        self.ascending = False          # False to take the greater target value as the better
         
     #----------------------------------------------------------------------
     def addParameter(self, name, start, end=None, step=None):
@@ -1043,27 +1035,41 @@ class OptimizationSetting(object):
         self.paramDict[name] = l
         
     #----------------------------------------------------------------------
-    def generateSetting(self):
-        """生成优化参数组合"""
+    def generateSetting(self, randomSamples=0, seed=None):
+        """生成优化参数组合
+        @param randomSamples - the number of settings to randomly pick from the grid, 0 to take the whole grid
+        @param seed - the random seed to reproduce the pick
+        """
         # 参数名的列表
-        nameList = self.paramDict.keys()
-        paramList = self.paramDict.values()
+        nameList = list(self.paramDict.keys())
+        paramList = list(self.paramDict.values())
         
-        # 使用迭代工具生产参数对组合
-        productList = list(product(*paramList))
-        
-        # 把参数对组合打包到一个个字典组成的列表中
+        total = 1
+        for l in paramList: total *= len(l)
+
+        if randomSamples <=0 or randomSamples >= total:
+            # 使用迭代工具生产参数对组合, 把参数对组合打包到一个个字典组成的列表中
+            return [ dict(zip(nameList, p)) for p in product(*paramList) ]
+
+        # random search: pick the grid indexes without materializing the whole grid, then decode them by mixed radix
         settingList = []
-        for p in productList:
-            d = dict(zip(nameList, p))
-            settingList.append(d)
+        for idx in random.Random(seed).sample(range(total), randomSamples) :
+            d = {}
+            for name, l in zip(reversed(nameList), reversed(paramList)) :
+                idx, i = divmod(idx, len(l))
+                d[name] = l[i]
+            settingList.append({ name : d[name] for name in nameList })
     
         return settingList
     
     #----------------------------------------------------------------------
-    def setOptimizeTarget(self, target):
-        """设置优化目标字段"""
+    def setOptimizeTarget(self, target, ascending=False):
+        """设置优化目标字段
+        @param target - one of the keys of calculateSummary()
+        @param ascending - True if the less value of target is the better, such as returnStd
+        """
         self.optimizeTarget = target
+        self.ascending = ascending
 
 #----------------------------------------------------------------------
 def calculateSummary(startBalance, dayResultDict):
@@ -1178,32 +1184,121 @@ def calculateSummary(startBalance, dayResultDict):
     return df, summary
 
 #----------------------------------------------------------------------
-def optimize(strategyClass, setting, targetName,
-             mode, startDate, initDays, endDate,
-             dbName, symbol):
-
-    """多进程优化时跑在每个进程中运行的函数"""
-    account = BTAccount_AShare() # should be BTAccountWrapper
-    account.setBacktestingMode(mode)
-    account.setStartDate(startDate, initDays)
-    account.setEndDate(endDate)
-    account.setSlippage(slippage)
-    account.setRate(rate)
-    account.setSize(size)
-    account.setPriceTick(priceTick)
-    account.setDatabase(dbName, symbol)
-    
-    account.initStrategy(strategyClass, setting)
-    account.runBacktesting()
-    
-    df, d = calculateSummary(startBalance, account.dailyResultDict)
-    try:
-        targetValue = d[targetName]
-    except KeyError:
-        targetValue = 0
-                    
-    return (str(setting), targetValue, d)    
-    
+RECCATE_OPTIMIZE = 'OptRes'
+COLUMNS_OPTIMIZE = 'settingNo,setting,target,targetValue,' + COLUMNS_ESPSUMMARY
+
+_optimizeContext = {} # the context of the optimizing master that the forked workers inherit
+
+def _initOptimizeWorker() :
+    # the forked worker must not echo into the handlers inherited from the master's logger
+    logging.getLogger().handlers = []
+
+def _optimizeWorker(task) :
+    """多进程优化时跑在每个进程中运行的函数
+    @return (settingNo, setting, summary)
+    """
+    settingNo, setting = task
+    ctx = _optimizeContext
+
+    p = Program()
+    p._heartbeatInterval =-1
+    histdata = ctx['histdata']
+    if histdata : histdata.setProgram(p)
+
+    summary = None
+    try :
+        bt = ctx['createBackTest'](p, histdata)
+        bt._episodes = 1
+        if ctx['earlyStopDdPcnt'] >0:
+            bt._pctEarlyStop = ctx['earlyStopDdPcnt']
+        bt.applySetting(setting)
+
+        try :
+            p.start()
+            if bt.isActive :
+                p.loop()
+            p.stop()
+        except SystemExit:
+            pass # BackTestApp exits once all the episodes are done
+
+        summary = bt._episodeSummary
+    except Exception as ex:
+        p.logexception(ex)
+        summary = 'exception: %s' % ex
+
+    return (settingNo, setting, summary)
+
+def optimize(program, createBackTest, optimizationSetting, histdata=None, processes=0, randomSamples=0, seed=None, earlyStopDdPcnt=0, recorder=None):
+    """
+    grid- or random-search the settings by running a BackTestApp episode of each setting in a process pool
+    @param program - the master program, whose configuration is also taken by the workers
+    @param createBackTest - function(program, histdata) that creates the apps in a worker and returns the BackTestApp
+    @param histdata - the Playback shared by the workers, a hist.PreloadedPlayback is preloaded here once then inherited by the forked workers
+    @param processes - the size of the process pool, 0 to take the cpu count
+    @param earlyStopDdPcnt - KO the episode of a setting once its drawdown so far exceeds this percentage
+    @param recorder - the TaggedCsvRecorder to stream the results into as category RECCATE_OPTIMIZE
+    @return list of (targetValue, setting, summary) sorted from the best
+    """
+    settingList = optimizationSetting.generateSetting(randomSamples, seed)
+    targetName = optimizationSetting.optimizeTarget
+    if not settingList or not targetName:
+        program.error('optimize() invalid settings[%s] or target[%s]' % (len(settingList), targetName))
+        return []
+
+    if isinstance(histdata, hist.PreloadedPlayback) :
+        histdata.preload()
+
+    if recorder :
+        recorder.registerCategory(RECCATE_OPTIMIZE, params= {'columns' : COLUMNS_OPTIMIZE })
+
+    _optimizeContext.update({
+        'createBackTest' : createBackTest,
+        'histdata' : histdata,
+        'earlyStopDdPcnt' : earlyStopDdPcnt,
+        })
+
+    if processes <=0 :
+        processes = multiprocessing.cpu_count()
+    program.info('optimize() running %d settings for target[%s] by %d processes' % (len(settingList), targetName, processes))
+
+    # maxtasksperchild=1 gives each setting a fresh fork of the master, so that the workers never leak Program/App state into the next setting
+    pool = multiprocessing.get_context('fork').Pool(processes, initializer=_initOptimizeWorker, maxtasksperchild=1)
+    resultList = []
+    stampStart = datetime.now()
+    try :
+        for settingNo, setting, summary in pool.imap_unordered(_optimizeWorker, enumerate(settingList)) :
+            targetValue = None
+            if isinstance(summary, dict) :
+                targetValue = summary.get(targetName, None)
+                if 'reason' in summary.keys() :
+                    targetValue = None # a KO-ed setting is always ranked to the bottom
+            else :
+                summary = { 'reason' : str(summary) }
+
+            resultList.append((targetValue, setting, summary))
+            program.info(u'optimize() %d/%d took %s 参数：%s，目标：%s' % (len(resultList), len(settingList), str(datetime.now() - stampStart), setting, targetValue))
+
+            if recorder :
+                row = {**summary, 'settingNo': settingNo, 'setting': str(setting).replace(',', ';'), 'target': targetName, 'targetValue': targetValue}
+                recorder.pushRow(RECCATE_OPTIMIZE, row)
+                recorder.doAppStep()
+
+        pool.close()
+    except KeyboardInterrupt :
+        program.warn('optimize() interrupted, taking the %d results so far' % len(resultList))
+        pool.terminate()
+    pool.join()
+
+    # 显示结果
+    worst = float('inf') if optimizationSetting.ascending else float('-inf')
+    resultList.sort(reverse=not optimizationSetting.ascending, key=lambda result: worst if result[0] is None else result[0])
+    program.info('-' * 30)
+    program.info(u'优化结果：')
+    for result in resultList:
+        program.info(u'参数：%s，目标：%s' %(result[1], result[0]))
+
+    return resultList
+
 ########################################################################
 class AccountWrapper(MetaAccount):
     """
@@ -1222,15 +1317,24 @@ class AccountWrapper(MetaAccount):
         self._nest  = account
         # self._nest._mode = Account.BROKER_API_SYNC
         self._tradeCount = 0
+        self.__orderIdx = OrderBookIndex() # the pending limit orders by symbol and price to match
+        self.__orderIdxOf = None # the dict of limit orders that __orderIdx is built from
+        self.__stopIdx = StopTriggerIndex() # the pending stop orders by symbol and trigger price
+        self.__stopIdxOf = None # the dict of stop orders that __stopIdx is built from
 
         # 日线回测结果计算用
         self.__dailyResultDict = OrderedDict()
+        self.__episodeStats = EpisodeStats() # the running summary over __dailyResultDict
         self._warmupDays =0
 
     @property
     def dailyResultDict(self):
         return self.__dailyResultDict
 
+    @property
+    def episodeStats(self):
+        return self.__episodeStats
+
     @property
     def account(self):
         return self._nest.account
@@ -1252,50 +1356,11 @@ class AccountWrapper(MetaAccount):
         this is a 'duplicated' impl of Account in order to call BackTestAcc._broker_xxxx() 
         instead of those of Account
         '''
-        outgoingOrders = []
-        ordersToCancel = []
-        cStep =0
         fstampNow = datetime2float(self.datetimeAsOfMarket())
-        strExpired = ''
-        cExpired=0
-
         with self._nest._lock:
-            outgoingOrders = copy.deepcopy(list(self._nest._dictOutgoingOrders.values()))
-
-            # find out those expired orders, append them into _lstOrdersToCancel
-            if fstampNow >0.0 :
-                for odid,odata in self._nest._dictLimitOrders.items():
-                    if odata.msecTTL <=0 or odata.fstampSubmitted + odata.msecTTL > fstampNow: continue
-                    if odid in self._lstOrdersToCancel : continue
-                    self._lstOrdersToCancel.append(odid)
-                    strExpired += 'O[%s],' % odata.desc
-                    cExpired +=1
-
-                for odid,odata in self._nest._dictStopOrders.items():
-                    if odata.msecTTL <=0 or odata.fstampSubmitted + odata.msecTTL > fstampNow: continue
-                    if odid in self._lstOrdersToCancel : continue
-                    self._lstOrdersToCancel.append(odid)
-                    strExpired += 'O[%s],' % odata.desc
-                    cExpired +=1
-
-            # find out he orderData by brokerOrderId
-            for odid in self._nest._lstOrdersToCancel :
-                orderData = None
-                try :
-                    if OrderData.STOPORDERPREFIX in odid :
-                        orderData = self._nest._dictStopOrders[odid]
-                    else :
-                        orderData = self._nest._dictLimitOrders[odid]
-                except KeyError:
-                    pass
-
-                if orderData :
-                    ordersToCancel.append(copy.copy(orderData))
-                
-                cStep +=1
-
-            self._nest._lstOrdersToCancel = []
+            outgoingOrders, ordersToCancel, expiredOrders = self._nest._flushOrders(fstampNow)
 
+        cStep = len(ordersToCancel)
         for co in ordersToCancel:
             self._broker_cancelOrder(co)
             cStep +=1
@@ -1304,8 +1369,8 @@ class AccountWrapper(MetaAccount):
             self._broker_placeOrder(no)
             cStep +=1
 
-        if (cExpired>0):
-            self.warn('step() placed %d orders, cancelled %d orders including %d expired: %s'% (len(outgoingOrders), len(ordersToCancel), cExpired, strExpired))
+        if len(expiredOrders) >0:
+            self.warn('step() placed %d orders, cancelled %d orders including %d expired: %s'% (len(outgoingOrders), len(ordersToCancel), len(expiredOrders), ''.join(['O[%s],' % o.desc for o in expiredOrders])))
         elif (len(ordersToCancel) + len(outgoingOrders)) >0:
             self.info('step() placed %d orders, cancelled %d orders'% (len(outgoingOrders), len(ordersToCancel)))
 
@@ -1354,6 +1419,7 @@ class AccountWrapper(MetaAccount):
     def getPosition(self, symbol): return self._nest.getPosition(symbol) # returns PositionData
     def cashAmount(self): return self._nest.cashAmount() # returns (avail, total)
     def positionState(self) : return self._nest.positionState()
+    def positionSnapshot(self) : return self._nest.positionSnapshot()
     def summrizeBalance(self, positions=None, cashTotal=0) : return self._nest.summrizeBalance(positions=positions, cashTotal=cashTotal)
     def cashChange(self, dAvail=0, dTotal=0): return self._nest.cashChange(dAvail, dTotal)
     def record(self, category, data): return self._nest.record(category, data)
@@ -1366,7 +1432,16 @@ class AccountWrapper(MetaAccount):
     def findOrdersOfStrategy(self, strategyId, symbol=None): return self._nest.findOrdersOfStrategy(strategyId, symbol)
     
     def datetimeAsOfMarket(self): return self._btTrader.wkTrader._dtData
-    def _broker_onOrderPlaced(self, orderData): return self._nest._broker_onOrderPlaced(orderData)
+    def _broker_onOrderPlaced(self, orderData):
+        ret = self._nest._broker_onOrderPlaced(orderData)
+        with self._nest._lock:
+            if self.__syncOrderIndex() :
+                if orderData.brokerOrderId in self._nest._dictLimitOrders:
+                    self.__indexOrder(self._nest._dictLimitOrders[orderData.brokerOrderId])
+                elif orderData.brokerOrderId in self._nest._dictStopOrders:
+                    self.__indexOrder(self._nest._dictStopOrders[orderData.brokerOrderId])
+        return ret
+
     def _broker_onCancelled(self, orderData): return self._nest._broker_onCancelled(orderData)
     def _broker_onOrderDone(self, orderData): return self._nest._broker_onOrderDone(orderData)
     def _broker_onTrade(self, trade): return self._nest._broker_onTrade(trade)
@@ -1387,6 +1462,8 @@ class AccountWrapper(MetaAccount):
 
         # save the calculated daily result into the this wrapper for late calculating
         if self._nest._datePrevClose :
+            if not self._nest._datePrevClose in self.__dailyResultDict :
+                self.__episodeStats.push(self._nest._todayResult, self._nest._datePrevClose)
             self.__dailyResultDict[self._nest._datePrevClose] = self._nest._todayResult
 
     def onTimer(self, dt): return self._nest.onTimer(dt)
@@ -1502,6 +1579,9 @@ class AccountWrapper(MetaAccount):
             sellCrossPrice     = tkdata.b1P
             buyBestCrossPrice  = tkdata.a1P
             sellBestCrossPrice = tkdata.b1P
+            buyTriggerPrice    = tkdata.price
+            sellTriggerPrice   = tkdata.price
+            openPrice          = tkdata.price
         elif EVENT_KLINE_PREFIX == ev.type[:len(EVENT_KLINE_PREFIX)] :
             kldata = ev.data
             symbol = kldata.symbol
@@ -1513,6 +1593,9 @@ class AccountWrapper(MetaAccount):
             maxCrossVolume     = kldata.volume
             buyBestCrossPrice  = ((kldata.open + kldata.close + kldata.high) *3 + kldata.low)  /10  # 在当前时间点前发出的买入委托可能的最优成交价
             sellBestCrossPrice = ((kldata.open + kldata.close + kldata.low)  *3 + kldata.high) /10  # 在当前时间点前发出的卖出委托可能的最优成交价
+            buyTriggerPrice    = kldata.high       # 若买入方向停止单价格低于该价格，则会触发
+            sellTriggerPrice   = kldata.low        # 若卖出方向停止单价格高于该价格，则会触发
+            openPrice          = kldata.open
             
             # 张跌停封板
             if buyCrossPrice <= kldata.open*0.9 :
@@ -1529,7 +1612,65 @@ class AccountWrapper(MetaAccount):
         # 先撮合限价单
         self.__crossLimitOrder(symbol, dtEvent, buyCrossPrice, sellCrossPrice, buyBestCrossPrice, sellBestCrossPrice, maxCrossVolume)
         # 再撮合停止单
-        self.__crossStopOrder(symbol, dtEvent, buyCrossPrice, sellCrossPrice, buyBestCrossPrice, sellBestCrossPrice, maxCrossVolume)
+        self.__crossStopOrder(symbol, dtEvent, buyCrossPrice, sellCrossPrice, buyBestCrossPrice, sellBestCrossPrice,
+                              buyTriggerPrice, sellTriggerPrice, openPrice, maxCrossVolume)
+
+    def __indexOrder(self, order) :
+        # 推送委托进入队列（未成交）的状态更新
+        if not order.status:
+            order.status = OrderData.STATUS_SUBMITTED
+        if OrderData.STOPORDERPREFIX in order.reqId :
+            self.__stopIdx.add(order, self._nest._dictStopOrders)
+        else :
+            self.__orderIdx.add(order, self._nest._dictLimitOrders)
+
+    def __syncOrderIndex(self) :
+        '''
+        rebuild the order indices if the dicts of orders have been replaced, such as by loadDB(), expected to be
+        called within self._nest._lock
+        @return True if the indices were already in sync
+        '''
+        if self.__orderIdxOf is self._nest._dictLimitOrders and self.__stopIdxOf is self._nest._dictStopOrders:
+            return True
+
+        self.__orderIdxOf, self.__stopIdxOf = self._nest._dictLimitOrders, self._nest._dictStopOrders
+        self.__orderIdx.clear()
+        self.__stopIdx.clear()
+        for o in list(self._nest._dictLimitOrders.values()) + list(self._nest._dictStopOrders.values()):
+            self.__indexOrder(o)
+        return False
+
+    def __fakeTrade(self, order, price, dtAsOf) :
+        '''
+        fill the order completely at the price
+        @return the TradeData
+        '''
+        self._tradeCount += 1            # 成交编号自增1
+        tradeID = str(self._tradeCount)
+        trade = TradeData(self._nest)
+        trade.brokerTradeId = tradeID
+        # tradeID will be generated in Account: trade.tradeID = tradeID
+        trade.symbol = order.symbol
+        trade.exchange = order.exchange
+        trade.orderReq = order.reqId
+        trade.orderID  = order.brokerOrderId
+        trade.direction = order.direction
+        trade.offset    = order.offset
+        trade.volume    = order.totalVolume
+        trade.datetime  = dtAsOf
+        trade.price     = price
+
+        order.tradedVolume = trade.volume
+        order.status = OrderData.STATUS_ALLTRADED
+        order.stampFinished = dtAsOf.strftime('%H:%M:%S.%f')[:3]
+
+        if order.tradedVolume < order.totalVolume :
+            order.status = OrderData.STATUS_PARTTRADED
+        return trade
+
+    def __logEnabled(self, level) :
+        logger = self.program.logger if self.program else None
+        return not logger or logger.isEnabledFor(level)
 
     def __crossLimitOrder(self, symbol, dtAsOf, buyCrossPrice, sellCrossPrice, buyBestCrossPrice, sellBestCrossPrice, maxCrossVolume=-1):
         """基于最新数据撮合限价单
@@ -1541,74 +1682,37 @@ class AccountWrapper(MetaAccount):
         it may not be executed if the price set by the investor cannot be met
         during the period of time in which the order is left open.
         """
-        # 遍历限价单字典中的所有限价单vtTradeID
+        # only the orders that can cross are taken from the index by symbol and price, instead of
+        # iterating all the limit orders
 
         trades = []
         finishedOrders = []
-        pendingOrders =[]
+        pendingOrders = None
 
-        strCrossed =''
         if not dtAsOf:
             dtAsOf  = self.datetimeAsOfMarket()
 
         with self._nest._lock:
-            for orderID, order in self._nest._dictLimitOrders.items():
-                if order.symbol != symbol:
-                    continue
-
-                # 推送委托进入队列（未成交）的状态更新
-                if not order.status:
-                    order.status = OrderData.STATUS_SUBMITTED
-
-                # 判断是否会成交
-                buyCross = (order.direction == OrderData.DIRECTION_LONG and 
-                            order.price>=buyCrossPrice and
-                            buyCrossPrice > 0)      # 国内的tick行情在涨停时a1P为0，此时买无法成交
-                
-                sellCross = (order.direction == OrderData.DIRECTION_SHORT and 
-                            order.price<=sellCrossPrice and
-                            sellCrossPrice > 0)    # 国内的tick行情在跌停时bidP1为0，此时卖无法成交
-                
-                if not buyCross and not sellCross:
-                    pendingOrders.append(order)
-                    continue
-
+            self.__syncOrderIndex()
+            crossed = self.__orderIdx.popCrossed(symbol, buyCrossPrice, sellCrossPrice, self._nest._dictLimitOrders)
+            for order, buyCross in crossed:
                 # 如果发生了成交， 推送成交数据
-                self._tradeCount += 1            # 成交编号自增1
-                tradeID = str(self._tradeCount)
-                trade = TradeData(self._nest)
-                trade.brokerTradeId = tradeID
-                # tradeID will be generated in Account: trade.tradeID = tradeID
-                trade.symbol = order.symbol
-                trade.exchange = order.exchange
-                trade.orderReq = order.reqId
-                trade.orderID  = order.brokerOrderId
-                trade.direction = order.direction
-                trade.offset    = order.offset
-                trade.volume    = order.totalVolume
-                trade.datetime  = dtAsOf
-
                 if buyCross:
-                    trade.price = min(order.price, buyBestCrossPrice)
+                    trade = self.__fakeTrade(order, min(order.price, buyBestCrossPrice), dtAsOf)
                 else:
-                    trade.price  = max(order.price, sellBestCrossPrice)
+                    trade = self.__fakeTrade(order, max(order.price, sellBestCrossPrice), dtAsOf)
 
                 trades.append(trade)
-
-                order.tradedVolume = trade.volume
-                order.status = OrderData.STATUS_ALLTRADED
-                order.stampFinished = dtAsOf.strftime('%H:%M:%S.%f')[:3]
-
-                if order.tradedVolume < order.totalVolume :
-                    order.status = OrderData.STATUS_PARTTRADED
                 finishedOrders.append(order)
-                strCrossed += 'O[%s]->T[%s],' % (order.desc, trade.desc)
 
-        if len(finishedOrders) + len(pendingOrders) >0:
-            strPendings = ''
-            for o in pendingOrders:
-                strPendings += 'O[%s],' % o.desc
+            # the pending orders are listed only if they are going to be logged
+            if self.__logEnabled(logging.INFO if len(finishedOrders) >0 else logging.DEBUG):
+                pendingOrders = self.__orderIdx.pendingOrders(symbol, self._nest._dictLimitOrders)
+
+        if pendingOrders is not None and len(finishedOrders) + len(pendingOrders) >0:
+            strPendings = ''.join(['O[%s],' % o.desc for o in pendingOrders])
             if len(finishedOrders) >0:
+                strCrossed = ''.join(['O[%s]->T[%s],' % (o.desc, t.desc) for o, t in zip(finishedOrders, trades)])
                 self.info('crossLimitOrder() crossed %d orders:%s; %d pendings: %s'% (len(finishedOrders), strCrossed, len(pendingOrders), strPendings))
             else:
                 self.debug('crossLimitOrder() %d pending orders: %s'% (len(pendingOrders), strPendings))
@@ -1620,87 +1724,42 @@ class AccountWrapper(MetaAccount):
             self._broker_onTrade(t)
 
     #----------------------------------------------------------------------
-    def __crossStopOrder(self, symbol, dtAsOf, buyCrossPrice, sellCrossPrice, buyBestCrossPrice, sellBestCrossPrice, maxCrossVolume=-1): 
+    def __crossStopOrder(self, symbol, dtAsOf, buyCrossPrice, sellCrossPrice, buyBestCrossPrice, sellBestCrossPrice,
+                         buyTriggerPrice, sellTriggerPrice, openPrice=0, maxCrossVolume=-1): 
         """基于最新数据撮合停止单
             A stop order is an order to buy or sell a security when its price moves past
             a particular point, ensuring a higher probability of achieving a predetermined 
             entry or exit price, limiting the investor's loss or locking in a profit. Once 
             the price crosses the predefined entry/exit point, the stop order becomes a
             market order.
+        the triggered stops are found by a binary search on the trigger prices of the symbol, a stop is not triggered if
+        its side could not be filled, such as at the price limit
         """
+        trades = []
+        finishedOrders = []
+
         if not dtAsOf:
             dtAsOf  = self.datetimeAsOfMarket()
 
-        # TODO implement StopOrders
-        #########################################################
-        # # 遍历停止单字典中的所有停止单
-        # with self._nest. _lock:
-        #     for stopOrderID, so in self._nest._dictStopOrders.items():
-        #         if order.symbol != symbol:
-        #             continue
-
-        #         # 判断是否会成交
-        #         buyCross  = (so.direction==OrderData.DIRECTION_LONG)  and so.price<=buyCrossPrice
-        #         sellCross = (so.direction==OrderData.DIRECTION_SHORT) and so.price>=sellCrossPrice
-                
-        #         # 忽略未发生成交
-        #         if not buyCross and not sellCross : # and (so.volume < maxCrossVolume):
-        #             continue;
-
-        #         # 更新停止单状态，并从字典中删除该停止单
-        #         so.status = OrderData.STOPORDER_TRIGGERED
-        #         if stopOrderID in self._dictStopOrders:
-        #             del self._dictStopOrders[stopOrderID]                        
-
-        #         # 推送成交数据
-        #         self.tdDriver.tradeCount += 1            # 成交编号自增1
-        #         tradeID = str(self.tdDriver.tradeCount)
-        #         trade = VtTradeData()
-        #         trade.vtSymbol = so.vtSymbol
-        #         trade.tradeID = tradeID
-        #         trade.vtTradeID = tradeID
-                    
-        #         if buyCross:
-        #             self.strategy.pos += so.volume
-        #             trade.price = max(bestCrossPrice, so.price)
-        #         else:
-        #             self.strategy.pos -= so.volume
-        #             trade.price = min(bestCrossPrice, so.price)                
-                    
-        #         self.tdDriver.limitOrderCount += 1
-        #         orderID = str(self.tdDriver.limitOrderCount)
-        #         trade.orderID = orderID
-        #         trade.vtOrderID = orderID
-        #         trade.direction = so.direction
-        #         trade.offset = so.offset
-        #         trade.volume = so.volume
-        #         trade.tradeTime = self.__dtLastData.strftime('%H:%M:%S')
-        #         trade.dt = self.__dtLastData
-                    
-        #         self._dictTrades[tradeID] = trade
-                    
-        #         # 推送委托数据
-        #         order = VtOrderData()
-        #         order.vtSymbol = so.vtSymbol
-        #         order.symbol = so.vtSymbol
-        #         order.orderID = orderID
-        #         order.vtOrderID = orderID
-        #         order.direction = so.direction
-        #         order.offset = so.offset
-        #         order.price = so.price
-        #         order.totalVolume = so.volume
-        #         order.tradedVolume = so.volume
-        #         order.status = OrderData.STATUS_ALLTRADED
-        #         order.orderTime = trade.tradeTime
-                    
-        #         self.tdDriver.limitOrderDict[orderID] = order
-                    
-        #         self._account.onTrade(trade)
+        with self._nest._lock:
+            self.__syncOrderIndex()
+            triggered = self.__stopIdx.popTriggered(symbol, buyTriggerPrice if buyCrossPrice >0 else 0, sellTriggerPrice if sellCrossPrice >0 else 0,
+                                                    self._nest._dictStopOrders)
+            for so, buyCross in triggered:
+                # 停止单触发后按市价成交
+                bestCrossPrice = buyBestCrossPrice if buyCross else sellBestCrossPrice
+                trade = self.__fakeTrade(so, StopTriggerIndex.fillPrice(so, buyCross, bestCrossPrice, openPrice), dtAsOf)
+                trades.append(trade)
+                finishedOrders.append(so)
+
+        if len(finishedOrders) >0 and self.__logEnabled(logging.INFO):
+            self.info('crossStopOrder() triggered %d stops: %s'% (len(finishedOrders), ''.join(['O[%s]->T[%s],' % (o.desc, t.desc) for o, t in zip(finishedOrders, trades)])))
 
-        #         # 按照顺序推送数据
-        #         self.strategy.onStopOrder(so)
-        #         self.strategy.onOrder(order)
-        #         self.strategy.onTrade(trade)
+        for o in finishedOrders:
+            self._broker_onOrderDone(o)
+            
+        for t in trades:
+            self._broker_onTrade(t)
 
     def OnPlaybackEnd(self) :
         # ---------------------------
@@ -2423,7 +2482,7 @@ class ShortSwingScanner(OfflineSimulator):
 
         for ev in eventsOfDay:
             stateD4f = ev['stateD4f']
-            if not stateD4f or len(stateD4f) <=0:
+            if stateD4f is None or len(stateD4f) <=0:
                 continue
 
             price = ev['price']
@@ -46,6 +46,13 @@ class TradeAdvisor(BaseApplication):
         self._exchange         = self.getConfig('exchange', 'AShare')
         self.__recMarketEvent  = self.getConfig('recMarketEvent', 'False').lower() in BOOL_STRVAL_TRUE
         self.__intvSS_min      = self.getConfig('intvSafeStore', 10) # in minutes, <=0 to disable safestore
+        self._batchSize        = int(self.getConfig('batch/size', 1)) # max number of symbols to advise in a batch, <=1 to advise per event
+        self._batchWindow_ms   = int(self.getConfig('batch/msecWindow', 200)) # max milliseconds to collect a batch before advising
+
+        self.__pendingBatch = OrderedDict() # dict of symbol to (ev, latestAdvc, bTickDuplicated) waiting for the next batch
+        self.__fstampBatchStarted = None
+        self.__histBatchSize = {} # dict of batch size to count
+        self.__histBatchLatency = {} # dict of latency upper-bound in msec to count
 
         if not objectives or not isinstance(objectives, list) or len(objectives) <=0:
             objectives = self.getConfig('objectives', [])
@@ -76,6 +83,14 @@ class TradeAdvisor(BaseApplication):
     @property
     def recorder(self): return self._recorder
 
+    @property
+    def batchHistograms(self):
+        '''
+        @return (sizeHist, latencyHist) where sizeHist is a dict of batch-size to count, and latencyHist is a dict of
+                latency upper-bound in msec (power of 2) to count, the latency is taken from the first event queued till the advices posted
+        '''
+        return dict(self.__histBatchSize), dict(self.__histBatchLatency)
+
     def __saveMarketState(self) :
         if self.__intvSS_min <=0 : return
         try :
@@ -101,6 +116,21 @@ class TradeAdvisor(BaseApplication):
         '''
         return None
 
+    def generateAdvicesOnMarketEvents(self, mdEvents, lastAdvs):
+        '''processing a batch of MarketEvents of different symbols, the advisor may overwrite this to advise in one pass
+            @param lastAdvs the list of the references corresponding to mdEvents
+            @return the list of advices in the order of mdEvents, None on the item if no advice generated
+        '''
+        advices = []
+        for ev, lastAdv in zip(mdEvents, lastAdvs):
+            advice = None
+            try:
+                advice = self.generateAdviceOnMarketEvent(ev, lastAdv)
+            except Exception as ex:
+                self.error('call generateAdviceOnMarketEvent %s caught %s: %s' % (ev.desc, ex, traceback.format_exc()))
+            advices.append(advice)
+        return advices
+
     #----------------------------------------------------------------------
     # impl/overwrite of BaseApplication
     def doAppInit(self): # return True if succ
@@ -168,9 +198,16 @@ class TradeAdvisor(BaseApplication):
             if stampNow - self.__stampMStateSaved > saveInterval:
                 self.__stampMStateSaved = stampNow
                 self.__saveMarketState()
+
+        if self.__fstampBatchStarted and (datetime2float(datetime.now()) - self.__fstampBatchStarted) *1000 >= self._batchWindow_ms:
+            self.__flushBatch()
         
         return c+1
 
+    def stop(self):
+        self.__flushBatch() # the events pending in the batch would otherwise get no advice
+        super(TradeAdvisor, self).stop()
+
     def OnEvent(self, ev):
         '''
         dispatch the event
@@ -194,8 +231,6 @@ class TradeAdvisor(BaseApplication):
         if self._marketState:
             self._marketState.updateByEvent(ev)
 
-        fstamp = datetime2float(d.asof)
-        
         # repeat the tick to remote eventChannel if this advice is based on a tick, so that the Trader
         # who subscribe EVENT_ADVICEs does NOT have to instantiate a seperated crawler or others only in order to get the recent price
         bTickDuplicated = False
@@ -218,17 +253,59 @@ class TradeAdvisor(BaseApplication):
         #     objective['date'] = d.date
         #     # objective['ohlc'] = self.updateOHLC(None, d.open, d.high, d.low, d.close)
 
+        if self._batchSize <=1:
+            self.__adviseOnEvents([(ev, latestAdvc, bTickDuplicated)])
+            return
+
+        # collect the events into the pending batch, only the most recent event of a symbol is kept
+        if not self.__fstampBatchStarted:
+            self.__fstampBatchStarted = datetime2float(datetime.now())
+        self.__pendingBatch[symbol] = (ev, latestAdvc, bTickDuplicated)
+
+        if len(self.__pendingBatch) >= self._batchSize or (datetime2float(datetime.now()) - self.__fstampBatchStarted) *1000 >= self._batchWindow_ms:
+            self.__flushBatch()
+
+    def __flushBatch(self):
+        if len(self.__pendingBatch) <=0:
+            self.__fstampBatchStarted = None
+            return
+
+        batch = list(self.__pendingBatch.values())
+        self.__pendingBatch = OrderedDict()
+        self.__adviseOnEvents(batch)
+
+        latency_ms = (datetime2float(datetime.now()) - self.__fstampBatchStarted) *1000
+        self.__fstampBatchStarted = None
+
+        bucket =1
+        while bucket < latency_ms: bucket *=2
+        self.__histBatchSize[len(batch)] = self.__histBatchSize.get(len(batch), 0) +1
+        self.__histBatchLatency[bucket] = self.__histBatchLatency.get(bucket, 0) +1
+        self.debug('advised on a batch of %d events in %.1fmsec' % (len(batch), latency_ms))
+
+    def __adviseOnEvents(self, batch):
+        '''
+        @param batch list of (ev, latestAdvc, bTickDuplicated)
+        '''
         # step 2. # call each registed procedure to handle the incoming MarketEvent
-        newAdvice = None
+        advices = []
         try:
-            newAdvice = self.generateAdviceOnMarketEvent(ev, latestAdvc)
+            advices = self.generateAdvicesOnMarketEvents([i[0] for i in batch], [i[1] for i in batch])
         except Exception as ex:
-            self.error('call generateAdviceOnMarketEvent %s caught %s: %s' % (ev.desc, ex, traceback.format_exc()))
+            self.error('call generateAdvicesOnMarketEvents on %d events caught %s: %s' % (len(batch), ex, traceback.format_exc()))
+
+        for i in range(len(batch)):
+            ev, latestAdvc, bTickDuplicated = batch[i]
+            self.__postAdvice(ev, latestAdvc, advices[i] if i < len(advices) else None, bTickDuplicated)
 
+    def __postAdvice(self, ev, latestAdvc, newAdvice, bTickDuplicated):
         if not newAdvice:
             self.debug('ignored NULL advice on event[%s]' % (ev.desc))
             return
 
+        d = ev.data
+        symbol = d.vtSymbol.split('.')[0]
+        fstamp = datetime2float(d.asof)
         dir = newAdvice.dirString() # generate the dirString to ease reading
         
         newAdvice.advisorId = '%s@%s' %(self.ident, self.program.hostname)
@@ -274,8 +351,6 @@ class TradeAdvisor(BaseApplication):
         # MUST record the advice anyway
         self._recorder.pushRow(EVENT_ADVICE, newAdvice)
 
-        return
-
     # end of BaseApplication routine
     #----------------------------------------------------------------------
 
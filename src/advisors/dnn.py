@@ -96,6 +96,7 @@ class DnnAdvisor_S1548I4A3(TradeAdvisor):
         self._brainId   = self.getConfig('brainId', "default")
         self._processor = self.getConfig('processor', None)
         self._brain     = None
+        self._floatstates = np.zeros((max(1, self._batchSize), DnnAdvisor_S1548I4A3.STATE_DIMS), dtype=NN_FLOAT) # reused buffer to export the states into
 
     @property
     def ident(self) :
@@ -105,7 +106,49 @@ class DnnAdvisor_S1548I4A3(TradeAdvisor):
         '''processing an incoming MarketEvent and generate an advice
             @param lastAdv is a reference in the case the advisor wish to refer to 
         '''
+        return self.generateAdvicesOnMarketEvents([ev], [lastAdv])[0]
 
+    def generateAdvicesOnMarketEvents(self, mdEvents, lastAdvs):
+        '''stack the states of the symbols into a matrix and predict them by calling the brain once
+        '''
+        advices = [None] * len(mdEvents)
+        if self._floatstates.shape[0] < len(mdEvents):
+            self._floatstates = np.zeros((len(mdEvents), DnnAdvisor_S1548I4A3.STATE_DIMS), dtype=NN_FLOAT)
+
+        rows = [] # the index of mdEvents of each row of self._floatstates
+        for i in range(len(mdEvents)):
+            ev = mdEvents[i]
+            symbol = self.__symbolToPredict(ev, lastAdvs[i])
+            if not symbol:
+                continue
+
+            floatstate = self._marketState.exportKLFloats(symbol, out=self._floatstates[len(rows)], incremental=True)
+            if not floatstate.any():
+                self.debug('generateAdviceOnMarketEvent() rack of marketState on %s' % ev.desc)
+                continue # skip advising pirior to plenty state data
+
+            rows.append(i)
+
+        if len(rows) <=0:
+            return advices
+
+        act_values = self._brain.predict(self._floatstates[:len(rows)])
+        for r in range(len(rows)):
+            ev = mdEvents[rows[r]]
+            d = ev.data
+            # action = [0.0] * DnnAdvisor_S1548I4A3.ACTION_DIMS
+            # idxAct = np.argmax(act_values[r])
+            # action[idxAct] = 1.0
+            advice = AdviceData(self.ident, d.vtSymbol.split('.')[0], d.exchange)
+            advice.dirNONE, advice.dirLONG, advice.dirSHORT = act_values[r][0], act_values[r][1], act_values[r][2]
+            advice.price = d.close if EVENT_KLINE_PREFIX == ev.type[:len(EVENT_KLINE_PREFIX)] else d.price
+            advices[rows[r]] = advice
+
+        return advices
+
+    def __symbolToPredict(self, ev, lastAdv):
+        '''@return the symbol of the event if it is necessary to predict on, otherwise None
+        '''
         if MARKETDATE_EVENT_PREFIX != ev.type[:len(MARKETDATE_EVENT_PREFIX)] :
             self.debug('generateAdviceOnMarketEvent() ignored event %s' % ev.type)
             return None
@@ -125,21 +168,7 @@ class DnnAdvisor_S1548I4A3(TradeAdvisor):
                 self.debug('generateAdviceOnMarketEvent() recently adviced %ss ago, skip predicting on event: %s' % (secAgo, ev.desc))
                 return None
 
-        floatstate = self._marketState.exportKLFloats(symbol)
-        if all(v == 0.0 for v in floatstate):
-            self.debug('generateAdviceOnMarketEvent() rack of marketState on %s' % ev.desc)
-            return None # skip advising pirior to plenty state data
-
-        floatstate = np.array(floatstate).astype(NN_FLOAT).reshape(1, DnnAdvisor_S1548I4A3.STATE_DIMS)
-        act_values = self._brain.predict(floatstate)
-        # action = [0.0] * DnnAdvisor_S1548I4A3.ACTION_DIMS
-        # idxAct = np.argmax(act_values[0])
-        # action[idxAct] = 1.0
-        advice = AdviceData(self.ident, symbol, d.exchange)
-        advice.dirNONE, advice.dirLONG, advice.dirSHORT = act_values[0][0], act_values[0][1], act_values[0][2]
-        advice.price = d.close if EVENT_KLINE_PREFIX == ev.type[:len(EVENT_KLINE_PREFIX)] else d.price
-
-        return advice
+        return symbol
 
     #----------------------------------------------------------------------
     # impl/overwrite of BaseApplication
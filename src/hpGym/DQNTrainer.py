@@ -34,6 +34,7 @@ import numpy as np
 DUMMY_BIG_VAL = 999999
 NN_FLOAT = 'float32'
 RFGROUP_PREFIX = 'ReplayFrame:'
+FRAME_MASK = '_mask'
 
 # GPUs = backend.tensorflow_backend._get_available_gpus()
 def get_available_gpus():
@@ -163,6 +164,7 @@ class MarketDirClassifier(BaseApplication):
         self._evaluateSamples     = self.getConfig('evaluateSamples', 'yes').lower() in BOOL_STRVAL_TRUE
         self._preBalanced         = self.getConfig('preBalanced',      'no').lower() in BOOL_STRVAL_TRUE
         self._evalAt              = self.getConfig('evalAt', 5) # how often on trains to perform evaluation
+        self._readAheadProcs      = int(self.getConfig('readAheadProcesses', 0)) # >0 to read ahead by processes instead of a thread
 
         # self._nonTrainables       = self.getConfig('nonTrainables',  ['VClz512to20.1of2', 'VClz512to20.2of2']) # non-trainable layers
         # self._nonTrainables       = [x('') for x in self._nonTrainables] # convert to string list
@@ -213,6 +215,9 @@ class MarketDirClassifier(BaseApplication):
         self.__recycledChunks =[]
         self.__convertFrame = self.__frameToBatchs
         self.__filterFrame  = None if self._preBalanced else self.__balanceSamples
+        self.__frameReaders = threading.local() # the ReplayFrameReader of each read-ahead thread, whose buffers are reused across frames
+        self.__readAheadPool = None
+        self.__samplesFrom = []
 
         self.__latestBthNo=0
         self.__totalAccu, self.__totalEval, self.__totalSamples, self.__stampRound = 0.0, 0, 0, datetime.now()
@@ -262,6 +267,12 @@ class MarketDirClassifier(BaseApplication):
         self.__nextFrameName(False) # probe the dims of state/action from the h5 file
         self.__maxChunks = max(int(self._frameSize/self._batchesPerTrain /self._batchSize), 1) # minimal 8K samples to at least cover a frame
 
+        if self._readAheadProcs >0:
+            self.__readAheadPool = hist.ReplayFrameReadAhead({'state': self._stateSize, 'action': self._actionSize}, self._batchSize, processes=self._readAheadProcs,
+                slots=self._batchesPerTrain *(2 +self._readAheadProcs), dtype=NN_FLOAT, balance=not self._preBalanced)
+            self.__readAheadPool.start()
+            self.info('started %d read-ahead processes' % self._readAheadProcs)
+
         if self._model_json:
             if len(GPUs) <= 1:
                 self._brain = model_from_json(self._model_json)
@@ -347,6 +358,12 @@ class MarketDirClassifier(BaseApplication):
 
         return True
 
+    def stop(self):
+        if self.__readAheadPool:
+            self.__readAheadPool.stop()
+            self.__readAheadPool = None
+        super(MarketDirClassifier, self).stop()
+
     def doAppStep(self):
         if not self._stepMethod:
             self.stop()
@@ -598,6 +615,9 @@ class MarketDirClassifier(BaseApplication):
         '''
         @return chunk, bRecycledData   - bRecycledData=True if it is from the recycled data
         '''
+        if self.__readAheadPool:
+            return self.__nextChunkFromReadAhead()
+
         ret = None
         with self.__lock:
             if self.__newChunks and len(self.__newChunks) >0:
@@ -666,7 +686,62 @@ class MarketDirClassifier(BaseApplication):
         self.info('nextDataChunk() pool refreshed: %s x(%s samples/bth) from %s; started reading %s+ chunks ahead, recycled-size:%s' % (newsize, self._batchSize, ','.join(self.__samplesFrom), self._batchesPerTrain, szRecycled))
         return ret, bRecycled
 
+    def __nextChunkFromReadAhead(self):
+        '''
+        the nextDataChunk() by the read-ahead processes, which keeps the same recycle semantics as the read-ahead thread
+        @return chunk, bRecycledData
+        '''
+        self.__submitReadAhead()
+        bth, frameTag = self.__readAheadPool.get(timeout=0)
+        if bth is None:
+            with self.__lock:
+                if self._recycleSize>0 and len(self.__recycledChunks) >0:
+                    ret = self.__recycledChunks[0]
+                    del self.__recycledChunks[0]
+                    self.__recycledChunks.append(ret)
+                    return ret, True
+
+            self.warn('nextDataChunk() no readAhead ready, waiting for the read-ahead processes')
+
+        # the pending frames may all be done without a batch, such as shorter than a batch or failed to read, so more
+        # frames are submitted until a batch arrives. the frames are taken round by round, thus an empty frame seen again
+        # means none of the frames gives a batch
+        emptyFrames = set()
+        while True:
+            for frameTag, lenFrame, cBths, err in self.__readAheadPool.framesDone():
+                self.__samplesFrom = (self.__samplesFrom + [frameTag])[-self._batchesPerTrain:]
+                if err:
+                    self.error('readAhead failed to read %s: %s' % (frameTag, err))
+                else:
+                    self.debug('readAhead read %s samples of %s into %s batches, %d frames await' % (lenFrame, frameTag, cBths, len(self._frameSeq)))
+
+                if bth is None and cBths <=0:
+                    if frameTag in emptyFrames:
+                        raise ValueError('nextDataChunk() none of the ReplayFrames gives a batch of %s samples' % self._batchSize)
+                    emptyFrames.add(frameTag)
+
+            if bth is not None:
+                break
+
+            self.__submitReadAhead()
+            bth, frameTag = self.__readAheadPool.get()
+
+        with self.__lock:
+            self.__recycledChunks.append(bth)
+            if len(self.__recycledChunks) >= ((1+self._recycleSize) *self._batchesPerTrain):
+                random.shuffle(self.__recycledChunks)
+                del self.__recycledChunks[(self._recycleSize *self._batchesPerTrain):]
+
+        return bth, False
+
+    def __submitReadAhead(self):
+        # keep the read-ahead processes busy with twice the frames of them
+        while self.__readAheadPool.pendingFrames < self._readAheadProcs *2:
+            h5fileName, nextFrameName, awaitSize = self.__nextFrameName(True)
+            self.__readAheadPool.submit(h5fileName, RFGROUP_PREFIX + nextFrameName)
+
     def __frameToSlices(self, frameDict):
+        frameDict = self.__selectedRows(frameDict)
         framelen = 1
         for k,v in frameDict.items():
             framelen = len(v)
@@ -686,6 +761,7 @@ class MarketDirClassifier(BaseApplication):
         return slices
 
     def __frameToDatasets(self, frameDict):
+        frameDict = self.__selectedRows(frameDict)
         framelen = 1
         for k,v in frameDict.items():
             framelen = len(v)
@@ -706,63 +782,29 @@ class MarketDirClassifier(BaseApplication):
 
         return datasets
 
-    def __frameToBatchs(self, frameDict):
-        COLS = ['state','action']
-        framelen = len(frameDict[COLS[0]])
-        
-        # to shuffle within the frame
-        shuffledIndx =[i for i in range(framelen)]
-        random.shuffle(shuffledIndx)
-
-        bths = []
-        cBth = framelen // self._batchSize
-        for i in range(cBth):
-            batch = {}
-            for col in COLS :
-                # batch[col] = np.array(frameDict[col][self._batchSize*i: self._batchSize*(i+1)]).astype(NN_FLOAT)
-                batch[col] = np.array([frameDict[col][j] for j in shuffledIndx[self._batchSize*i: self._batchSize*(i+1)]]).astype(NN_FLOAT)
-            
-            bths.append(batch)
+    def __selectedRows(self, frameDict):
+        '''
+        @return the frameDict of only the rows selected by __balanceSamples()
+        '''
+        if not FRAME_MASK in frameDict.keys():
+            return frameDict
+        mask = frameDict[FRAME_MASK]
+        return { col: v[mask] for col, v in frameDict.items() if col != FRAME_MASK }
 
-        return bths
+    def __frameToBatchs(self, frameDict):
+        # to shuffle within the frame by a permutation and fancy-index the batches, which are copies of the reader's buffers
+        mask = frameDict.get(FRAME_MASK, None)
+        cols = { col: frameDict[col] for col in ['state','action'] }
+        return hist.ReplayFrameReader.toBatches(cols, self._batchSize, mask)
 
     def __balanceSamples(self, frameDict) :
         '''
             balance the samples, usually reduce some action=HOLD, which appears too many
+            the rows to keep are marked in frameDict[FRAME_MASK] instead of being deleted
         '''
-        actionchunk = np.array(frameDict['action'])
-        # AD = np.where(actionchunk >=0.99) # to match 1 because action is float read from RFrames
-        # kI = [np.count_nonzero(AD[1] ==i) for i in range(3)] # counts of each actions in frame
-
-        # cRowToKeep = max(kI[1:]) + sum(kI[1:]) # = max(kI[1:]) *3
-        # # cRowToKeep = int(sum(kI[1:]) /2 *3 +1)
-
-        # # round up by batchSize
-        # if self._batchSize >0:
-        #     cRowToKeep = int((cRowToKeep + self._batchSize/2) // self._batchSize) *self._batchSize
-            
-        # idxHolds = np.where(AD[1] ==0)[0].tolist()
-        # cHoldsToDel = len(idxHolds) - (cRowToKeep - sum(kI[1:]))
-        # if cHoldsToDel>0 :
-        #     random.shuffle(idxHolds)
-        #     del idxHolds[cHoldsToDel:]
-        #     frameDict['action'] = np.delete(frameDict['action'], idxHolds, axis=0)
-        #     frameDict['state']  = np.delete(frameDict['state'],  idxHolds, axis=0)
-
-        AD = np.where(actionchunk >=0.99) # to match 1 because action is float read from RFrames
-        kI = [np.count_nonzero(AD[1] ==i) for i in range(3)] # counts of each actions in frame
-        kImax = max(kI)
-        idxMax = kI.index(kImax)
-        cToReduce = kImax - int(1.6*(sum(kI) -kImax))
-        if cToReduce >0:
-            idxItems = np.where(AD[1] ==idxMax)[0].tolist()
-            random.shuffle(idxItems)
-            del idxItems[cToReduce:]
-            idxToDel = [lenBefore +i for i in idxItems]
-            frameDict['action'] = np.delete(frameDict['action'], idxToDel, axis=0)
-            frameDict['state']  = np.delete(frameDict['state'], idxToDel, axis=0)
-
-        return len(frameDict['action'])
+        mask = hist.ReplayFrameReader.balanceMask(frameDict['action'])
+        frameDict[FRAME_MASK] = mask
+        return int(np.count_nonzero(mask))
 
     def __nextFrameName(self, bPop1stFrameName=False):
         '''
@@ -841,19 +883,18 @@ class MarketDirClassifier(BaseApplication):
     def readFrame(self, h5fileName, frameName):
         '''
         read a frame from H5 file
+        @return dict of {col: ndarray}, which are the views of the reader's buffers valid until the next readFrame() of the thread
         '''
-        COLS = ['state','action']
         frameDict ={}
         try :
             # reading the frame from the h5
             self.debug('readAhead() reading %s of %s' % (frameName, h5fileName))
-            with h5py.File(h5fileName, 'r') as h5f:
-                frame = h5f[RFGROUP_PREFIX + frameName]
+            reader = getattr(self.__frameReaders, 'reader', None)
+            if not reader:
+                reader = hist.ReplayFrameReader(cols=['state','action'], dtype=NN_FLOAT)
+                self.__frameReaders.reader = reader
 
-                for col in COLS :
-                    if col in frameDict.keys():
-                        frameDict[col] += list(frame[col])
-                    else : frameDict[col] = list(frame[col])
+            frameDict = reader.read(h5fileName, RFGROUP_PREFIX + frameName)
         except Exception as ex:
             self.logexception(ex)
 
@@ -881,6 +922,7 @@ class MarketDirClassifier(BaseApplication):
                 self.debug('readAhead(%s) converted %s samples of %s@%s into %s chunks' % (thrdSeqId, lenFrame, nextFrameName, h5fileName, len(cvnted)) )
         except Exception as ex:
             self.logexception(ex)
+            cvnted = { k: v.copy() for k, v in frameDict.items() } # the views would be overwritten by the next readFrame() of the thread
 
         addSize, raSize=0, 0
         with self.__lock:
@@ -933,6 +975,7 @@ class MarketDirClassifier(BaseApplication):
                     cvnted = self.__convertFrame(frameDict)
             except Exception as ex:
                 self.logexception(ex)
+                cvnted = { k: v.copy() for k, v in frameDict.items() } # the views would be overwritten by the next readFrame() of the thread
 
             self.debug('readAheadChunks(%s) filtered %s from %s samples and converted into %s chunks' % (thrdSeqId, nAfterFilter, lenFrame, len(cvnted)) )
 
@@ -983,6 +1026,7 @@ class MarketDirClassifier(BaseApplication):
 
             statebths, actionbths =[], []
             cFresh, cRecycled = 0, 0
+            stampWait = datetime.now()
             while len(statebths) < self._batchesPerTrain :
                 bth, recycled = self.nextDataChunk() #= self.readDataChunk(idxBatchInPool)
                 if recycled:
@@ -997,6 +1041,7 @@ class MarketDirClassifier(BaseApplication):
             # continue # if only test read-ahead and pool making-up   #
             #----------------------------------------------------------
 
+            stalled = datetime.now() - stampWait # the time that the trainer waits for the samples
             cBths = len(statebths)
             if cBths < self._batchesPerTrain:
                 continue
@@ -1070,10 +1115,10 @@ class MarketDirClassifier(BaseApplication):
 
             strEpochs = '+'.join([str(i) for i in lstEpochs])
             if sampledAhead:
-                self.__logAndSaveResult(histEpochs[-1], 'doAppStep_local_generator', '%s%s/%s steps x%s epochs on %dN+%dR samples %.2f%%ov%s took %s, hist: %s' % (strEval, trainSize, self._batchSize, strEpochs, cFresh, cRecycled, self.__totalAccu*100.0/(1+self.__totalEval), self.__totalSamples, (datetime.now() -stampStart), ', '.join(histEpochs)) )
+                self.__logAndSaveResult(histEpochs[-1], 'doAppStep_local_generator', '%s%s/%s steps x%s epochs on %dN+%dR samples %.2f%%ov%s took %s stalled %s, hist: %s' % (strEval, trainSize, self._batchSize, strEpochs, cFresh, cRecycled, self.__totalAccu*100.0/(1+self.__totalEval), self.__totalSamples, (datetime.now() -stampStart), stalled, ', '.join(histEpochs)) )
                 skippedSaves =0
             else :
-                self.info('doAppStep_local_generator() %s epochs on recycled %dN+%dR samples took %s, hist: %s' % (strEpochs, cFresh, cRecycled, (datetime.now() -stampStart), ', '.join(histEpochs)) )
+                self.info('doAppStep_local_generator() %s epochs on recycled %dN+%dR samples took %s stalled %s, hist: %s' % (strEpochs, cFresh, cRecycled, (datetime.now() -stampStart), stalled, ', '.join(histEpochs)) )
                 skippedSaves +=1
     
     #----------------------------------------------------------------------
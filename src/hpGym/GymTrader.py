@@ -448,8 +448,8 @@ class GymTrader(BaseTrader):
     #------------------------------------------------
 
     def makeupGymObservation(self):
-        market_state = self._marketState.exportKLFloats(self._tradeSymbol)
-        return np.array(market_state).astype(GymTrader.NN_FLOAT)
+        market_state = self._marketState.exportKLFloats(self._tradeSymbol, incremental=True)
+        return np.array(market_state).astype(GymTrader.NN_FLOAT) # copy the cached state as the observation
 
     def makeupGymObservation_0(self):
         '''Concatenate all necessary elements to create the observation.
@@ -487,7 +487,7 @@ class GymTrader(BaseTrader):
         account_state = np.concatenate([stateCapital + statePOS], axis=0)
 
         # part 2. build up the market_state
-        market_state = self._marketState.exportKLFloats(self._tradeSymbol)
+        market_state = self._marketState.exportKLFloats(self._tradeSymbol, incremental=True)
 
         # TODO: more observations in the future could be:
         #  - money flow
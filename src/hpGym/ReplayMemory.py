@@ -0,0 +1,273 @@
+# encoding: UTF-8
+
+'''
+The replay memory of the gym agents, which keeps the observations (state, action, reward, next_state, done) in
+preallocated columns instead of a list of tuples
+'''
+import numpy as np
+
+NEXT_PENDING = -1 # the next_state of the latest observation that is not yet known to be the state of the following one
+
+########################################################################
+class ReplayMemory(object):
+    '''
+    The columnar replay memory as a ring of capacity observations
+        - the insert is O(1) into the preallocated float32 columns
+        - the next_state is usually the state of the following observation, so it is kept as a reference to that slot.
+          only when the chain breaks, such as at the end of an episode, the next_state is copied into a small ring of tails
+        - the batch is sampled by a vector of indices and gathered into the reused batch buffers, which are handed
+          to fit()/predict() without further conversion
+    '''
+    def __init__(self, capacity, stateSize, actionSize, tailCapacity=0, dtype='float32'):
+        self._capacity = int(capacity)
+        self._stateSize, self._actionSize = int(stateSize), int(actionSize)
+        self._dtype = np.dtype(dtype)
+
+        self._states  = np.zeros((self._capacity, self._stateSize), dtype=self._dtype)
+        self._actions = np.zeros((self._capacity, self._actionSize), dtype=self._dtype)
+        self._rewards = np.zeros(self._capacity, dtype=self._dtype)
+        self._dones   = np.zeros(self._capacity, dtype=bool)
+        self._nextRef = np.full(self._capacity, NEXT_PENDING, dtype=np.int64) # >=0 the slot in _states, <-1 the -2-k of _tails[k]
+        self._valid   = np.zeros(self._capacity, dtype=bool)
+
+        self._tailCapacity = int(tailCapacity) if tailCapacity and tailCapacity >0 else max(64, self._capacity //32)
+        self._tails     = np.zeros((self._tailCapacity, self._stateSize), dtype=self._dtype)
+        self._tailOwner = np.full(self._tailCapacity, -1, dtype=np.int64)
+        self._tailCursor = 0
+
+        self._pendingNext = np.zeros(self._stateSize, dtype=self._dtype)
+        self._cursor, self._size, self._latest = 0, 0, -1
+        self._cInvalid = 0
+        self._pushes = 0
+
+        self.__rng = np.random.default_rng()
+        self.__bthBuffers = {} # batchSize -> the reused batch buffers
+
+    @property
+    def capacity(self) : return self._capacity
+
+    @property
+    def size(self) : return self._size
+
+    @property
+    def isFull(self) : return self._size >= self._capacity
+
+    @property
+    def cursor(self) :
+        '''@return the slot that the next push() will write'''
+        return self._cursor
+
+    @property
+    def nbytes(self) :
+        return sum([a.nbytes for a in [self._states, self._actions, self._rewards, self._dones, self._nextRef, self._valid, self._tails, self._tailOwner]])
+
+    def push(self, state, action, reward, next_state, done) :
+        '''
+        @return the slot of the observation
+        '''
+        state = np.asarray(state, dtype=self._dtype).reshape(self._stateSize)
+        slot = self._cursor
+
+        # resolve the next_state of the previous observation
+        if self._latest >=0 and self._nextRef[self._latest] == NEXT_PENDING:
+            if not self._dones[self._latest] and np.array_equal(state, self._pendingNext):
+                self._nextRef[self._latest] = slot
+            else :
+                self.__saveTail(self._latest)
+
+        # the observation that is being overwritten no longer owns its tail
+        if self._nextRef[slot] < NEXT_PENDING and self._tailOwner[-2 -self._nextRef[slot]] == slot:
+            self._tailOwner[-2 -self._nextRef[slot]] = -1
+        if self._size >= self._capacity and not self._valid[slot]:
+            self._cInvalid -=1
+
+        self._states[slot]  = state
+        self._actions[slot] = np.asarray(action, dtype=self._dtype).reshape(self._actionSize)
+        self._rewards[slot] = reward
+        self._dones[slot]   = bool(done)
+        self._nextRef[slot] = NEXT_PENDING
+        self._valid[slot]   = True
+        self._pendingNext[:] = np.asarray(next_state, dtype=self._dtype).reshape(self._stateSize)
+
+        self._latest = slot
+        self._cursor = (slot +1) % self._capacity
+        if self._size < self._capacity: self._size +=1
+        self._pushes +=1
+        return slot
+
+    def __saveTail(self, slot) :
+        k = self._tailCursor
+        self._tailCursor = (k +1) % self._tailCapacity
+        owner = self._tailOwner[k]
+        if owner >=0 and self._nextRef[owner] == -2 -k and self._valid[owner]:
+            # the tail is being reused before its owner is evicted, so the owner has no next_state any more
+            self._valid[owner] = False
+            self._cInvalid +=1
+            self._onInvalidated(owner)
+
+        self._tails[k] = self._pendingNext
+        self._tailOwner[k] = slot
+        self._nextRef[slot] = -2 -k
+
+    def _onInvalidated(self, slot) :
+        '''
+        the hook when an observation lost its next_state and is no more to sample
+        '''
+        pass
+
+    def sample(self, batchSize) :
+        '''
+        sample a batch without replacement
+        @return tuple of the sampled batch (state_batch, action_batch, reward_batch, next_state_batch, done_batch), whose
+                arrays are reused by the next sample() of the same batchSize, or Nones if not enough observations
+        '''
+        if self._size - self._cInvalid < batchSize:
+            return None, None, None, None, None
+
+        if self._cInvalid >0:
+            idxs = self.__rng.choice(np.flatnonzero(self._valid[:self._size]), batchSize, replace=False)
+        else :
+            idxs = self.__rng.choice(self._size, batchSize, replace=False)
+
+        return self.gather(idxs)
+
+    def gather(self, idxs) :
+        '''
+        gather the observations of the given slots into the batch buffers
+        '''
+        n = len(idxs)
+        if not n in self.__bthBuffers.keys():
+            self.__bthBuffers[n] = (
+                np.empty((n, self._stateSize), dtype=self._dtype),
+                np.empty((n, self._actionSize), dtype=self._dtype),
+                np.empty(n, dtype=self._dtype),
+                np.empty((n, self._stateSize), dtype=self._dtype),
+                np.empty(n, dtype=bool))
+
+        state_batch, action_batch, reward_batch, next_state_batch, done_batch = self.__bthBuffers[n]
+        np.take(self._states,  idxs, axis=0, out=state_batch)
+        np.take(self._actions, idxs, axis=0, out=action_batch)
+        np.take(self._rewards, idxs, out=reward_batch)
+        np.take(self._dones,   idxs, out=done_batch)
+
+        self.__gatherNext(self._nextRef[idxs], next_state_batch)
+        return state_batch, action_batch, reward_batch, next_state_batch, done_batch
+
+    def __gatherNext(self, refs, out) :
+        linked = refs >=0
+        if linked.all():
+            np.take(self._states, refs, axis=0, out=out)
+            return
+
+        out[linked] = self._states[refs[linked]]
+        tailed = refs < NEXT_PENDING
+        out[tailed] = self._tails[-2 -refs[tailed]]
+        out[refs == NEXT_PENDING] = self._pendingNext
+
+    def columns(self) :
+        '''
+        @return the observations in the order of slots as (col_state, col_action, col_reward, col_next_state, col_done),
+                where col_state, col_action and col_reward are the views of the memory
+        '''
+        n = self._size
+        col_next_state = np.empty((n, self._stateSize), dtype=self._dtype)
+        self.__gatherNext(self._nextRef[:n], col_next_state)
+        return self._states[:n], self._actions[:n], self._rewards[:n], col_next_state, self._dones[:n].astype('int8')
+
+########################################################################
+class SumTree(object):
+    '''
+    The binary segment tree over the priorities of slots, which keeps the sums and the minimums of the subtrees
+    in arrays, so that both updating and proportional finding take O(log n) and are vectorized over a batch
+    '''
+    def __init__(self, capacity):
+        self._leaves = 1
+        while self._leaves < capacity:
+            self._leaves <<= 1
+
+        self._sums = np.zeros(2 *self._leaves, dtype=np.float64)
+        self._mins = np.full(2 *self._leaves, np.inf, dtype=np.float64) # the zero priorities are excluded from the minimum
+
+    @property
+    def total(self) : return self._sums[1]
+
+    @property
+    def minimum(self) : return self._mins[1]
+
+    def priorities(self, idxs) :
+        return self._sums[np.asarray(idxs) + self._leaves]
+
+    def update(self, idxs, priorities) :
+        nodes = np.asarray(idxs, dtype=np.int64) + self._leaves
+        priorities = np.asarray(priorities, dtype=np.float64)
+        self._sums[nodes] = priorities
+        self._mins[nodes] = np.where(priorities >0, priorities, np.inf)
+
+        nodes = np.unique(nodes >> 1)
+        while len(nodes) >0 and nodes[-1] >=1:
+            self._sums[nodes] = self._sums[2*nodes] + self._sums[2*nodes +1]
+            self._mins[nodes] = np.minimum(self._mins[2*nodes], self._mins[2*nodes +1])
+            if nodes[0] <=1: break
+            nodes = np.unique(nodes >> 1)
+
+    def find(self, values) :
+        '''
+        @return the slots where the prefix-sums of priorities reach the values
+        '''
+        values = np.minimum(np.asarray(values, dtype=np.float64), self.total *(1 -1e-12))
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self._leaves:
+            left = 2 *nodes
+            goRight = (values >= self._sums[left]) & (self._sums[left +1] >0)
+            values = values - self._sums[left] *goRight
+            nodes = left + goRight
+
+        return nodes - self._leaves
+
+########################################################################
+class PrioritizedReplayMemory(ReplayMemory):
+    '''
+    The replay memory that samples the observations in proportion to priority^alpha, where the priority is the
+    latest |TD-error|, and compensates the bias by the importance-sampling weights ((N*P(i))^-beta normalized by the max)
+    '''
+    def __init__(self, capacity, stateSize, actionSize, alpha=0.6, beta=0.4, betaIncrement=0.001, epsilon=0.01, **kwargs):
+        super(PrioritizedReplayMemory, self).__init__(capacity, stateSize, actionSize, **kwargs)
+        self._alpha, self._beta, self._betaIncrement, self._epsilon = alpha, beta, betaIncrement, epsilon
+        self._maxPriority = 1.0
+        self._tree = SumTree(self._capacity)
+        self.__rng = np.random.default_rng()
+
+    @property
+    def beta(self) : return self._beta
+
+    def push(self, state, action, reward, next_state, done) :
+        slot = super(PrioritizedReplayMemory, self).push(state, action, reward, next_state, done)
+        self._tree.update([slot], [self._maxPriority]) # the new observation is sampled at least once soon
+        return slot
+
+    def _onInvalidated(self, slot) :
+        self._tree.update([slot], [0.0])
+
+    def samplePrioritized(self, batchSize) :
+        '''
+        sample a batch in proportion to the priorities, by one random value in each of batchSize equal segments
+        @return tuple (state_batch, action_batch, reward_batch, next_state_batch, done_batch, idxs, weights), or Nones
+        '''
+        cValid = self._size - self._cInvalid
+        if cValid < batchSize or self._tree.total <=0:
+            return None, None, None, None, None, None, None
+
+        segment = self._tree.total / batchSize
+        idxs = self._tree.find((np.arange(batchSize) + self.__rng.random(batchSize)) *segment)
+
+        probs = self._tree.priorities(idxs) / self._tree.total
+        maxWeight = (cValid *self._tree.minimum /self._tree.total) ** -self._beta
+        weights = ((cValid *probs) ** -self._beta / maxWeight).astype(self._dtype)
+        self._beta = min(1.0, self._beta + self._betaIncrement)
+
+        return self.gather(idxs) + (idxs, weights)
+
+    def updatePriorities(self, idxs, tdErrors) :
+        priorities = (np.abs(np.asarray(tdErrors, dtype=np.float64)) + self._epsilon) ** self._alpha
+        self._maxPriority = max(self._maxPriority, float(priorities.max()))
+        self._tree.update(idxs, priorities)
@@ -8,7 +8,9 @@ Do not hesitate to run several times and/or tweak parameters to get better resul
 Inspired from https://github.com/keon/deep-q-learning
 '''
 from .GymTrader import GymTrader, MetaAgent
+from .ReplayMemory import ReplayMemory, PrioritizedReplayMemory
 from MarketData import EXPORT_FLOATS_DIMS
+from Application import BOOL_STRVAL_TRUE
 
 import random
 
@@ -70,7 +72,18 @@ class agentDQN(MetaAgent):
         if self.__replaySize >10240:
             self.__replaySize = 10240
 
-        self.__replayCache = [None] # * self._batchSize
+        # the prioritized replay samples in proportion to |TD-error|^priorityAlpha, and the bias is compensated by
+        # the importance-sampling weights whose exponent anneals from priorityBeta to 1 by priorityBetaIncrement per sampling
+        self._prioritizedReplay = str(self.getConfig('prioritizedReplay', 'no')).lower() in BOOL_STRVAL_TRUE
+        if self._prioritizedReplay:
+            self.__replayCache = PrioritizedReplayMemory(self.__replaySize, self._stateSize, self._actionSize, dtype=GymTrader.NN_FLOAT,
+                alpha         = float(self.getConfig('priorityAlpha', 0.6)),
+                beta          = float(self.getConfig('priorityBeta', 0.4)),
+                betaIncrement = float(self.getConfig('priorityBetaIncrement', 0.001)),
+                epsilon       = float(self.getConfig('priorityEpsilon', 0.01)))
+        else:
+            self.__replayCache = ReplayMemory(self.__replaySize, self._stateSize, self._actionSize, dtype=GymTrader.NN_FLOAT)
+        self._sampleIdxs, self._sampleWeights = None, None # the slots and the importance-sampling weights of the latest prioritized batch
         self.__sampleIdx = 0
         self.__realDataNum =0
         self.__frameNum =0
@@ -203,7 +216,7 @@ class agentDQN(MetaAgent):
         if not super(agentDQN, self).isReady():
             return False
             
-        return not None in self.__replayCache
+        return self.__replayCache.size >0
 
     @property
     def trainable(self):
@@ -342,6 +355,7 @@ class agentDQN(MetaAgent):
             reward_batch += (self._gamma * np.logical_not(done_batch) * Q_next_max) # arrary(sampleLen, 1)
 
             Q_target = self._brain.predict(state_batch)
+            tdErrors = reward_batch - Q_target[action_batch[0], action_batch[1]] # by the same predict pass
             Q_target[action_batch[0], action_batch[1]] = reward_batch # action =arrary(2,sampleLen)
 
             # x：输入数据。如果模型只有一个输入，那么x的类型是numpy array，如果模型有多个输入，那么x的类型应当为list，list的元素是对应于各个输入的numpy array
@@ -359,7 +373,8 @@ class agentDQN(MetaAgent):
             epochs =1
             if len(GPUs) > 0 and sampleLen >self._batchSize:
                 epochs = self._epochsPerObservOnGpu
-            self._loss = self._brain.fit(x=state_batch, y=Q_target, epochs=epochs, batch_size=self._batchSize, verbose=0, callbacks=self._fitCallbacks)
+            self._loss = self._brain.fit(x=state_batch, y=Q_target, sample_weight=self._sampleWeights, epochs=epochs, batch_size=self._batchSize, verbose=0, callbacks=self._fitCallbacks)
+            self._updatePriorities(tdErrors)
         return self._loss
 
     def _pushToReplay(self, state, action, reward, next_state, done):
@@ -368,34 +383,23 @@ class agentDQN(MetaAgent):
         @return True if warmed up and ready to train
         '''
         with self._lock:
-            self.__sampleIdx = self.__sampleIdx % self.__replaySize
-            if not self.__bWarmed and not None in self.__replayCache :
+            if not self.__bWarmed and self.__replayCache.size >0 : # not to wait for a full ring, the same start as before
                 self.__bWarmed = True
-                self.__sampleIdx =0
 
-            samplelen = len(self.__replayCache)
-            if 0 == self.__sampleIdx and samplelen > self._batchSize: 
+            samplelen = self.__replayCache.size
+            if 0 == self.__replayCache.cursor and samplelen > self._batchSize: 
                 self.__frameNum +=1
                 frameId = 'F%s' % (str(self.__frameNum).zfill(4))
                 if len(self._cbNewReplayFrame) >0:
-                    metrix = np.array(self.__replayCache)
-                    col_state      = np.concatenate(metrix[:, 0]).reshape(samplelen, self._stateSize)
-                    col_action     = np.concatenate(metrix[:, 1]).reshape(samplelen, self._actionSize)
-                    col_reward     = metrix[:, 2].astype('float32')
-                    col_next_state = np.concatenate(metrix[:, 3]).reshape(samplelen, self._stateSize)
-                    col_done       = [ 1 if i else 0 for i in metrix[:, 4]]
+                    col_state, col_action, col_reward, col_next_state, col_done = self.__replayCache.columns()
                     for cb in self._cbNewReplayFrame:
                         try:
                             cb(frameId, col_state, col_action, col_reward, col_next_state, col_done)
                         except Exception as ex:
                             self._gymTrader.logexception(ex)
 
-            if self.__sampleIdx >= samplelen :
-                self.__replayCache.append((state, action, reward, next_state, done))
-                self.__sampleIdx = samplelen
-            else :
-                self.__replayCache[self.__sampleIdx] = (state, action, reward, next_state, done)
-                self.__sampleIdx +=1
+            self.__replayCache.push(state, action, reward, next_state, done)
+            self.__sampleIdx = self.__replayCache.cursor
 
             if not self.__bWarmed:
                 self.__realDataNum =0
@@ -412,52 +416,25 @@ class agentDQN(MetaAgent):
            Process action_batch into a position vector
         @return tuple of the sampled batch:
             state_batch, action_batch, reward_batch, next_state_batch, done_batch
-        TODO: if sampling take loss-of-fit as priority to always keep those have most losses as high priorities to pop for next round,
-        the training could be more effictive. To get the loss of each sample within a fit-training, a source exmaple could be like:
-        https://stackoverflow.com/questions/57087047/how-to-get-loss-for-each-sample-within-a-batch-in-keras
-
-                model = keras.models.Sequential([
-                    keras.layers.Input(shape=(4,)),
-                    keras.layers.Dense(1)
-                ])
-
-                def examine_loss(y_true, y_pred):
-                    result = keras.losses.mean_squared_error(y_true, y_pred)
-                    result = K.print_tensor(result, message='losses')
-                    return result
-
-                model.compile('adam', examine_loss)
-                model.summary()
-
-                X = np.random.rand(100, 4)
-
-                def test_fn(x):
-                    return x[0] * 0.2 + x[1] * 5.0 + x[2] * 0.3 + x[3] + 0.6
-
-                y = np.apply_along_axis(test_fn, 1, X)
-
-                model.fit(X[0:4], y[0:4])
-                
-        You should seem something like the following:
-        losses [23.2873611 26.1659927 34.1300354 6.16115761]
+        with prioritizedReplay, the slots and the importance-sampling weights of the batch are kept in self._sampleIdxs and
+        self._sampleWeights for the fit() and _updatePriorities() of the same batch
         '''
         state_batch, action_batch, reward_batch, next_state_batch, done_batch =None,None,None,None,None
         with self._lock:
             sizeToBatch = self._batchSize
-            if None in self.__replayCache or len(self.__replayCache) < sizeToBatch:
+            if self.__replayCache.size < sizeToBatch:
                 return state_batch, action_batch, reward_batch, next_state_batch, done_batch
 
-            if len(GPUs) > 0 and len(self.__replayCache) > self._batchSize:
-                sizeToBatch = min(10, int(len(self.__replayCache) / self._batchSize)) *self._batchSize
+            if len(GPUs) > 0 and self.__replayCache.size > self._batchSize:
+                sizeToBatch = min(10, int(self.__replayCache.size / self._batchSize)) *self._batchSize
             
-            batch = np.array(random.sample(self.__replayCache, sizeToBatch))
-
-            # pick up the each part from the batch as we inserted via __replayCache[__sampleIdx] = (state, action, reward, next_state, done)
-            state_batch = np.concatenate(batch[:, 0]).reshape(sizeToBatch, self._stateSize)
-            action_batch = np.concatenate(batch[:, 1]).reshape(sizeToBatch, self._actionSize) # array(sizeToBatch, self._actionSize)
-            reward_batch = batch[:, 2] #array(sizeToBatch, 1)
-            next_state_batch = np.concatenate(batch[:, 3]).reshape(sizeToBatch, self._stateSize)
-            done_batch = batch[:, 4] #array(sizeToBatch, 1)
+            # the batch arrays are the buffers of the replay memory, which are reused by the next sampling
+            if self._prioritizedReplay:
+                state_batch, action_batch, reward_batch, next_state_batch, done_batch, self._sampleIdxs, self._sampleWeights = self.__replayCache.samplePrioritized(sizeToBatch)
+            else:
+                state_batch, action_batch, reward_batch, next_state_batch, done_batch = self.__replayCache.sample(sizeToBatch)
+            if state_batch is None:
+                return state_batch, action_batch, reward_batch, next_state_batch, done_batch
 
             # action processing
             action_batch = np.where(action_batch == 1) # array(sizeToBatch, self._actionSize)=>array(2, sizeToBatch): array[0]=[index of item] arrayp[1]=[2d index of where=1]
@@ -472,12 +449,22 @@ class agentDQN(MetaAgent):
             
             return state_batch, action_batch, reward_batch, next_state_batch, done_batch
 
+    def _updatePriorities(self, tdErrors) :
+        '''
+        update the priorities of the latest prioritized batch by its TD-errors, expected to be called within self._lock
+        '''
+        if not self._prioritizedReplay or self._sampleIdxs is None:
+            return
+
+        self.__replayCache.updatePriorities(self._sampleIdxs, tdErrors)
+        self._sampleIdxs, self._sampleWeights = None, None
+
     def OnNewFrame(self, frameId, col_state, col_action, col_reward, col_next_state, col_done) :
 
         if not self._masterExportHomeDir or len(self._masterExportHomeDir) <=0:
             return # not as the master
         
-        if not col_state or len(col_state) <=0:
+        if col_state is None or len(col_state) <=0:
             return
         
         if '/' != self._masterExportHomeDir[-1]: self._masterExportHomeDir +='/'
@@ -522,7 +509,6 @@ class agentDQN(MetaAgent):
             g.attrs[u'default'] = 'state'
 
             g.create_dataset(u'title',     data= '%s replay buffer for NN training' % brainInst)
-            done_col = [ 1 if i else 0 for i in metrix[:, 4]]
             g.create_dataset('state',      data= col_state)
             g.create_dataset('action',     data= col_action)
             g.create_dataset('reward',     data= col_reward)
@@ -640,7 +626,7 @@ class agentDoubleDQN(agentDQN):
 
         # this basic DQN also performs training in this step
         state_batch, action_batch, reward_batch, next_state_batch, done_batch = self._sampleBatches()
-        sampleLen = len(state_batch) if state_batch else 0
+        sampleLen = len(state_batch) if not state_batch is None else 0
         if sampleLen < self._batchSize: 
             return None
 
@@ -657,12 +643,14 @@ class agentDoubleDQN(agentDQN):
             reward_batch += (self._gamma * np.logical_not(done_batch) * Q_next_max) # arrary(sampleLen, 1)
 
             Q_target = brainTrain.predict(state_batch)
+            tdErrors = reward_batch - Q_target[action_batch[0], action_batch[1]] # by the same predict pass
             Q_target[action_batch[0], action_batch[1]] = reward_batch # action =arrary(2,sampleLen)
 
             epochs =1
             if len(GPUs) > 0 and sampleLen >self._batchSize:
                 epochs = self._epochsPerObservOnGpu
-            self._loss = brainTrain.fit(x=state_batch, y=Q_target, epochs=epochs, batch_size=self._batchSize, verbose=0, callbacks=self._fitCallbacks)
+            self._loss = brainTrain.fit(x=state_batch, y=Q_target, sample_weight=self._sampleWeights, epochs=epochs, batch_size=self._batchSize, verbose=0, callbacks=self._fitCallbacks)
+            self._updatePriorities(tdErrors)
 
         return self._loss
 
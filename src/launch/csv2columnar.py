@@ -0,0 +1,28 @@
+# encoding: UTF-8
+'''
+This utility converts the csv/bz2 history trees into the columnar store of ColumnarPlayback
+    usage: csv2columnar.py <csvTopDir> <columnarDir> [symbol ...]
+where each symbol has its csv/bz2 files under <csvTopDir>/<symbol>/, all the sub-dirs are taken if no symbol specified
+'''
+
+from Application import *
+import HistoryData as hist
+
+import sys, os
+
+if __name__ == '__main__':
+
+    csvTopDir, columnarDir, symbols = sys.argv[1], sys.argv[2], sys.argv[3:]
+    sys.argv = sys.argv[:1]
+
+    p = Program()
+    p._heartbeatInterval =-1
+
+    csvTopDir, columnarDir = Program.fixupPath(csvTopDir), Program.fixupPath(columnarDir)
+    if len(symbols) <=0:
+        symbols = [ d for d in os.listdir(csvTopDir) if os.path.isdir(os.path.join(csvTopDir, d)) ]
+        symbols.sort()
+
+    for s in symbols:
+        days = hist.csvToColumnar(s, os.path.join(csvTopDir, s), columnarDir, program=p)
+        p.info('symbol[%s] converted %d days into %s' % (s, days, columnarDir))
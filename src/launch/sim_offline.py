@@ -17,138 +17,29 @@ import random
 
 def balanceSamples(filepathRFrm, compress=True) :
     '''
-    read a frame from H5 file
+    rebalance the ReplayFrames of a H5 file into <filepathRFrm>b of OUTFRM_SIZE-row frames by streaming chunks
     '''
-    dsargs={}
-    if compress :
-        dsargs['compression'] = 'lzf' # 'gzip' for HDFExplorer
-
-    print("balancing samples in %s to %sb" % (filepathRFrm, filepathRFrm))
-    with h5py.File(filepathRFrm+'b', 'w') as h5out:
-        frmId=0
-        frmState=None
-        frmAction=None
-        frmInName=''
-        subtotal = np.asarray([0]*3)
-
-        with h5py.File(filepathRFrm, 'r') as h5f:
-            framesInHd5 = []
-            for name in h5f.keys() :
-                if RFGROUP_PREFIX == name[:len(RFGROUP_PREFIX)] or RFGROUP_PREFIX2 == name[:len(RFGROUP_PREFIX2)] :
-                    framesInHd5.append(name)
-
-            framesInHd5.sort()
-            print("found frames in %s: %s" % (filepathRFrm, ','.join(framesInHd5)))
-
-            for frmInName in framesInHd5 :
-                print("reading frmIn[%s] from %s" % (frmInName, filepathRFrm))
-                frm = h5f[frmInName]
-                if frmState is None:
-                    frmState = np.array(list(frm['state']))
-                    frmAction = np.array(list(frm['action']))
-                    lenBefore =0
-                    lenAfter = len(frmState)
-                else :
-                    lenBefore = len(frmState)
-                    a = np.array(list(frm['state']))
-                    frmState = np.concatenate((frmState, a), axis=0)
-                    a = np.array(list(frm['action']))
-                    frmAction= np.concatenate((frmAction, a), axis=0)
-                    lenAfter = len(frmState)
-
-                npActions = frmAction[lenBefore:]
-                AD = np.where(npActions >=0.99) # to match 1 because action is float read from RFrames
-                kI = [np.count_nonzero(AD[1] ==i) for i in range(3)] # counts of each actions in frame
-                kImax = max(kI)
-                idxMax = kI.index(kImax)
-                cToReduce = kImax - int(1.2*(sum(kI) -kImax))
-                if cToReduce >0:
-                    print("frmIn[%s] actCounts[%s,%s,%s]->evicting %d samples of max-act[%d]" % (frmInName, kI[0],kI[1],kI[2], cToReduce, idxMax))
-                    idxItems = np.where(AD[1] ==idxMax)[0].tolist()
-                    random.shuffle(idxItems)
-                    del idxItems[cToReduce:]
-                    idxToDel = [lenBefore +i for i in idxItems]
-                    frmAction = np.delete(frmAction, idxToDel, axis=0)
-                    frmState = np.delete(frmState, idxToDel, axis=0)
-
-                # update the stat now
-                AD = np.where(frmAction >=0.99) # to match 1 because action is float read from RFrames
-                kI = [np.count_nonzero(AD[1] ==i) for i in range(3)] # counts of each actions in frame
-                print("frmIn[%s] processed, pending %s actCounts[%s,%s,%s]" % (frmInName, len(frmState), kI[0],kI[1],kI[2]))
-
-                if len(frmState) >= OUTFRM_SIZE:
-                    col_state = frmState[:OUTFRM_SIZE]
-                    col_action = frmAction[:OUTFRM_SIZE]
-                    frmState  = frmState[OUTFRM_SIZE:]
-                    frmAction = frmAction[OUTFRM_SIZE:]
-
-                    AD = np.where(col_action >=0.99)
-                    kIout = [np.count_nonzero(AD[1] ==i) for i in range(3)]
-                    subtotal += np.asarray(kIout)
-                    # AD = np.where(frmAction >=0.99)
-                    # kI = [np.count_nonzero(AD[1] ==i) for i in range(3)]
-
-                    frmName ='%s%s' % (RFGROUP_PREFIX, frmId)
-                    g = h5out.create_group(frmName)
-                    g.create_dataset(u'title', data= 'compressed replay frame[%s]' % (frmId))
-                    frmId +=1
-                    g.attrs['state'] = 'state'
-                    g.attrs['action'] = 'action'
-                    g.attrs[u'default'] = 'state'
-                    g.attrs['size'] = col_state.shape[0]
-                    g.attrs['signature'] = EXPORT_SIGNATURE
-
-                    st = g.create_dataset('state', data= col_state, **dsargs)
-                    st.attrs['dim'] = col_state.shape[1]
-                    ac = g.create_dataset('action', data= col_action, **dsargs)
-                    ac.attrs['dim'] = col_action.shape[1]
-                    print("outfrm[%s] actCounts[%s,%s,%s] saved, pending %s" % (frmName, kIout[0],kIout[1],kIout[2], len(frmState)))
-
-            # the last frame
-            if len(frmState) >= 0:
-                col_state = frmState
-                col_action = frmAction
-                AD = np.where(col_action >=0.99)
-                kIout = [np.count_nonzero(AD[1] ==i) for i in range(3)]
-                subtotal += np.asarray(kIout)
-                
-                frmName ='%s%s' % (RFGROUP_PREFIX, frmId)
-                frmId +=1
-                g = h5out.create_group(frmName)
-                g.create_dataset(u'title', data= 'compressed replay frame[%s]' % (frmId))
-                g.attrs['state'] = 'state'
-                g.attrs['action'] = 'action'
-                g.attrs[u'default'] = 'state'
-                g.attrs['size'] = col_state.shape[0]
-                g.attrs['signature'] = EXPORT_SIGNATURE
-
-                st = g.create_dataset('state', data= col_state, **dsargs)
-                st.attrs['dim'] = col_state.shape[1]
-                ac = g.create_dataset('action', data= col_action, **dsargs)
-                ac.attrs['dim'] = col_action.shape[1]
-
-                print("lastfrm[%s] actCounts[%s,%s,%s] saved, size %s" % (frmName, kIout[0],kIout[1],kIout[2], len(col_action)))
-
-            print("balanced %s to %sb: %s->%d frameOut, actSubtotal%s" % (filepathRFrm, filepathRFrm, frmInName, frmId, list(subtotal)))
-
-if __name__ == '__main__':
-
-    # sys.argv += ['-z', '-b', '/mnt/e/h5_to_h5b/RFrmD4M1X5_SZ159949.h5']
-
-    if '-b' in sys.argv :
-        idx = sys.argv.index('-b') +1
-        if idx >0 and idx < len(sys.argv):
-            h5fn = sys.argv[idx]
-            compress = '-z' in sys.argv
-            balanceSamples(h5fn, compress)
-            quit()
-
-    if not '-f' in sys.argv :
-        sys.argv += ['-f', os.path.realpath(os.path.dirname(os.path.abspath(__file__))+ '/../../conf') + '/Trader.json']
-
-    p = Program()
-    p._heartbeatInterval =-1
+    rb = hist.ReplayFrameRebalancer(outFrameSize=OUTFRM_SIZE, compress=compress, signature=EXPORT_SIGNATURE, prefixes=[RFGROUP_PREFIX, RFGROUP_PREFIX2], outPrefix=RFGROUP_PREFIX)
+    return rb.rebalance(filepathRFrm, filepathRFrm+'b')
 
+def balanceFiles(filepathsRFrm, compress=True, processes=0) :
+    '''
+    rebalance multiple H5 files in parallel, each <filepathRFrm> into <filepathRFrm>b
+    '''
+    results = hist.ReplayFrameRebalancer.rebalanceFiles([ (fn, fn+'b') for fn in filepathsRFrm ], processes=processes,
+                outFrameSize=OUTFRM_SIZE, compress=compress, signature=EXPORT_SIGNATURE, prefixes=[RFGROUP_PREFIX, RFGROUP_PREFIX2], outPrefix=RFGROUP_PREFIX)
+    for fn, frames, subtotal, err in results :
+        if err :
+            print("failed to balance %s: %s" % (fn, err))
+        else :
+            print("balanced %s to %sb: %d frameOut, actSubtotal%s" % (fn, fn, frames, subtotal))
+    return results
+
+def createSimulator(p) :
+    '''
+    create the apps of a simulation per the configuration of the program, the symbol is taken from env SYMBOL if specified
+    @return the simulator app
+    '''
     evMdSource  = p.getConfig('marketEvents/source', None) # market data event source
     advisorType = p.getConfig('advisor/type', "remote")
     ideal       = p.getConfig('trader/backTest/ideal', None) # None
@@ -202,6 +93,36 @@ if __name__ == '__main__':
         tdrWraper = p.createApp(OfflineSimulator, configNode ='trader', trader=tdrCore, histdata=csvreader) # the simulator with brain loaded to verify training result
 
     tdrWraper.setRecorder(rec)
+    return tdrWraper
+
+if __name__ == '__main__':
+
+    # sys.argv += ['-z', '-b', '/mnt/e/h5_to_h5b/RFrmD4M1X5_SZ159949.h5']
+    # multiple files are balanced in parallel: -b <file1> <file2> ... [-p <processes>]
+
+    if '-b' in sys.argv :
+        idx = sys.argv.index('-b') +1
+        h5fns = []
+        while idx < len(sys.argv) and '-' != sys.argv[idx][:1]:
+            h5fns.append(sys.argv[idx])
+            idx +=1
+
+        if len(h5fns) >0:
+            compress = '-z' in sys.argv
+            processes = int(sys.argv[sys.argv.index('-p') +1]) if '-p' in sys.argv else 0
+            if len(h5fns) >1:
+                balanceFiles(h5fns, compress, processes)
+            else :
+                balanceSamples(h5fns[0], compress)
+            quit()
+
+    if not '-f' in sys.argv :
+        sys.argv += ['-f', os.path.realpath(os.path.dirname(os.path.abspath(__file__))+ '/../../conf') + '/Trader.json']
+
+    p = Program()
+    p._heartbeatInterval =-1
+
+    tdrWraper = createSimulator(p)
 
     p.start()
     if tdrWraper.isActive :
@@ -0,0 +1,179 @@
+# encoding: UTF-8
+'''
+This utility shards the symbols across a pool of worker processes, each of which runs a sim_offline
+simulation of its own Program, CsvPlayback and IdealTrader_Tplus1/ShortSwingScanner on one symbol
+    usage: sim_offline_pool.py [-f <config-file>] [-o <outputdir>]
+config node "pool" in the config-file:
+    symbols    - the file listing one symbol per line, default crawler/symbols.txt.bz2
+    processes  - the number of worker processes, default the cpu count
+    memoryMB   - the address-space budget of each worker process, 0 for unlimited
+    merge      - whether to merge the per-worker H5 files at the end, default True
+the symbols completed are checkpointed into <outputdir>/symbols.done so that a restart skips them
+'''
+
+from Application import *
+from sim_offline import createSimulator
+
+import multiprocessing
+import resource, logging
+import sys, os, bz2, glob, time
+import h5py
+
+CHECKPOINT_FILE = 'symbols.done'
+
+def _initWorker(memoryMB) :
+    # the forked worker must not echo into the handlers inherited from the driver's logger
+    logging.getLogger().handlers = []
+    if memoryMB and memoryMB >0 :
+        limit = int(memoryMB) *1024*1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _simulateSymbol(symbol) :
+    '''
+    the worker that runs the simulation of a single symbol
+    @return (symbol, ok, message)
+    '''
+    os.environ['SYMBOL'] = symbol
+    p, stampStart = None, time.time() -1 # tolerate the coarse mtime of the filesystem
+    try :
+        p = Program()
+        p._heartbeatInterval =-1
+
+        tdrWraper = createSimulator(p)
+        p.start()
+        if tdrWraper.isActive :
+            p.loop()
+        p.stop()
+    except SystemExit as ex :
+        # IdealTrader_Tplus1 and ShortSwingScanner exit once the playback is done, which only counts if the output is there.
+        # the other exits, such as of createSimulator() or the getopt of Program, are failures to retry
+        if not ex.code in (0, None) or not p or not outputProduced(p.outdir, symbol, stampStart) :
+            return (symbol, False, 'exit %s' % ex.code)
+    except MemoryError :
+        return (symbol, False, 'exceeded memory budget')
+    except Exception as ex :
+        if p: p.logexception(ex)
+        return (symbol, False, '%s' % ex)
+
+    return (symbol, True, 'pid[%s]' % os.getpid())
+
+def outputProduced(outdir, symbol, since) :
+    '''
+    @return True if the per-symbol output, the tcsv or the H5 files of the symbol, has been written since the given stamp
+    '''
+    fns = glob.glob(os.path.join(outdir, '%s_P*.tcsv*' % symbol)) + glob.glob(os.path.join(outdir, 'Tdr.P*', '*_%s.h5' % symbol))
+    return any([os.path.getmtime(fn) >= since for fn in fns])
+
+def readSymbols(filename) :
+    '''
+    @return the list of symbols in the file, one symbol per line
+    '''
+    symbols = []
+    openfunc = bz2.open if '.bz2' == filename[-4:] else open
+    with openfunc(filename, 'rt') as f:
+        for line in f :
+            s = line.strip()
+            if len(s) >0 and not s in symbols:
+                symbols.append(s)
+    return symbols
+
+def readCheckpoint(outdir) :
+    '''
+    @return the set of symbols recorded as done
+    '''
+    try :
+        with open(os.path.join(outdir, CHECKPOINT_FILE), 'r') as f:
+            return set([ line.strip() for line in f if len(line.strip()) >0 ])
+    except IOError :
+        pass
+    return set()
+
+def simulateSymbols(p, symbols, processes, memoryMB, symbolsDone) :
+    '''
+    simulate the symbols by the pool of worker processes, the symbols done are checkpointed and added into symbolsDone
+    @return the list of the symbols failed
+    '''
+    stampStart = datetime.now()
+    cDone, failures = 0, []
+    # maxtasksperchild=1 gives each symbol a fresh process, so that a worker never leaks Program/App state into the next symbol
+    pool = multiprocessing.Pool(processes=processes, initializer=_initWorker, initargs=(memoryMB,), maxtasksperchild=1)
+    try :
+        with open(os.path.join(p.outdir, CHECKPOINT_FILE), 'a') as fckpt:
+            for symbol, ok, msg in pool.imap_unordered(_simulateSymbol, symbols) :
+                cDone +=1
+                if ok :
+                    fckpt.write('%s\n' % symbol)
+                    fckpt.flush()
+                    symbolsDone.add(symbol)
+                else :
+                    failures.append(symbol)
+                    p.error('symbol[%s] failed: %s' % (symbol, msg))
+
+                elapsed = datetime.now() - stampStart
+                eta = elapsed / cDone * (len(symbols) - cDone)
+                p.info('progress %d/%d symbol[%s] %s, %d failed, elapsed %s, ETA %s' % (cDone, len(symbols), symbol, 'done' if ok else 'failed', len(failures), str(elapsed).split('.')[0], str(eta).split('.')[0]))
+        pool.close()
+    except KeyboardInterrupt :
+        p.warn('interrupted, the symbols done so far are kept in the checkpoint')
+        pool.terminate()
+    pool.join()
+
+    return failures
+
+def mergeFrames(p, symbolsDone) :
+    '''
+    merge the per-worker H5 files <outdir>/Tdr.P*/<kind>_<symbol>.h5 into <outdir>/<kind>.h5, where
+    each group is copied as <group>@<symbol>. only the latest file of each symbol that is checkpointed as done is taken
+    @return dict of {kind: number of files merged}
+    '''
+    latest = {} # {(kind, symbol): filepath}
+    for fn in glob.glob(os.path.join(p.outdir, 'Tdr.P*', '*.h5')) :
+        kind, symbol = os.path.basename(fn)[:-3].rsplit('_', 1)
+        if not symbol in symbolsDone: continue
+        key = (kind, symbol)
+        if not key in latest or os.path.getmtime(fn) > os.path.getmtime(latest[key]) :
+            latest[key] = fn
+
+    merged = {}
+    for (kind, symbol) in sorted(latest.keys()) :
+        fnOut = os.path.join(p.outdir, '%s.h5' % kind)
+        with h5py.File(latest[(kind, symbol)], 'r') as h5in, h5py.File(fnOut, 'a') as h5out:
+            for name in h5in.keys() :
+                nameOut = '%s@%s' % (name, symbol)
+                if nameOut in h5out: del h5out[nameOut] # the re-simulated symbol overwrites
+                h5in.copy(name, h5out, name=nameOut)
+
+        merged[kind] = merged.get(kind, 0) +1
+
+    for kind, cnt in merged.items() :
+        p.info('merged %d symbols into %s' % (cnt, os.path.join(p.outdir, '%s.h5' % kind)))
+    return merged
+
+if __name__ == '__main__':
+
+    if not '-f' in sys.argv :
+        sys.argv += ['-f', os.path.realpath(os.path.dirname(os.path.abspath(__file__))+ '/../../conf') + '/Trader.json']
+
+    p = Program()
+    p._heartbeatInterval =-1
+
+    symbolsFile = Program.fixupPath(p.getConfig('pool/symbols', os.path.realpath(os.path.dirname(os.path.abspath(__file__))+ '/../crawler') + '/symbols.txt.bz2'))
+    processes   = int(p.getConfig('pool/processes', multiprocessing.cpu_count()))
+    memoryMB    = int(p.getConfig('pool/memoryMB', 0))
+    merge       = str(p.getConfig('pool/merge', 'True')).lower() in BOOL_STRVAL_TRUE
+
+    try :
+        os.makedirs(p.outdir)
+    except :
+        pass
+
+    symbolsDone = readCheckpoint(p.outdir)
+    symbols = [ s for s in readSymbols(symbolsFile) if not s in symbolsDone ]
+    p.info('%d symbols to simulate by %d processes, %d skipped as done per %s' % (len(symbols), processes, len(symbolsDone), os.path.join(p.outdir, CHECKPOINT_FILE)))
+
+    failures = simulateSymbols(p, symbols, processes, memoryMB, symbolsDone)
+    if len(failures) >0:
+        p.warn('%d symbols failed: %s' % (len(failures), ','.join(failures)))
+
+    if merge :
+        mergeFrames(p, symbolsDone)
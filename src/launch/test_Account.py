@@ -6,9 +6,50 @@ import MarketData as md
 from Application import *
 from Account import *
 from Trader import *
+from EventData import Event, datetime2float
+import random, time, copy
 
 PROGNAME = os.path.basename(__file__)[0:-3]
 
+class ClockedAccount(Account_AShare):
+    '''
+    the account whose market time is set by the test, and whose broker confirms the orders immediately
+    '''
+    def __init__(self, program, **kwargs):
+        super(ClockedAccount, self).__init__(program, **kwargs)
+        self.clock = datetime(2020, 3, 2, 10, 0, 0)
+        self._skipSavingByEvent = True
+
+    def datetimeAsOfMarket(self): return self.clock
+    def record(self, category, row): pass
+    def postEvent_Order(self, orderData): pass
+
+    def _broker_placeOrder(self, orderData):
+        orderData.brokerOrderId = '$' + orderData.reqId
+        orderData.status = OrderData.STATUS_SUBMITTED
+        self._broker_onOrderPlaced(orderData)
+
+    def _broker_cancelOrder(self, orderData):
+        self._broker_onCancelled(orderData)
+
+    def fakeTrade(self, symbol, direction, price, volume):
+        trade = TradeData(self)
+        trade.brokerTradeId = str(len(self._dictTrades) +1)
+        trade.symbol, trade.direction, trade.price, trade.volume = symbol, direction, price, volume
+        trade.datetime = self.clock
+        self._broker_onTrade(trade)
+
+class FixedMarket(object):
+    '''
+    the market state of the prices set by the test
+    '''
+    def __init__(self): self.prices = {}
+    def latestPrice(self, symbol): return self.prices.get(symbol, 0)
+    def getAsOf(self, symbol=None): return datetime(2020, 3, 2, 10, 0, 0)
+
+class FakeTrader(object):
+    def __init__(self): self.marketState, self.recorder = FixedMarket(), None
+
 class TestAccount(unittest.TestCase):
 
     def test_AccApp(self):
@@ -38,6 +79,434 @@ class TestAccount(unittest.TestCase):
         p.loop()
         p.stop()
 
+    def _legacyCrossLimitOrder(liveOrders, symbol, buyCrossPrice, sellCrossPrice) :
+        # the scan over all the limit orders that AccountWrapper took before the OrderBookIndex
+        crossed, pendings = [], []
+        for orderID, order in liveOrders.items():
+            if order.symbol != symbol:
+                continue
+            buyCross = (order.direction == OrderData.DIRECTION_LONG and order.price>=buyCrossPrice and buyCrossPrice > 0)
+            sellCross = (order.direction == OrderData.DIRECTION_SHORT and order.price<=sellCrossPrice and sellCrossPrice > 0)
+            if not buyCross and not sellCross:
+                pendings.append(order)
+                continue
+            crossed.append((order, buyCross))
+        return crossed, pendings
+
+    def test_OrderBookIndex(self):
+        p = Program()
+        p._heartbeatInterval =-1
+        acc = p.createApp(Account_AShare)
+
+        random.seed(19)
+        symbols = ['000001', '000002', '600000']
+        liveOrders, idx = OrderedDict(), OrderBookIndex()
+        cCrossed = 0
+        for step in range(3000):
+            r = random.random()
+            if r < 0.5:
+                o = OrderData(acc)
+                o.symbol = random.choice(symbols)
+                o.direction = random.choice([OrderData.DIRECTION_LONG, OrderData.DIRECTION_SHORT, OrderData.DIRECTION_LONG, OrderData.DIRECTION_SHORT, OrderData.DIRECTION_NONE])
+                o.price = round(random.uniform(9.0, 11.0), 2)
+                o.brokerOrderId = '$%s' % o.reqId
+                liveOrders[o.brokerOrderId] = o
+                idx.add(o, liveOrders)
+            elif r < 0.65 and len(liveOrders) >0:
+                del liveOrders[random.choice(list(liveOrders.keys()))] # cancelled
+            elif r < 0.66:
+                liveOrders.clear() # day-open
+            else:
+                symbol = random.choice(symbols)
+                buyCrossPrice  = 0 if random.random() < 0.05 else round(random.uniform(9.0, 11.0), 2)
+                sellCrossPrice = 0 if random.random() < 0.05 else round(buyCrossPrice + random.uniform(-0.5, 0.5), 2)
+                expected, pendings = TestAccount._legacyCrossLimitOrder(liveOrders, symbol, buyCrossPrice, sellCrossPrice)
+                crossed = idx.popCrossed(symbol, buyCrossPrice, sellCrossPrice, liveOrders)
+                self.assertEqual([(o.reqId, b) for o, b in crossed], [(o.reqId, b) for o, b in expected])
+                self.assertEqual([o.reqId for o in idx.pendingOrders(symbol, liveOrders)], [o.reqId for o in pendings])
+                for o, _ in crossed:
+                    del liveOrders[o.brokerOrderId] # done
+                cCrossed += len(crossed)
+
+        self.assertTrue(cCrossed >100)
+        idx.compact(liveOrders)
+        self.assertEqual(len(idx), len(liveOrders))
+
+    def test_StopTriggerIndex(self):
+        p = Program()
+        p._heartbeatInterval =-1
+        acc = p.createApp(Account_AShare)
+
+        liveOrders, idx = OrderedDict(), StopTriggerIndex()
+        def _stop(direction, price, symbol='000001'):
+            o = OrderData(acc, True)
+            o.symbol, o.direction, o.price = symbol, direction, price
+            o.brokerOrderId = '$%s' % o.reqId
+            liveOrders[o.brokerOrderId] = o
+            idx.add(o, liveOrders)
+            return o
+
+        def _bestCross(open, high, low, close, buy):
+            # the best-cross-price model of the limit orders in AccountWrapper.matchTrades()
+            return ((open + close + high) *3 + low) /10 if buy else ((open + close + low) *3 + high) /10
+
+        b100, b102, b105 = _stop(OrderData.DIRECTION_LONG, 10.0), _stop(OrderData.DIRECTION_LONG, 10.2), _stop(OrderData.DIRECTION_LONG, 10.5)
+        s98, s95 = _stop(OrderData.DIRECTION_SHORT, 9.8), _stop(OrderData.DIRECTION_SHORT, 9.5)
+        other = _stop(OrderData.DIRECTION_LONG, 1.0, symbol='000002')
+
+        # KLine(open=10.1, high=10.3, low=9.9, close=10.25) touches the buy-stops at 10.0 and 10.2 only
+        triggered = idx.popTriggered('000001', 10.3, 9.9, liveOrders)
+        self.assertEqual([(o.reqId, b) for o, b in triggered], [(b100.reqId, True), (b102.reqId, True)])
+        best = _bestCross(10.1, 10.3, 9.9, 10.25, True)
+        self.assertAlmostEqual(StopTriggerIndex.fillPrice(b102, True, best, 10.1), max(10.2, best))
+        self.assertAlmostEqual(StopTriggerIndex.fillPrice(b100, True, 9.9, 10.1), 10.1) # the stop already crossed at the open
+        for o, _ in triggered: del liveOrders[o.brokerOrderId]
+        self.assertEqual(idx.popTriggered('000001', 10.3, 9.9, liveOrders), []) # popped only once
+
+        # gap-through: KLine(open=10.8, high=11.0, low=10.7, close=10.9) opens above the buy-stop at 10.5
+        triggered = idx.popTriggered('000001', 11.0, 10.7, liveOrders)
+        self.assertEqual([o.reqId for o, _ in triggered], [b105.reqId])
+        fill = StopTriggerIndex.fillPrice(b105, True, _bestCross(10.8, 11.0, 10.7, 10.9, True), 10.8)
+        self.assertTrue(fill >= 10.8)
+        del liveOrders[b105.brokerOrderId]
+
+        # gap-down through both sell-stops: KLine(open=9.3, high=9.4, low=9.0, close=9.1), filled no better than the open
+        s97 = _stop(OrderData.DIRECTION_SHORT, 9.7)
+        del liveOrders[s97.brokerOrderId] # cancelled
+        self.assertEqual(idx.popTriggered('000001', 9.4, 0, liveOrders), []) # no sell trigger at the price limit
+        triggered = idx.popTriggered('000001', 9.4, 9.0, liveOrders)
+        self.assertEqual([(o.reqId, b) for o, b in triggered], [(s98.reqId, False), (s95.reqId, False)])
+        best = _bestCross(9.3, 9.4, 9.0, 9.1, False)
+        for o, _ in triggered:
+            self.assertAlmostEqual(StopTriggerIndex.fillPrice(o, False, best, 9.3), min(best, 9.3))
+            del liveOrders[o.brokerOrderId]
+        self.assertEqual([o.reqId for o in idx.pendingOrders('000002', liveOrders)], [other.reqId])
+
+        # randomized against a scan of all the stops
+        random.seed(20)
+        symbols = ['000001', '000002']
+        for step in range(2000):
+            if random.random() < 0.5:
+                _stop(random.choice([OrderData.DIRECTION_LONG, OrderData.DIRECTION_SHORT]), round(random.uniform(9.0, 11.0), 2), random.choice(symbols))
+            elif random.random() < 0.2 and len(liveOrders) >0:
+                del liveOrders[random.choice(list(liveOrders.keys()))]
+            else:
+                symbol, low = random.choice(symbols), round(random.uniform(9.0, 11.0), 2)
+                high = round(low + random.uniform(0, 0.3), 2)
+                expected = [ (o.reqId, o.direction == OrderData.DIRECTION_LONG) for o in liveOrders.values() if o.symbol == symbol and
+                            ((o.direction == OrderData.DIRECTION_LONG and o.price <= high) or (o.direction == OrderData.DIRECTION_SHORT and o.price >= low)) ]
+                triggered = idx.popTriggered(symbol, high, low, liveOrders)
+                self.assertEqual([(o.reqId, b) for o, b in triggered], expected)
+                for o, _ in triggered: del liveOrders[o.brokerOrderId]
+
+        idx.compact(liveOrders)
+        self.assertEqual(len(idx), len(liveOrders))
+
+    def _kline(symbol, asof, open, high, low, close, volume=1e6):
+        kl = md.KLineData('SSE', symbol)
+        kl.datetime, kl.open, kl.high, kl.low, kl.close, kl.volume = asof, open, high, low, close, volume
+        ev = Event(md.EVENT_KLINE_1MIN)
+        ev.setData(kl)
+        return ev
+
+    def test_StopOrderMatching(self):
+        # the stops go through sendStopOrder() and AccountWrapper.doAppStep(), and are matched by the KLines
+        from Simulator import AccountWrapper
+
+        class FakeBackTest(object):
+            ''' the BackTestApp that AccountWrapper takes the market time and logs from '''
+            def __init__(self, acc): self.wkTrader, self._acc = self, acc
+            @property
+            def _dtData(self): return self._acc.clock
+            def debug(self, msg): pass
+            def info(self, msg): pass
+            def warn(self, msg): pass
+            def error(self, msg): pass
+
+        p = Program()
+        p._heartbeatInterval =-1
+        acc = p.createApp(ClockedAccount)
+        acc.hostTrader(FakeTrader())
+        acc.cashChange(1e6, 1e6)
+        wrapper = AccountWrapper(p, btTrader=FakeBackTest(acc), account=acc)
+        _kline = TestAccount._kline
+
+        # KLine(open=10.1, high=10.3, low=9.9, close=10.25) touches the buy-stop at 10.2, filled at the best-cross-price
+        reqId = wrapper.sendStopOrder('000001', OrderData.ORDER_BUY, 10.2, 300, 'stop')
+        self.assertEqual(wrapper.doAppStep(), 1)
+        self.assertEqual([o.reqId for o in acc._dictStopOrders.values()], [reqId])
+        wrapper.matchTrades(_kline('000002', acc.clock, 10.1, 10.3, 9.9, 10.25)) # the other symbol
+        self.assertEqual(len(acc._dictTrades), 0)
+
+        wrapper.matchTrades(_kline('000001', acc.clock, 10.1, 10.3, 9.9, 10.25))
+        self.assertEqual(len(acc._dictStopOrders), 0)
+        trade = list(acc._dictTrades.values())[0]
+        self.assertEqual((trade.orderReq, trade.direction, trade.volume), (reqId, OrderData.DIRECTION_LONG, 300))
+        self.assertAlmostEqual(trade.price, max(10.2, acc.roundByPriceTick(((10.1 + 10.25 + 10.3) *3 + 9.9) /10)))
+        self.assertEqual(acc.getPosition('000001').position, 300)
+        turnover, commission, slippage = acc.calcAmountOfTrade('000001', trade.price, 300)
+        cashAvail, cashTotal = acc.cashAmount()
+        self.assertAlmostEqual(cashTotal, 1e6 - turnover - commission - slippage, places=2)
+        self.assertAlmostEqual(cashAvail, cashTotal, places=2) # the cash frozen by the stop is released
+        wrapper.matchTrades(_kline('000001', acc.clock, 10.1, 10.3, 9.9, 10.25))
+        self.assertEqual(len(acc._dictTrades), 1) # filled only once
+
+        # no buy is filled while the price is locked at the limit, the stop keeps pending until the next KLine crosses
+        reqId = wrapper.sendStopOrder('000001', OrderData.ORDER_BUY, 10.0, 100, 'stop')
+        wrapper.doAppStep()
+        wrapper.matchTrades(_kline('000001', acc.clock, 10.0, 10.05, 9.0, 9.0))
+        self.assertEqual(len(acc._dictTrades), 1)
+        self.assertEqual([o.reqId for o in acc._dictStopOrders.values()], [reqId])
+
+        # gap-through: KLine(open=10.8, high=11.0, low=10.7, close=10.9) fills no better than the open
+        acc.clock += timedelta(minutes=1)
+        wrapper.matchTrades(_kline('000001', acc.clock, 10.8, 11.0, 10.7, 10.9))
+        self.assertEqual(len(acc._dictStopOrders), 0)
+        trade = [ t for t in acc._dictTrades.values() if t.orderReq == reqId ][0]
+        self.assertEqual(trade.volume, 100)
+        self.assertAlmostEqual(trade.price, acc.roundByPriceTick(((10.8 + 10.9 + 11.0) *3 + 10.7) /10))
+        self.assertTrue(trade.price >= 10.8)
+        self.assertEqual(acc.getPosition('000001').position, 400)
+
+        # the stop not triggered within its TTL is cancelled by the step, and never filled afterwards
+        acc._msecOrderTTL = 60 *1000.0
+        cashBefore = acc.cashAmount()
+        reqId = wrapper.sendStopOrder('000001', OrderData.ORDER_BUY, 11.5, 100, 'stop')
+        wrapper.doAppStep()
+        self.assertEqual(acc._dictStopOrders[list(acc._dictStopOrders.keys())[0]].msecTTL, 60 *1000.0)
+        acc.clock += timedelta(seconds=59)
+        self.assertEqual(wrapper.doAppStep(), 0)
+        self.assertEqual(len(acc._dictStopOrders), 1)
+        acc.clock += timedelta(seconds=2)
+        self.assertTrue(wrapper.doAppStep() >0)
+        self.assertEqual(len(acc._dictStopOrders), 0)
+        for a, b in zip(acc.cashAmount(), cashBefore): self.assertAlmostEqual(a, b, places=2)
+        cTrades = len(acc._dictTrades)
+        wrapper.matchTrades(_kline('000001', acc.clock, 11.4, 11.8, 11.3, 11.7))
+        self.assertEqual(len(acc._dictTrades), cTrades)
+
+    def _legacyExpiryScan(acc, fstampNow) :
+        # the scan over all the pending orders that Account.doAppStep() took before the expiry heap, with msecTTL in msec
+        toCancel = []
+        for odid, odata in list(acc._dictLimitOrders.items()) + list(acc._dictStopOrders.items()):
+            if odata.msecTTL <=0 or odata.fstampSubmitted + odata.msecTTL /1000.0 > fstampNow: continue
+            if odid in toCancel : continue
+            toCancel.append(odid)
+        return toCancel
+
+    def test_AccountStepExpiry(self):
+        p = Program()
+        p._heartbeatInterval =-1
+        acc = p.createApp(ClockedAccount)
+        acc.cashChange(1e9, 1e9)
+
+        # 1k resting orders placed over 1000 seconds, each lives 300 seconds by the default ttlOrder
+        for i in range(1000):
+            acc.sendOrder('000001', OrderData.ORDER_BUY, 10.0 - i*0.001, 100, 'bench')
+            acc.doAppStep()
+            acc.clock += timedelta(seconds=1)
+        self.assertEqual(len(acc._dictOutgoingOrders), 0) # swapped out and placed
+        self.assertEqual(len(acc._dictLimitOrders), 1000 - 700) # expired by the steps
+
+        # the resting orders are not touched by a step until they expire
+        for i in range(1000 - len(acc._dictLimitOrders)):
+            acc.sendOrder('000001', OrderData.ORDER_BUY, 9.0, 100, 'bench')
+        acc.doAppStep()
+        self.assertEqual(len(acc._dictLimitOrders), 999) # one more expired by this step
+
+        rounds = 2000
+        fstampNow = datetime2float(acc.datetimeAsOfMarket())
+        stampStart = time.time()
+        for i in range(rounds):
+            TestAccount._legacyExpiryScan(acc, fstampNow)
+        elapsedLegacy = time.time() - stampStart
+        stampStart = time.time()
+        for i in range(rounds):
+            acc.doAppStep()
+        elapsed = time.time() - stampStart
+        print('Account.doAppStep() with %d resting orders: %.1fusec/step, the legacy expiry scan alone %.1fusec/step' % (len(acc._dictLimitOrders), elapsed *1e6 /rounds, elapsedLegacy *1e6 /rounds))
+        self.assertTrue(elapsed < elapsedLegacy)
+
+        # expire by the heap the same orders as the scan did, including the cancelled ones skipped
+        acc.cancelOrder(list(acc._dictLimitOrders.keys())[0])
+        acc.clock += timedelta(seconds=30)
+        expected = set(TestAccount._legacyExpiryScan(acc, datetime2float(acc.datetimeAsOfMarket())))
+        with acc._lock:
+            _, ordersToCancel, expiredOrders = acc._flushOrders(datetime2float(acc.datetimeAsOfMarket()))
+        self.assertEqual(set([o.brokerOrderId for o in ordersToCancel]), expected | set([list(acc._dictLimitOrders.keys())[0]]))
+        self.assertTrue(len(expiredOrders) >0 and set([o.brokerOrderId for o in expiredOrders]) <= expected)
+
+    def test_PositionSnapshot(self):
+        p = Program()
+        p._heartbeatInterval =-1
+        acc = p.createApp(ClockedAccount)
+        trader = FakeTrader()
+        acc.hostTrader(trader)
+        acc.cashChange(1e6, 1e6)
+        _trade = acc.fakeTrade
+
+        for s, price in [('000001', 10.0), ('000002', 20.0), ('000003', 5.0)]:
+            trader.marketState.prices[s] = price
+            _trade(s, OrderData.DIRECTION_LONG, price, int(price))
+
+        # the readers share the same snapshot and the same positions dict until something changes
+        snap = acc.positionSnapshot()
+        self.assertEqual(set(snap.symbols), set(['000001', '000002', '000003']))
+        self.assertFalse(snap.position.flags.writeable)
+        self.assertEqual(snap.position[snap.index('000002')], 20)
+        self.assertEqual(snap.index('000009'), -1)
+        _, cashTotal, positions = acc.positionState()
+        self.assertTrue(acc.positionState()[2] is positions)
+        self.assertTrue(acc.positionSnapshot() is snap)
+        cash, posValue = acc.summrizeBalance(positions, cashTotal)
+        self.assertEqual(posValue, round((10*10 + 20*20 + 5*5) *acc.contractSize, 2))
+        self.assertEqual(acc.summrizeBalance(), (cash, posValue))
+
+        # a price move revalues the same snapshot, the symbol without a price keeps its latest known one
+        trader.marketState.prices['000001'] = 11.0
+        del trader.marketState.prices['000003']
+        _, _, moved = acc.positionState()
+        self.assertTrue(acc.positionSnapshot() is snap)
+        self.assertFalse(moved is positions)
+        self.assertEqual(moved['000001'].price, 11.0)
+        self.assertEqual(moved['000003'].price, 5.0)
+        self.assertEqual(positions['000001'].price, 10.0) # the previous readers are not affected
+        self.assertEqual(acc.summrizeBalance()[1], round((11*10 + 20*20 + 5*5) *acc.contractSize, 2))
+
+        # a trade or a cash change bumps the version
+        _trade('000002', OrderData.DIRECTION_SHORT, 20.0, 5)
+        snap2 = acc.positionSnapshot()
+        self.assertFalse(snap2 is snap)
+        self.assertTrue(snap2.version > snap.version)
+        self.assertEqual(snap2.position[snap2.index('000002')], 15)
+        self.assertEqual(snap.position[snap.index('000002')], 20) # the old snapshot is immutable
+        acc.cashChange(-100, -100)
+        self.assertTrue(acc.positionSnapshot().version > snap2.version)
+
+        # compare with the deep-copies that positionState() used to take
+        for s, pos in acc._dictPositions.items():
+            if s == acc.cashSymbol: continue
+            self.assertEqual(acc.positionState()[2][s].__dict__, pos.__dict__)
+
+        rounds = 2000
+        stampStart = time.time()
+        for i in range(rounds):
+            with acc._lock:
+                allpos = copy.deepcopy(acc._dictPositions)
+        elapsedLegacy = time.time() - stampStart
+        stampStart = time.time()
+        for i in range(rounds):
+            _, cashTotal, positions = acc.positionState()
+            acc.summrizeBalance(positions, cashTotal)
+        elapsed = time.time() - stampStart
+        print('positionState()+summrizeBalance() of %d symbols: %.1fusec, the legacy deepcopy alone %.1fusec' % (len(snap2.symbols), elapsed *1e6 /rounds, elapsedLegacy *1e6 /rounds))
+
+    def _accountState(acc) :
+        with acc._lock:
+            positions = { s: (pos.position, pos.posAvail, round(pos.avgPrice, 6)) for s, pos in acc._dictPositions.items() }
+            return positions, set(acc._dictLimitOrders.keys()), set(acc._dictStopOrders.keys()), set(acc._dictTrades.keys()), set(acc._dictOutgoingOrders.keys())
+
+    def _tradeDay(acc, rounds) :
+        # the orders placed, partially cancelled and traded as a live account does during a day
+        random.seed(11)
+        for i in range(rounds):
+            symbol = '00000%d' % random.randint(1, 5)
+            price = round(random.uniform(9, 11), 2)
+            acc.sendOrder(symbol, OrderData.ORDER_BUY, price, 1, 'journal')
+            acc.doAppStep()
+            if i %3 ==0:
+                acc.cancelOrder(list(acc._dictLimitOrders.keys())[-1])
+                acc.doAppStep()
+            else :
+                acc.fakeTrade(symbol, OrderData.DIRECTION_LONG, price, 1)
+            acc.clock += timedelta(seconds=1)
+
+    def test_AccountJournal(self):
+        import tempfile, shutil
+        tmpdir = tempfile.mkdtemp()
+        try :
+            p = Program()
+            p._heartbeatInterval =-1
+            p.setShelveFilename(os.path.join(tmpdir, 'acc.ss'))
+            settings = { 'journal/enabled': 'True', 'journal/path': os.path.join(tmpdir, 'acc.journal'), 'journal/fsyncInterval': 0, 'journal/snapshotEvery': 100 }
+
+            acc = p.createApp(ClockedAccount, id='J1', **settings)
+            acc.hostTrader(FakeTrader())
+            acc.cashChange(1e6, 1e6)
+            TestAccount._tradeDay(acc, 250)
+            expected = TestAccount._accountState(acc)
+            self.assertTrue(0 < acc._journal.cAppended < 100) # the records after the latest snapshot
+
+            # a crashed process leaves the journal unclosed, the new one recovers by the snapshot and the replay
+            acc2 = p.createApp(ClockedAccount, id='J2', **settings)
+            acc2.hostTrader(FakeTrader())
+            self.assertTrue(acc2.restore())
+            self.assertEqual(TestAccount._accountState(acc2), expected)
+            self.assertEqual(acc2.cashAmount(), acc.cashAmount())
+
+            # the torn tail of an interrupted write is truncated, and the appending goes on after the good records
+            with open(settings['journal/path'], 'ab') as f:
+                f.write(AccountJournal.FRAME.pack(1000, 0) + b'torn')
+            acc3 = p.createApp(ClockedAccount, id='J3', **settings)
+            acc3.hostTrader(FakeTrader())
+            self.assertTrue(acc3.restore())
+            self.assertEqual(TestAccount._accountState(acc3), expected)
+            acc3.cashChange(-100, -100)
+            acc4 = p.createApp(ClockedAccount, id='J4', **settings)
+            acc4.hostTrader(FakeTrader())
+            self.assertTrue(acc4.restore())
+            self.assertEqual(acc4.cashAmount(), acc3.cashAmount())
+
+            # the records that the snapshot covers are skipped if the crash came before the journal restarted
+            with open(settings['journal/path'], 'rb') as f:
+                journaled = f.read()
+            acc4.save()
+            with open(settings['journal/path'], 'wb') as f:
+                f.write(journaled)
+            acc5 = p.createApp(ClockedAccount, id='J5', **settings)
+            acc5.hostTrader(FakeTrader())
+            self.assertTrue(acc5.restore())
+            self.assertEqual(acc5.cashAmount(), acc3.cashAmount())
+
+            # benchmark against the shelve, where every event saves the whole state
+            legacy = p.createApp(ClockedAccount, id='S1')
+            legacy.hostTrader(FakeTrader())
+            legacy._skipSavingByEvent = False
+            legacy.cashChange(1e6, 1e6)
+            stampStart = time.time()
+            TestAccount._tradeDay(legacy, 250)
+            elapsedLegacy = time.time() - stampStart
+
+            del settings['journal/fsyncInterval']
+            journaled = p.createApp(ClockedAccount, id='S2', **{**settings, 'journal/path': os.path.join(tmpdir, 'bench.journal')})
+            journaled.hostTrader(FakeTrader())
+            journaled.cashChange(1e6, 1e6)
+            stampStart = time.time()
+            TestAccount._tradeDay(journaled, 250)
+            elapsed = time.time() - stampStart
+            self.assertEqual(TestAccount._accountState(journaled)[0], TestAccount._accountState(legacy)[0])
+            journaled._journal.flush() # the records within the latest fsyncInterval are lost if crashed right now
+
+            rounds = 20
+            recovered = p.createApp(ClockedAccount, id='S1')
+            recovered.hostTrader(FakeTrader())
+            stampStart = time.time()
+            for i in range(rounds):
+                recovered.restore()
+            elapsedLegacyRecovery = time.time() - stampStart
+            recovered = p.createApp(ClockedAccount, id='S3', **{**settings, 'journal/path': os.path.join(tmpdir, 'bench.journal')})
+            recovered.hostTrader(FakeTrader())
+            stampStart = time.time()
+            for i in range(rounds):
+                recovered.restore()
+            elapsedRecovery = time.time() - stampStart
+            self.assertEqual(TestAccount._accountState(recovered), TestAccount._accountState(journaled))
+
+            print('a day of %d events: shelve %.1fmsec, journal %.1fmsec; recovery: shelve %.2fmsec, journal %.2fmsec' % (250 *2, elapsedLegacy *1000, elapsed *1000, elapsedLegacyRecovery *1000 /rounds, elapsedRecovery *1000 /rounds))
+            self.assertTrue(elapsed < elapsedLegacy)
+        finally :
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,236 @@
+import unittest
+
+from Application import *
+from EventData import Event, EventData
+from MarketData import TickData, KLineData, EVENT_TICK, EVENT_KLINE_1MIN
+from Account import Account
+
+import time
+from datetime import datetime, timedelta
+
+EVENT_FOO = EVENT_NAME_PREFIX + 'Foo' # of PRIORITY_NORMAL
+
+class Sink(BaseApplication) :
+    '''
+    the app records the events received, and stops the program once nothing is pending
+    '''
+    def __init__(self, program, **kwargs):
+        super(Sink, self).__init__(program, **kwargs)
+        self.received = []
+
+    def doAppInit(self): # return True if succ
+        return super(Sink, self).doAppInit()
+
+    def OnEvent(self, event):
+        self.received.append(event)
+
+    def doAppStep(self):
+        if self._program.loopStats['queueDepth'] <=0:
+            self._program.stop()
+        return 0
+
+def _event(type_, seq, symbol='SH600000', asof=None) :
+    if type_ in [EVENT_TICK, EVENT_KLINE_1MIN] :
+        d = TickData('SSE', symbol) if EVENT_TICK == type_ else KLineData('SSE', symbol)
+        d.datetime = asof or datetime(2020, 3, 2, 9, 30)
+    else :
+        d = EventData()
+    d.seq = seq
+    ev = Event(type_)
+    ev.setData(d)
+    return ev
+
+class TestProgramLoop(unittest.TestCase):
+
+    def __loop(self, events, batchSize=20, coalesceAt=300) :
+        '''
+        @return the events in the order that Program.loop() dispatched
+        '''
+        p = Program()
+        p._heartbeatInterval =-1
+        p._batchSize, p._coalesceAt = batchSize, coalesceAt
+        sink = p.createApp(Sink)
+        for et in set([ev.type for ev in events]) :
+            p.subscribe(et, sink)
+        p.start()
+        for ev in events :
+            p.publish(ev)
+        p.loop()
+        return sink.received
+
+    def test_priority(self):
+        types = [EVENT_TICK, Account.EVENT_ORDER, EVENT_FOO, EVENT_KLINE_1MIN, Account.EVENT_TRADE]
+        events = [ _event(types[i %len(types)], i, asof=datetime(2020, 3, 2, 9, 30) + timedelta(minutes=i)) for i in range(15) ]
+
+        # within a batch, the account events go ahead of the others and the market data go last
+        received = self.__loop(events, batchSize=20)
+        self.assertEqual(len(received), len(events))
+        prios = [ Program.PRIORITY_HIGH if ev.type[:5] == 'evacc' else Program.PRIORITY_LOW if ev.type[:4] == 'evmd' else Program.PRIORITY_NORMAL for ev in received ]
+        self.assertEqual(prios, sorted(prios))
+        self.assertEqual(received[0].type, Account.EVENT_ORDER)
+
+        # FIFO within a priority, across the batches
+        events = [ _event(types[i %len(types)], i, asof=datetime(2020, 3, 2, 9, 30) + timedelta(minutes=i)) for i in range(200) ]
+        received = self.__loop(events, batchSize=7)
+        self.assertEqual(len(received), len(events))
+        for prefix in ['evacc', 'evmd', EVENT_FOO] :
+            seqs = [ ev.data.seq for ev in received if ev.type[:len(prefix)] == prefix ]
+            self.assertEqual(seqs, sorted(seqs))
+
+    def test_coalesce(self):
+        t1, t2 = datetime(2020, 3, 2, 9, 30), datetime(2020, 3, 2, 9, 31)
+        events = [ _event(EVENT_TICK, i) for i in range(5) ] + [ _event(EVENT_TICK, 5, symbol='SZ000001') ]
+        events += [ _event(EVENT_KLINE_1MIN, 6, asof=t1), _event(EVENT_KLINE_1MIN, 7, asof=t1), _event(EVENT_KLINE_1MIN, 8, asof=t2) ]
+        events += [ _event(EVENT_FOO, 9), _event(EVENT_FOO, 10) ]
+
+        # nothing is coalesced until the pendings back up
+        self.assertEqual([ev.data.seq for ev in self.__loop(events)], [9, 10] + list(range(9)))
+
+        # the latest of the ticks supersedes, the KLines of different asof are never merged
+        received = self.__loop(events, coalesceAt=0)
+        self.assertEqual([ev.data.seq for ev in received], [9, 10, 4, 5, 7, 8])
+        self.assertEqual([ev.data.symbol for ev in received if EVENT_TICK == ev.type], ['SH600000', 'SZ000001'])
+        self.assertEqual([ev.data.asof for ev in received if EVENT_KLINE_1MIN == ev.type], [t1, t2])
+
+    def test_subscriberCache(self):
+        p = Program()
+        p._heartbeatInterval =-1
+        sink1, sink2 = p.createApp(Sink), p.createApp(Sink)
+        p.subscribe(EVENT_FOO, sink1)
+        p.start()
+
+        dispatch = lambda seq: p._Program__dispatch([time.time(), _event(EVENT_FOO, seq), None])
+        dispatch(0)
+        p.subscribe(EVENT_FOO, sink2)
+        dispatch(1)
+        p.unsubscribe(EVENT_FOO, sink1)
+        dispatch(2)
+        self.assertEqual([ev.data.seq for ev in sink1.received], [0, 1])
+        self.assertEqual([ev.data.seq for ev in sink2.received], [1, 2])
+
+        # the apps added or removed are resolved again
+        sink3 = Sink(program=p)
+        p.subscribe(EVENT_FOO, sink3) # not yet added
+        self.assertEqual([app for _, app in p._Program__subscriberAppsOf(EVENT_FOO)], [sink2])
+        p.addApp(sink3)
+        self.assertEqual([app for _, app in p._Program__subscriberAppsOf(EVENT_FOO)], [sink2, sink3])
+        p.removeApp(sink2)
+        self.assertEqual([app for _, app in p._Program__subscriberAppsOf(EVENT_FOO)], [sink3])
+        p.stop()
+
+    def test_handlerTiming(self):
+        # the handlers are only timed when profiling
+        events = [ _event(EVENT_FOO, i) for i in range(10) ]
+        p = Program()
+        p._heartbeatInterval =-1
+        sink = p.createApp(Sink)
+        p.subscribe(EVENT_FOO, sink)
+        p.start()
+        for ev in events :
+            p._Program__dispatch([time.time(), ev, None])
+        self.assertEqual(p.loopStats['dispatched'], 10)
+        self.assertEqual(p.loopStats['apps'], {})
+
+        p.enableProfile()
+        for ev in events :
+            p._Program__dispatch([time.time(), ev, None])
+        self.assertEqual(p.loopStats['apps'][sink.ident]['events'], 10)
+        p.stop()
+
+class FakeRecorder(object) :
+    '''
+    takes the rows pushed as a TaggedCsvRecorder would
+    '''
+    def __init__(self) :
+        self.categories, self.rows = {}, []
+
+    def registerCategory(self, category, params= {}) :
+        self.categories[category] = params
+
+    def pushRow(self, category, row) :
+        self.rows.append((category, row))
+
+class TestHandlerProfiler(unittest.TestCase):
+
+    def test_summary(self):
+        prof = HandlerProfiler()
+        for i in range(90) :
+            prof.record('A', EVENT_FOO, 3e-6)
+        for i in range(10) :
+            prof.record('A', EVENT_FOO, 700e-6)
+        prof.record('B', 'doAppStep', 1.5)
+
+        # the percentiles are the upper bounds of the log2-usec buckets
+        self.assertEqual(HandlerProfiler.percentile([0, 0, 90, 0, 10], 100, 50), 4)
+        self.assertEqual(HandlerProfiler.percentile([0, 0, 90, 0, 10], 100, 90), 4)
+        self.assertEqual(HandlerProfiler.percentile([0, 0, 90, 0, 10], 100, 91), 16)
+
+        rows = prof.summary()
+        self.assertEqual([(r['app'], r['what']) for r in rows], [('B', 'doAppStep'), ('A', EVENT_FOO)]) # by the time taken
+        r = rows[1]
+        self.assertEqual(r['count'], 100)
+        self.assertAlmostEqual(r['usecAvg'], 72.7)
+        self.assertAlmostEqual(r['usecMax'], 700)
+        self.assertEqual(r['usecP50'], 4)
+        self.assertEqual(r['usecP99'], 1024)
+        self.assertEqual(set(r.keys()), set(HandlerProfiler.COLUMNS.split(',')))
+        self.assertEqual(rows[0]['usecP50'], 1 << 21) # 1.5sec falls in [2^20, 2^21) usec
+
+        prof.reset()
+        self.assertEqual(prof.summary(), [])
+
+    def test_enableAndDump(self):
+        p = Program()
+        p._heartbeatInterval =-1
+        sink = p.createApp(Sink)
+        p.subscribe(EVENT_FOO, sink)
+        p.start()
+        self.assertIsNone(p.profile) # disabled by default
+        p._Program__dispatch([time.time(), _event(EVENT_FOO, 0), None])
+        p.dumpProfile() # nothing to dump
+
+        p.enableProfile()
+        for i in range(5) :
+            p._Program__dispatch([time.time(), _event(EVENT_FOO, i), None])
+        self.assertEqual([(r['app'], r['what'], r['count']) for r in p.profile], [(sink.ident, EVENT_FOO, 5)])
+
+        # into the logger only
+        with self.assertLogs(p.logger, level='INFO') as logs:
+            p.dumpProfile()
+        self.assertTrue(any(['profile %s/%s: 5x' % (sink.ident, EVENT_FOO) in l for l in logs.output]))
+
+        # also into the recorder as category Prof
+        rec = FakeRecorder()
+        p.setProfileRecorder(rec)
+        self.assertEqual(rec.categories[HandlerProfiler.RECCATE_PROFILE]['columns'], HandlerProfiler.COLUMNS)
+        with self.assertLogs(p.logger, level='INFO') as logs:
+            p.dumpProfile()
+        self.assertEqual([(c, r['app'], r['count']) for c, r in rec.rows], [(HandlerProfiler.RECCATE_PROFILE, sink.ident, 5)])
+
+        # the profile is kept over re-enabling, and dropped by disabling
+        p.enableProfile()
+        self.assertEqual(len(p.profile), 1)
+        p.enableProfile(False)
+        self.assertIsNone(p.profile)
+        p.dumpProfile()
+        self.assertEqual(len(rec.rows), 1)
+        p.stop()
+
+    def test_StackSampler(self):
+        def _busy() :
+            stampEnd = time.time() +0.3
+            while time.time() < stampEnd: pass
+
+        sampler = StackSampler(threading.get_ident(), interval=0.002)
+        sampler.start()
+        _busy()
+        sampler.stop()
+        sampler.join()
+        top = sampler.top(100)
+        self.assertTrue(len(top) >0)
+        funcs = [ func for func, pctOnStack, pctOnTop in top ]
+        self.assertTrue(any(['(_busy)' in f for f in funcs]))
+        self.assertTrue(all([pctOnStack >= pctOnTop for func, pctOnStack, pctOnTop in top]))
+
+if __name__ == '__main__':
+    unittest.main()
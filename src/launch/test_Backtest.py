@@ -143,6 +143,119 @@ class TestBacktest(unittest.TestCase):
         prog.loop()
         prog.stop()
 
+    def test_EpisodeStats(self):
+        # the running stats must give the same summary as the DataFrame-based calculateSummary() at any day
+        import random, math
+        random.seed(7)
+        startBalance = 200000.0
+        stats, dayResults = EpisodeStats(), OrderedDict()
+        balance = startBalance
+        for i in range(300):
+            date = (datetime(2019, 1, 1) + timedelta(days=i)).strftime('%Y-%m-%d')
+            dr = DailyResult(date if i %5 else '', startBalance=balance)
+            if i < 250 and random.random() < 0.4:
+                dr.tcBuy, dr.tcSell = random.randint(0, 3), random.randint(0, 2)
+                dr.turnover = round(random.uniform(0, 50000), 2) if dr.tcBuy + dr.tcSell >0 else 0
+                dr.commission, dr.slippage = round(dr.turnover *0.0003, 2), round(dr.turnover *0.0001, 2)
+            dr.netPnl = round(random.gauss(0, 1500), 2) if i < 250 else 0 # the lazy days without trade at the end
+            balance = round(balance + dr.netPnl, 3)
+            dr.endBalance = balance
+
+            dayResults[date] = dr
+            stats.push(dr, date)
+            if i not in [0, 1, 17, 120, 299]: continue
+
+            _, expected = calculateSummary(startBalance, dayResults)
+            summary = stats.summary(startBalance)
+            self.assertEqual(set(summary.keys()), set(expected.keys()))
+            for k, v in expected.items():
+                if isinstance(v, float) and math.isnan(v):
+                    self.assertTrue(math.isnan(summary[k]), k)
+                elif isinstance(v, (int, float)):
+                    self.assertAlmostEqual(summary[k], v, delta=1e-3 + abs(v) *1e-9, msg=k)
+                else:
+                    self.assertEqual(summary[k], v, k)
+
+        self.assertIsNone(EpisodeStats().summary(startBalance))
+        self.assertEqual(stats.summary(startBalance)['endLazyDays'], 300 - 250)
+
+    def test_OptimizationSetting(self):
+        setting = OptimizationSetting()
+        setting.addParameter('a', 1, 3, 1)
+        setting.addParameter('b', 10, 40, 10)
+        setting.addParameter('c', 5)
+        grid = [ (s['a'], s['b'], s['c']) for s in setting.generateSetting() ]
+        self.assertEqual(len(grid), 12)
+        self.assertEqual(len(set(grid)), 12)
+        self.assertEqual(len(setting.generateSetting(randomSamples=12)), 12) # no less than the grid
+
+        # the mixed-radix decoding covers the whole grid without duplicates
+        picked = [ (s['a'], s['b'], s['c']) for s in setting.generateSetting(randomSamples=11, seed=1) ]
+        self.assertEqual(len(set(picked)), 11)
+        self.assertTrue(set(picked) < set(grid))
+        covered = set()
+        for seed in range(20) :
+            covered |= set([ (s['a'], s['b'], s['c']) for s in setting.generateSetting(randomSamples=3, seed=seed) ])
+        self.assertEqual(covered, set(grid))
+
+        # the random pick is reproducible by the seed
+        self.assertEqual(setting.generateSetting(randomSamples=5, seed=7), setting.generateSetting(randomSamples=5, seed=7))
+        self.assertEqual(list(setting.generateSetting(randomSamples=5, seed=7)[0].keys()), ['a', 'b', 'c'])
+
+    def test_EarlyStop(self):
+        class FakeAccount(object):
+            balance = (100000.0, 0.0)
+            def summrizeBalance(self): return self.balance
+
+        bt = BackTestApp.__new__(BackTestApp) # only the members that __testEarlyStop() takes
+        bt._program, bt._episodeNo, bt._episodeSummary, bt._bGameOver = None, 1, {}, False
+        bt._account, bt._maxBalance, bt._pctEarlyStop, bt._marketState = FakeAccount(), 100000.0, 10, None
+
+        # KO-ed once the drawdown reaches 10% of the max balance so far
+        for cash, posvalue, ko in [(80000.0, 40000.0, False), (100000.0, 8001.0, False), (100000.0, 8000.0, True)] :
+            bt._account.balance = (cash, posvalue)
+            self.assertEqual(bt._BackTestApp__testEarlyStop(), ko)
+            self.assertEqual(bt._bGameOver, ko)
+        self.assertEqual(bt._maxBalance, 120000.0)
+        self.assertTrue('early-stop' in bt._episodeSummary['reason'])
+
+    def test_SimOfflinePool(self):
+        # only the exit with the per-symbol output is checkpointed, the failing exits are left to retry
+        import sim_offline_pool as pool
+
+        def failingSimulator(p) :
+            p.error('sim_offline only takes local advisor')
+            quit()
+
+        def failingCode(p) :
+            sys.exit(2)
+
+        def producingSimulator(p) :
+            with open(os.path.join(p.outdir, '%s_P%s.tcsv' % (os.environ['SYMBOL'], p.pid)), 'w') as f:
+                f.write('done\n')
+            sys.exit(0)
+
+        p = Program()
+        p._heartbeatInterval =-1
+        try :
+            os.makedirs(p.outdir)
+        except :
+            pass
+        fnCkpt = os.path.join(p.outdir, pool.CHECKPOINT_FILE)
+        if os.path.exists(fnCkpt): os.remove(fnCkpt)
+
+        for simulator, symbol in [(failingSimulator, 'SZ000001'), (failingCode, 'SZ000002')] :
+            pool.createSimulator = simulator # inherited by the forked workers
+            symbolsDone = set()
+            self.assertEqual(pool.simulateSymbols(p, [symbol], 1, 0, symbolsDone), [symbol])
+            self.assertEqual(len(symbolsDone), 0)
+            self.assertFalse(symbol in pool.readCheckpoint(p.outdir))
+
+        pool.createSimulator = producingSimulator
+        symbolsDone = set()
+        self.assertEqual(pool.simulateSymbols(p, ['SZ000003'], 1, 0, symbolsDone), [])
+        self.assertEqual(pool.readCheckpoint(p.outdir), set(['SZ000003']))
+
 ########################################################################
 if __name__ == '__main__':
     # runChildProcess()
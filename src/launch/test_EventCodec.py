@@ -0,0 +1,124 @@
+import unittest
+
+from EventCodec import *
+from EventData import Event, ErrorData
+from MarketData import TickData, KLineData, MoneyflowData, EVENT_TICK, EVENT_KLINE_1MIN, EVENT_MONEYFLOW_1MIN
+from TradeAdvisor import AdviceData, EVENT_ADVICE
+from Account import OrderData, TradeData, Account
+
+import time
+from datetime import datetime, timedelta, timezone
+
+class _Account(object):
+    nextOrderReqId, ident, _exchange = '1@Account_AShare.test', 'Account_AShare.test', 'SSE'
+
+def _genEvents() :
+    '''
+    @return list of the signed events of the hot types as the EventEnds forward
+    '''
+    asof = datetime(2020, 3, 2, 9, 30, 0, 250000)
+    tick = TickData('SSE', 'SH600000')
+    tick.datetime, tick.date, tick.time = asof, '2020-03-02', '09:30:00'
+    tick.price, tick.volume, tick.open, tick.high, tick.low, tick.prevClose = 10.52, 120300.0, 10.5, 10.6, 10.4, 10.48
+    tick.b1P, tick.b1V, tick.a1P, tick.a1V = 10.51, 3200.0, 10.53, 1800.0
+
+    kl = KLineData('SSE', 'SH600000')
+    kl.datetime, kl.date, kl.time = asof, '2020-03-02', '09:30:00'
+    kl.open, kl.high, kl.low, kl.close, kl.volume = 10.5, 10.6, 10.4, 10.52, 987654.0
+
+    mf = MoneyflowData('SSE', 'SH600000')
+    mf.datetime, mf.date, mf.time = asof, '2020-03-02', '09:30:00'
+    mf.price, mf.netamount, mf.ratioNet, mf.r0_ratio, mf.r3cate_ratio = 10.52, -1.25e6, -0.013, 0.021, -0.4
+
+    adv = AdviceData('advisor.dnn', 'SH600000', 'SSE')
+    adv.datetime, adv.price, adv.dirNONE, adv.dirLONG, adv.dirSHORT, adv.strDir = asof, 10.52, 0.1, 0.7, 0.2, 'LONG'
+
+    order = OrderData(_Account())
+    order.datetime, order.symbol, order.direction, order.offset = asof, 'SH600000', OrderData.DIRECTION_LONG, OrderData.OFFSET_OPEN
+    order.price, order.totalVolume, order.reason, order.fstampSubmitted = 10.52, 300, u'突破', 1583141400.25
+
+    trade = TradeData(_Account())
+    trade.datetime, trade.symbol, trade.brokerTradeId, trade.direction = asof, 'SH600000', '1234', OrderData.DIRECTION_LONG
+    trade.price, trade.volume = 10.52, 300
+
+    events = []
+    for evType, data in [(EVENT_TICK, tick), (EVENT_KLINE_1MIN, kl), (EVENT_MONEYFLOW_1MIN, mf), (EVENT_ADVICE, adv), (Account.EVENT_ORDER, order), (Account.EVENT_TRADE, trade)] :
+        ev = Event(evType)
+        ev.setData(data)
+        ev.sign('test_EventCodec_123@localhost')
+        events.append(ev)
+    return events
+
+class TestEventCodec(unittest.TestCase):
+
+    def __assertSameEvent(self, ev, ev2) :
+        self.assertEqual(ev2.type, ev.type)
+        self.assertEqual(ev2.dict_.keys(), ev.dict_.keys())
+        self.assertEqual(ev2.publisher, ev.publisher)
+        self.assertEqual(ev2.dict_.get('sig'), ev.dict_.get('sig'))
+        self.assertEqual(type(ev2.data), type(ev.data))
+        self.assertEqual(ev2.data.__dict__, ev.data.__dict__)
+        self.assertEqual(ev2.desc, ev.desc)
+
+    def test_roundTrip(self):
+        for ev in _genEvents() :
+            msg = encodeEvent(ev)
+            self.assertEqual(msg[0], WIRE_MAGIC)
+            self.__assertSameEvent(ev, decodeEvent(msg))
+            self.__assertSameEvent(ev, decodeEvent(encodeEvent(ev, CODEC_PICKLE))) # either codec is understood
+
+        # None of datetime and string, and the unsigned event
+        ev = Event(EVENT_KLINE_1MIN)
+        ev.setData(KLineData(None, 'SH600000'))
+        self.assertIsNone(ev.data.datetime)
+        msg = encodeEvent(ev)
+        self.assertEqual(msg[0], WIRE_MAGIC)
+        ev2 = decodeEvent(msg)
+        self.assertIsNone(ev2.publisher)
+        self.assertEqual(ev2.data.__dict__, ev.data.__dict__)
+
+    def test_fallback(self):
+        # the unknown type, the extra attribute and the value out of the layout go by pickle
+        err = ErrorData()
+        err.errorMsg = 'x'
+        ev = Event('eError')
+        ev.setData(err)
+        extra, badNum, tzAware = _genEvents()[1], _genEvents()[1], _genEvents()[1]
+        extra.data.extraInfo = 'not in the schema'
+        badNum.data.volume = None
+        tzAware.data.datetime = datetime(2020, 3, 2, 9, 30, tzinfo=timezone(timedelta(hours=8)))
+        for e in [ev, extra, badNum, tzAware] :
+            msg = encodeEvent(e)
+            self.assertEqual(msg[:1], b'\x80')
+            self.assertEqual(decodeEvent(msg).data.__dict__, e.data.__dict__)
+
+        # the layout of an unknown version is refused instead of being misread
+        msg = bytearray(encodeEvent(_genEvents()[0]))
+        msg[2] +=1
+        self.assertRaises(ValueError, decodeEvent, bytes(msg))
+
+    def test_benchmark(self):
+        rounds = 2000
+        for ev in _genEvents() :
+            msgBin, msgPkl = encodeEvent(ev), encodeEvent(ev, CODEC_PICKLE)
+            self.assertTrue(len(msgBin) < len(msgPkl))
+
+            stampStart = time.time()
+            for i in range(rounds): encodeEvent(ev, CODEC_PICKLE)
+            elapsedPklEnc = time.time() - stampStart
+            stampStart = time.time()
+            for i in range(rounds): decodeEvent(msgPkl)
+            elapsedPklDec = time.time() - stampStart
+
+            stampStart = time.time()
+            for i in range(rounds): encodeEvent(ev)
+            elapsedBinEnc = time.time() - stampStart
+            stampStart = time.time()
+            for i in range(rounds): decodeEvent(msgBin)
+            elapsedBinDec = time.time() - stampStart
+
+            print('%s: %dB vs pickle %dB, encode %.0f/s vs %.0f/s, decode %.0f/s vs %.0f/s' % (type(ev.data).__name__, len(msgBin), len(msgPkl),
+                rounds /elapsedBinEnc, rounds /elapsedPklEnc, rounds /elapsedBinDec, rounds /elapsedPklDec))
+
+if __name__ == '__main__':
+    unittest.main()
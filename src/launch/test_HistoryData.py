@@ -5,6 +5,10 @@ import MarketData as md
 from EventData import datetime2float
 from Application import *
 import h5py
+import numpy as np
+import tempfile, random, glob, bz2, gzip, lzma
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 class Foo(BaseApplication) :
     def __init__(self, program, settings):
@@ -164,6 +168,321 @@ class TestHistoryData(unittest.TestCase):
 
             p.debug('-> state: asof[%s] symbol[%s] lastPrice[%s] OHLC%s\n' % (marketstate.getAsOf(s).strftime('%Y%m%dT%H:%M:%S'), s, marketstate.latestPrice(s), marketstate.dailyOHLC_sofar(s)))
 
+    def _genCsvFolder(self, days=5):
+        folder = tempfile.mkdtemp()
+        dtStart, price = datetime(2020, 3, 2, 9, 30), 10.0
+        with open(os.path.join(folder, '%s_2020.csv' % SYMBOL), 'w') as f:
+            for d in range(days):
+                for m in range(240):
+                    dt = dtStart + timedelta(days=d, minutes=m)
+                    f.write('%s,%s,%.2f,%.2f,%.2f,%.2f,%d,%d\n' % (dt.strftime('%Y/%m/%d'), dt.strftime('%H:%M'), price, price+0.1, price-0.1, price, random.randint(100, 10000), 10000))
+                    price *= 1.0 + random.uniform(-0.01, 0.01)
+        return folder
+
+    def _readEvents(self, reader, count=None):
+        evs = []
+        try :
+            for ev in reader :
+                d = ev.data
+                evs.append((ev.type, d.__class__, d.exchange, d.symbol, d.vtSymbol, d.date, d.time, d.datetime, getattr(d, 'close', None), getattr(d, 'volume', None)))
+                if count and len(evs) >= count: break
+        except RuntimeError: # Iterable raises StopIteration inside the generator at the end
+            pass
+        return evs
+
+    def test_CachedPlayback(self):
+        folder = self._genCsvFolder()
+        fields = 'date,time,open,high,low,close,volume,ammount'
+        expected = self._readEvents(hist.CsvPlayback(symbol=SYMBOL, folder=folder, fields=fields))
+        self.assertTrue(len(expected) >240*5)
+
+        cache = hist.EventCache(capMB=64)
+        reader = hist.CachedPlayback(hist.CsvPlayback(symbol=SYMBOL, folder=folder, fields=fields), cache=cache)
+        self.assertEqual(self._readEvents(reader), expected) # the recording pass
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(self._readEvents(reader), expected) # replayed from the cache
+        self.assertEqual(self._readEvents(reader), expected)
+
+        # a pass quit in the middle should still have the whole playback cached
+        cache = hist.EventCache(capMB=64)
+        reader = hist.CachedPlayback(hist.CsvPlayback(symbol=SYMBOL, folder=folder, fields=fields), cache=cache)
+        self.assertEqual(self._readEvents(reader, 100), expected[:100])
+        reader.resetRead()
+        self.assertEqual(self._readEvents(reader), expected)
+
+        # LRU eviction across symbols
+        stream = cache.get(list(cache._streams.keys())[0])
+        cache.setCapacity(stream.nbytes *2.5 /1024/1024)
+        cache.put('A', stream)
+        cache.put('B', stream)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(reader._key))
+        self.assertTrue(cache.get('A') is stream)
+        cache.put('C', stream)
+        self.assertEqual(list(cache._streams.keys()), ['A', 'C'])
+
+    def test_ColumnarPlayback(self):
+        # split a day across two csv files, which must be merged into a single day of the columnar store
+        folder = self._genCsvFolder()
+        fields = 'date,time,open,high,low,close,volume,ammount'
+        fn = os.path.join(folder, '%s_2020.csv' % SYMBOL)
+        with open(fn, 'r') as f:
+            lines = f.readlines()
+        with open(fn, 'w') as f:
+            f.writelines(lines[:600])
+        with open(os.path.join(folder, '%s_2020b.csv' % SYMBOL), 'w') as f:
+            f.writelines(lines[600:])
+
+        expected = self._readEvents(hist.CsvPlayback(symbol=SYMBOL, folder=folder, fields=fields))
+        self.assertTrue(len(expected) >240*5)
+
+        folderColumnar = tempfile.mkdtemp()
+        self.assertEqual(hist.csvToColumnar(SYMBOL, folder, folderColumnar, fields), 5)
+        self.assertEqual(len(glob.glob(os.path.join(folderColumnar, SYMBOL, '*.npy'))), 5)
+        self.assertEqual(self._readEvents(hist.ColumnarPlayback(symbol=SYMBOL, folder=folderColumnar)), expected)
+
+    def _recordRows(self, filepath, rows, fileMB=None, columns='date,time,price,volume', **kwargs):
+        p = Program()
+        p._heartbeatInterval =-1
+        rec = p.createApp(hist.TaggedCsvRecorder, filepath=filepath, **kwargs)
+        if fileMB: rec._fileMB = fileMB
+        rec.registerCategory('Foo', params={'columns': columns})
+        p.start()
+        for r in rows:
+            rec.pushRow('Foo', r)
+        if not fileMB:
+            rec.pushRow('Bar', {'x': 1, 'y': 'z'}) # the unregistered category
+        while rec.doAppStep(): pass
+        p.stop()
+        return rec
+
+    def test_AsyncTaggedCsvRecorder(self):
+        folder = tempfile.mkdtemp(prefix='tcsv')
+        rows = [ OrderedDict([('date', '20200101'), ('time', '09:%02d:%02d' % (i//60 %60, i%60)), ('price', 10.0 + i/100), ('volume', i)]) for i in range(20000) ]
+
+        self._recordRows(os.path.join(folder, 'sync.tcsv'), rows)
+        rec = self._recordRows(os.path.join(folder, 'async.tcsv'), rows, asyncWrite='True', batchRows=333)
+        self.assertEqual(rec.writtenRows, len(rows) +1)
+        self.assertEqual(rec.droppedRows, 0)
+        with open(os.path.join(folder, 'sync.tcsv'), 'r') as f1, open(os.path.join(folder, 'async.tcsv'), 'r') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        # the rotated files are compressed in background and each starts with the headers
+        self._recordRows(os.path.join(folder, 'rot.tcsv'), rows, fileMB=0.2, asyncWrite='True')
+        cRotated = len(glob.glob(os.path.join(folder, 'rot.tcsv.*.bz2')))
+        self.assertTrue(cRotated >=2)
+        lines = []
+        for fn in [os.path.join(folder, 'rot.tcsv.%d.bz2' % i) for i in range(cRotated, 0, -1)] :
+            with bz2.open(fn, 'rt') as f:
+                content = f.read().splitlines()
+            self.assertEqual(content[0], '!Foo,date,time,price,volume')
+            lines += content[1:]
+        with open(os.path.join(folder, 'rot.tcsv'), 'r') as f:
+            lines += f.read().splitlines()[1:]
+        self.assertEqual(len(lines), len(rows))
+        self.assertEqual(lines[-1], 'Foo,20200101,09:33:19,209.99,19999')
+
+        # the rollover threshold is of the encoded bytes, even if the rows are non-ASCII
+        rowsCN = [ OrderedDict([('date', '20200101'), ('time', '09:%02d:%02d' % (i//60 %60, i%60)), ('price', u'浦发银行收盘价%d' % i), ('volume', i)]) for i in range(10000) ]
+        self._recordRows(os.path.join(folder, 'cn.tcsv'), rowsCN, fileMB=0.2, asyncWrite='True')
+        fns = glob.glob(os.path.join(folder, 'cn.tcsv.*.bz2'))
+        self.assertTrue(len(fns) >=2)
+        for fn in fns :
+            with bz2.open(fn, 'rb') as f:
+                self.assertTrue(len(f.read()) < 0.2*1024*1024 + 100)
+
+        # registerCategory() from the caller's thread races with the writer thread formatting the headers
+        p = Program()
+        p._heartbeatInterval =-1
+        rec = p.createApp(hist.TaggedCsvRecorder, filepath=os.path.join(folder, 'race.tcsv'), asyncWrite='True', batchRows=10)
+        rec._fileMB = 0.05
+        p.start()
+        for i in range(5000) :
+            rec.registerCategory('Cat%d' % (i %500), params={'columns': 'a,b'})
+            rec.pushRow('Foo%d' % (i %50), rows[i]) # the unregistered categories are registered by the writer
+        p.stop()
+        self.assertEqual(rec.writtenRows, 5000)
+
+    def test_TcsvFilterIndexed(self):
+        folder = tempfile.mkdtemp(prefix='tcsv')
+        symbols = ['SH600000', 'SZ000001', 'SH510050']
+        rows = [ OrderedDict([('date', '2020-01-%02d' % (1 + i//3000)), ('time', '%02d:%02d:%02d' % (i//3600 %24, i//60 %60, i%60)), ('symbol', symbols[(i//500) %3]), ('price', 10.0 + i/100)]) for i in range(24000) ]
+        tcsv = os.path.join(folder, 'idx.tcsv')
+        self._recordRows(tcsv, rows, fileMB=0.3, columns='date,time,symbol,price', asyncWrite='True', blockKB=32)
+        self.assertTrue(len(glob.glob(tcsv + '.*.bz2.idx')) >=2)
+
+        def _expected(symbol, startTime=None, endTime=None):
+            ret = ['date,time,symbol,price\n']
+            for r in rows:
+                stamp = '%s %s' % (r['date'], r['time'])
+                if r['symbol'] != symbol or (startTime and stamp < startTime) or (endTime and stamp > endTime): continue
+                ret.append(','.join([str(v) for v in r.values()]) + '\n')
+            return ret
+
+        self.assertEqual(list(hist.TcsvFilter(tcsv, 'Foo', 'SZ000001')), _expected('SZ000001'))
+        self.assertEqual(list(hist.TcsvFilter(tcsv, 'Foo', 'SH510050', processes=2)), _expected('SH510050'))
+        window = ('2020-01-03 14:00:00', '2020-01-04 01:00:00')
+        self.assertEqual(list(hist.TcsvFilter(tcsv, 'Foo', 'SH600000', *window)), _expected('SH600000', *window))
+        self.assertEqual(len(list(hist.TcsvFilter(tcsv, 'Foo'))), len(rows) +1)
+
+        # only the blocks of the symbol are decompressed
+        fn = tcsv + '.1.bz2'
+        idx = hist.TcsvFilter.loadIndex(fn)
+        self.assertTrue(len(hist.TcsvFilter.selectBlocks(idx, 'Foo', 'SZ000001')) < len(idx['blocks']))
+
+        # a stale index is ignored and the file is scanned through
+        for fnIdx in glob.glob(tcsv + '.*.bz2.idx'):
+            with open(fnIdx, 'r+') as f: f.write('{') # corrupt
+        self.assertEqual(list(hist.TcsvFilter(tcsv, 'Foo', 'SH600000', *window)), _expected('SH600000', *window))
+
+    def test_Zipper(self):
+        folder = tempfile.mkdtemp(prefix='zip')
+        content = ''.join(['%d,%s\n' % (i, random.random()) for i in range(100000)]).encode()
+        for codec, openfunc in [('bz2', bz2.open), ('gzip', gzip.open), ('lzma', lzma.open)]:
+            p = Program()
+            p._heartbeatInterval =-1
+            zipper = p.createApp(hist.Zipper, codec=codec, level=6, blockKB=256, processes=2, maxBacklog=2).theApp()
+
+            # the repeated posts are deduped and the ones beyond the backlog are deferred
+            for name in ['a', 'a', 'b', 'c'] :
+                ev = hist.Event(hist.EVENT_TOARCHIVE)
+                ev.setData(hist.ArchiveData(os.path.join(folder, name)))
+                zipper.OnEvent(ev)
+            self.assertEqual(zipper.backlog, 2)
+            self.assertEqual(zipper.stats['deferred'], 1)
+
+            p.start()
+            fn = os.path.join(folder, 'sample.%s.csv' % codec)
+            with open(fn, 'wb') as f: f.write(content)
+            self.assertTrue(zipper.archive(fn))
+            self.assertFalse(os.path.exists(fn))
+            with openfunc(fn + hist.ARCHIVE_CODECS[codec][0], 'rb') as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual(zipper.stats['bytesIn'], len(content))
+            p.stop()
+
+    def _genRFrmFile(self, framelen, stateSize, frames=3):
+        h5fn = os.path.join(tempfile.mkdtemp(prefix='rfrm'), 'RFrm_synthetic.h5')
+        ret = {}
+        with h5py.File(h5fn, 'w') as h5f:
+            for i in range(frames):
+                state = np.random.rand(framelen - i*100, stateSize).astype('float32')
+                action = np.zeros((len(state), 3), dtype='float32')
+                action[np.arange(len(state)), np.random.choice(3, len(state), p=[0.8, 0.1, 0.1])] = 1
+                g = h5f.create_group('ReplayFrame:RF%03d' % i)
+                g.create_dataset('state', data=state)
+                g.create_dataset('action', data=action)
+                ret[i] = (state, action)
+        return h5fn, ret
+
+    def test_ReplayFrameReader(self):
+        framelen, stateSize, batchSize = 4096, 1548, 128
+        h5fn, frames = self._genRFrmFile(framelen, stateSize)
+
+        # the legacy path: list of rows, then the batches built up row by row
+        stampStart = datetime.now()
+        for i in range(3):
+            with h5py.File(h5fn, 'r') as h5f:
+                frameDict = { col: list(h5f['ReplayFrame:RF%03d' % i][col]) for col in ['state', 'action'] }
+            shuffledIndx = [j for j in range(len(frameDict['state']))]
+            random.shuffle(shuffledIndx)
+            for b in range(len(shuffledIndx) // batchSize):
+                bth = { col: np.array([frameDict[col][j] for j in shuffledIndx[batchSize*b: batchSize*(b+1)]]).astype('float32') for col in ['state', 'action'] }
+        elapsedLegacy = datetime.now() - stampStart
+
+        reader = hist.ReplayFrameReader()
+        stampStart = datetime.now()
+        for i in range(3):
+            frameDict = reader.read(h5fn, 'ReplayFrame:RF%03d' % i)
+            mask = hist.ReplayFrameReader.balanceMask(frameDict['action'])
+            bths = hist.ReplayFrameReader.toBatches(frameDict, batchSize, mask)
+        elapsed = datetime.now() - stampStart
+        print('ReplayFrame legacy path took %s, ReplayFrameReader took %s' % (elapsedLegacy, elapsed))
+        self.assertTrue(elapsed < elapsedLegacy)
+
+        # the buffers are reused and the content matches
+        for i in [2, 0, 1]:
+            state, action = frames[i]
+            frameDict = reader.read(h5fn, 'ReplayFrame:RF%03d' % i)
+            self.assertTrue(frameDict['state'].flags['C_CONTIGUOUS'] and frameDict['state'].dtype == np.float32)
+            self.assertTrue(np.array_equal(frameDict['state'], state) and np.array_equal(frameDict['action'], action))
+
+            permutation = np.random.permutation(len(state))
+            bths = hist.ReplayFrameReader.toBatches(frameDict, batchSize, permutation=permutation)
+            self.assertEqual(len(bths), len(state) // batchSize)
+            self.assertTrue(np.array_equal(bths[1]['state'], state[permutation[batchSize:batchSize*2]]))
+
+        # the balanced mask reduces the dominant action down to 1.6x of the others
+        mask = hist.ReplayFrameReader.balanceMask(action)
+        kI = np.bincount(np.argmax(action[mask], axis=1), minlength=3)
+        self.assertEqual(kI[0], int(1.6 * (kI[1] + kI[2])))
+        self.assertEqual(kI[1] + kI[2], np.count_nonzero(action[:, 1:]))
+
+    def test_ReplayFrameReadAhead(self):
+        batchSize = 64
+        h5fn, frames = self._genRFrmFile(1000, 20, frames=4)
+        rowsOfFrame = { ('ReplayFrame:RF%03d@%s' % (i, os.path.basename(h5fn))): set(map(tuple, np.hstack(frames[i]).tolist())) for i in frames.keys() }
+
+        ra = hist.ReplayFrameReadAhead({'state': 20, 'action': 3}, batchSize, processes=2, slots=3)
+        ra.start()
+        for i in frames.keys():
+            ra.submit(h5fn, 'ReplayFrame:RF%03d' % i)
+
+        cBths, done = {}, []
+        while True:
+            bth, frameTag = ra.get(timeout=10)
+            done += ra.framesDone()
+            if bth is None: break
+            self.assertEqual(bth['state'].shape, (batchSize, 20))
+            for row in np.hstack([bth['state'], bth['action']]).tolist():
+                self.assertIn(tuple(row), rowsOfFrame[frameTag])
+            cBths[frameTag] = cBths.get(frameTag, 0) +1
+
+        ra.stop()
+        self.assertEqual(ra.pendingFrames, 0)
+        self.assertEqual(len(done), len(frames))
+        for frameTag, lenFrame, bths, err in done:
+            self.assertIsNone(err)
+            self.assertEqual(cBths[frameTag], bths)
+            self.assertTrue(bths >0 and bths < lenFrame // batchSize) # balanced
+
+    def test_ReplayFrameRebalancer(self):
+        h5fn, frames = self._genRFrmFile(1000, 20, frames=3)
+        rowsIn = set(map(tuple, np.vstack([ np.hstack(frames[i]) for i in frames.keys() ]).tolist()))
+        kept = 0
+        for state, action in frames.values():
+            kI = np.bincount(np.argmax(action, axis=1), minlength=3)
+            kept += kI[1] + kI[2] + min(kI[0], int(1.2 * (kI[1] + kI[2])))
+
+        # the chunk covering a whole input frame keeps as many rows as the legacy per-frame balancing
+        rb = hist.ReplayFrameRebalancer(outFrameSize=256, chunkSize=1000, signature='sig', logger=None)
+        cFrames, subtotal = rb.rebalance(h5fn, h5fn + 'b')
+        self.assertEqual(sum(subtotal), kept)
+        self.assertEqual(cFrames, (kept + 255) // 256)
+
+        rowsOut = []
+        with h5py.File(h5fn + 'b', 'r') as h5f:
+            names = rb.framesOf(h5f)
+            self.assertEqual(len(names), cFrames)
+            for i, name in enumerate(sorted(names, key=lambda n: int(n.split(':')[1]))):
+                g = h5f[name]
+                self.assertEqual(g.attrs['signature'], 'sig')
+                self.assertEqual(g.attrs['size'], 256 if i < cFrames -1 else kept - 256 * (cFrames -1))
+                self.assertEqual(g['state'].dtype, np.float32)
+                rowsOut += np.hstack([g['state'][()], g['action'][()]]).tolist()
+        self.assertEqual(len(rowsOut), kept)
+        self.assertTrue(set(map(tuple, rowsOut)) <= rowsIn)
+
+        # the smaller chunks balance each chunk, and multiple files are rebalanced in parallel
+        h5fn2, frames2 = self._genRFrmFile(1000, 20, frames=2)
+        results = hist.ReplayFrameRebalancer.rebalanceFiles([(h5fn, h5fn + 'c'), (h5fn2, h5fn2 + 'c')], processes=2, outFrameSize=300, chunkSize=100, logger=None)
+        self.assertEqual(sorted([ r[0] for r in results ]), sorted([h5fn, h5fn2]))
+        for fn, cFrames, subtotal, err in results:
+            self.assertIsNone(err)
+            self.assertTrue(subtotal[0] <= 1.2 * (subtotal[1] + subtotal[2]) + 10)
+            with h5py.File(fn + 'c', 'r') as h5f:
+                self.assertEqual(sum([ h5f[name].attrs['size'] for name in h5f.keys() ]), sum(subtotal))
+
 if __name__ == '__main__':
     unittest.main()
 
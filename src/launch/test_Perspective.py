@@ -0,0 +1,120 @@
+import unittest
+
+import Perspective as psp
+from MarketData import *
+from EventData import Event
+
+from datetime import datetime, timedelta
+import random
+import copy
+import numpy as np
+
+EXCHANGE, SYMBOL ='AShare', '000001'
+
+def _genKLineEvents(evType, count, stampStart, step, symbol=SYMBOL) :
+    evs = []
+    price = 10.0 + random.random()
+    for i in range(count) :
+        kl = KLineData(EXCHANGE, symbol)
+        kl.open  = round(price, 2)
+        price *= 1.0 + random.uniform(-0.02, 0.02)
+        kl.close = round(price, 2)
+        kl.high  = round(max(kl.open, kl.close) * (1.0 + random.uniform(0, 0.01)), 2)
+        kl.low   = round(min(kl.open, kl.close) * (1.0 - random.uniform(0, 0.01)), 2)
+        kl.volume = random.randint(1000, 10000000)
+        kl.datetime = stampStart + step *i
+        kl.date = kl.datetime.strftime('%Y-%m-%d')
+        kl.time = kl.datetime.strftime('%H:%M:%S')
+        ev = Event(evType)
+        ev.setData(kl)
+        evs.append(ev)
+    return evs
+
+def _buildPerspective(symbol=SYMBOL, days=300, mins5=100, mins1=20) :
+    p = psp.Perspective(EXCHANGE, symbol)
+    stamp = datetime(2020, 3, 2, 9, 30)
+    for ev in _genKLineEvents(EVENT_KLINE_1DAY, days, stamp - timedelta(days=days), timedelta(days=1), symbol) :
+        p.push(ev)
+    for ev in _genKLineEvents(EVENT_KLINE_5MIN, mins5, stamp - timedelta(minutes=5*mins5), timedelta(minutes=5), symbol) :
+        p.push(ev)
+    for ev in _genKLineEvents(EVENT_KLINE_1MIN, mins1, stamp, timedelta(minutes=1), symbol) :
+        p.push(ev)
+    return p
+
+class TestPerspective(unittest.TestCase):
+
+    def test_EvictableStack(self):
+        stk = psp.EvictableStack(3, KLineData(EXCHANGE, SYMBOL))
+        for ev in _genKLineEvents(EVENT_KLINE_1MIN, 5, datetime(2020, 3, 2, 9, 30), timedelta(minutes=1)) :
+            stk.push(ev.data)
+
+        self.assertEqual(stk.size, 3)
+        self.assertEqual([stk[i].close for i in range(stk.size)], list(stk.column('close')))
+        self.assertEqual(stk.top.datetime, datetime(2020, 3, 2, 9, 34))
+
+    def test_S1548I4_identical(self):
+        for depth1min in [0, 10, 20, 40] :
+            p = _buildPerspective(mins1=depth1min)
+            legacy = np.array(p._S1548I4).astype(psp.NN_FLOAT)
+            vectorized = p.exportS1548I4()
+            self.assertEqual(len(vectorized), 1548)
+            self.assertEqual(legacy.tobytes(), vectorized.tobytes())
+
+    def test_floatsD4_identical(self):
+        p = _buildPerspective()
+        d4wished = { 'asof':1, EVENT_KLINE_5MIN : 50, EVENT_KLINE_1DAY : 150 }
+
+        klbaseline = p._stacks[EVENT_KLINE_1DAY].top
+        legacy = [p.asof.month, p.asof.day, p.asof.weekday(), p.asof.hour *60 +p.asof.minute]
+        for et in [EVENT_KLINE_5MIN, EVENT_KLINE_1DAY] :
+            stk = p._stacks[et]
+            for i in range(d4wished[et]) :
+                legacy += stk[i].toNNFloats(baseline_Price=klbaseline.close, baseline_Volume=klbaseline.volume / p._evsPerDay[et]) if i < stk.size else [0.0] * EXPORT_FLOATS_DIMS
+
+        self.assertEqual(np.array(legacy).astype(psp.NN_FLOAT).tobytes(), p.floatsD4(d4wished).tobytes())
+
+    def test_S1548I4_incremental(self):
+        p = _buildPerspective(days=10, mins5=10, mins1=0)
+        self.assertEqual(p.exportS1548I4(incremental=True).tobytes(), p.exportS1548I4().tobytes())
+
+        stamp = datetime(2020, 3, 2, 9, 30)
+        evs = _genKLineEvents(EVENT_KLINE_1MIN, 50, stamp, timedelta(minutes=1))
+        for i in range(len(evs)) :
+            evs[i].data.exchange += '_k2x' # the merged KLines are overwritable
+            p.push(evs[i])
+            if i %3 ==0 and i >2:
+                ev = Event(EVENT_KLINE_1MIN)
+                ev.setData(copy.copy(evs[i-2].data))
+                ev.data.close *= 1.01
+                p.push(ev)
+            if i %7 ==0 :
+                continue # let some changes accumulate
+            self.assertEqual(p.exportS1548I4(incremental=True).tobytes(), p.exportS1548I4().tobytes())
+
+        kl = copy.copy(p._stacks[EVENT_KLINE_1MIN][3])
+        kl.high *= 1.02
+        p._stacks[EVENT_KLINE_1MIN][3] = kl
+        p.push(_genKLineEvents(EVENT_KLINE_1MIN, 1, stamp + timedelta(hours=1), timedelta(minutes=1))[0])
+        self.assertEqual(p.exportS1548I4(incremental=True).tobytes(), p.exportS1548I4().tobytes())
+
+        # a new day changes the baseline and leads to a full renormalize
+        for ev in _genKLineEvents(EVENT_KLINE_1DAY, 1, stamp, timedelta(days=1)) :
+            p.push(ev)
+        self.assertEqual(p.exportS1548I4(incremental=True).tobytes(), p.exportS1548I4().tobytes())
+
+    def test_exportKLFloatsBatch(self):
+        state = psp.PerspectiveState(EXCHANGE)
+        symbols = ['000001', '000002', '600000']
+        for s in symbols[:2] :
+            evPsp = Event(psp.EVENT_Perspective)
+            evPsp.setData(_buildPerspective(symbol=s))
+            state.updateByEvent(evPsp)
+
+        mat = state.exportKLFloatsBatch(symbols)
+        self.assertEqual(mat.shape, (3, 1548))
+        for i, s in enumerate(symbols) :
+            self.assertEqual(mat[i].tobytes(), state.exportKLFloats(s).tobytes())
+        self.assertFalse(mat[2].any())
+
+if __name__ == '__main__':
+    unittest.main()
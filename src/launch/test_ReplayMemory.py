@@ -0,0 +1,212 @@
+import unittest
+
+from hpGym.ReplayMemory import ReplayMemory, PrioritizedReplayMemory, SumTree
+
+import random, time
+import numpy as np
+
+STATE_SIZE, ACTION_SIZE = 16, 3
+
+def _genObservations(count, episodeLen) :
+    '''
+    @return list of (state, action, reward, next_state, done) as a gym would observe, where the next_state is the state
+            of the following observation within an episode
+    '''
+    obs = []
+    state = np.random.rand(STATE_SIZE).astype('float32')
+    for i in range(count) :
+        action = np.zeros(ACTION_SIZE, dtype='float32')
+        action[random.randrange(ACTION_SIZE)] = 1
+        next_state = np.random.rand(STATE_SIZE).astype('float32')
+        done = (i % episodeLen) == episodeLen -1
+        obs.append((state, action, float(random.random()), next_state, done))
+        state = np.random.rand(STATE_SIZE).astype('float32') if done else next_state
+    return obs
+
+def _cliffwalkSteps(mem, chainLen, batchSize=8, learningRate=0.5, gamma=0.9, maxSteps=5000) :
+    '''
+    the Blind Cliffwalk: of each state in the chain, action 0 moves to the next state and only the last move is rewarded
+    by 1, action 1 falls off the cliff with reward 0. the memory is filled by the episodes of a random policy ending with a
+    single walk-through, then a
+    tabular Q is trained by replaying batches until its greedy policy walks through the chain
+    @return the number of replayed batches to reach the reward
+    '''
+    eye = np.eye(chainLen, dtype='float32')
+    cPushed = 0
+    while cPushed < mem.capacity :
+        succeed = cPushed >= mem.capacity - chainLen # the single walk-through comes last to keep it in the ring
+        for i in range(chainLen) :
+            action = np.zeros(2, dtype='float32')
+            fall = not succeed and random.random() < 0.5
+            action[1 if fall else 0] = 1
+            last = (i == chainLen -1)
+            mem.push(eye[i], action, 1.0 if last and not fall else 0.0, eye[min(i+1, chainLen -1)], fall or last)
+            cPushed +=1
+            if fall : break
+
+    Q = np.zeros((chainLen, 2))
+    for step in range(1, maxSteps +1) :
+        if isinstance(mem, PrioritizedReplayMemory) :
+            state_batch, action_batch, reward_batch, next_state_batch, done_batch, idxs, weights = mem.samplePrioritized(batchSize)
+        else :
+            (state_batch, action_batch, reward_batch, next_state_batch, done_batch), weights = mem.sample(batchSize), np.ones(batchSize)
+
+        s, a, ns = np.argmax(state_batch, axis=1), np.argmax(action_batch, axis=1), np.argmax(next_state_batch, axis=1)
+        tdErrors = reward_batch + gamma * np.logical_not(done_batch) * Q[ns].max(axis=1) - Q[s, a]
+        Q[s, a] += learningRate * weights * tdErrors # the duplicates in a batch take a single step
+        if isinstance(mem, PrioritizedReplayMemory) :
+            mem.updatePriorities(idxs, tdErrors)
+
+        if (Q[:, 0] > Q[:, 1]).all() :
+            return step
+
+    return maxSteps
+
+class TestReplayMemory(unittest.TestCase):
+
+    def __assertSlots(self, mem, obs) :
+        # the latest capacity observations are in the ring, the slot of observation i is i % capacity
+        col_state, col_action, col_reward, col_next_state, col_done = mem.columns()
+        for i in range(max(0, len(obs) - mem.capacity), len(obs)) :
+            slot = i % mem.capacity
+            s, a, r, ns, d = obs[i]
+            self.assertTrue(np.array_equal(col_state[slot], s))
+            self.assertTrue(np.array_equal(col_action[slot], a))
+            self.assertAlmostEqual(float(col_reward[slot]), r, places=5)
+            self.assertTrue(np.array_equal(col_next_state[slot], ns))
+            self.assertEqual(bool(col_done[slot]), d)
+
+    def test_pushAndColumns(self):
+        mem = ReplayMemory(100, STATE_SIZE, ACTION_SIZE)
+        obs = _genObservations(250, 37)
+        for i, o in enumerate(obs) :
+            mem.push(*o)
+            if i in [0, 50, 99, 100, 180] :
+                self.__assertSlots(mem, obs[:i+1])
+
+        self.assertTrue(mem.isFull)
+        self.assertEqual(mem.cursor, 250 % 100)
+        self.__assertSlots(mem, obs)
+
+        # the states are not kept twice
+        mem = ReplayMemory(10000, STATE_SIZE, ACTION_SIZE)
+        naive = 10000 * (STATE_SIZE *2 + ACTION_SIZE +2) *4
+        self.assertTrue(mem.nbytes < naive *0.75)
+
+    def test_sample(self):
+        mem = ReplayMemory(200, STATE_SIZE, ACTION_SIZE)
+        obs = _genObservations(500, 23)
+        self.assertIsNone(mem.sample(8)[0])
+        for o in obs :
+            mem.push(*o)
+
+        bySlot = { i % 200 : obs[i] for i in range(300, 500) }
+        byState = { obs[i][0].tobytes() : obs[i] for i in range(300, 500) }
+        state_batch, action_batch, reward_batch, next_state_batch, done_batch = mem.sample(64)
+        self.assertEqual(state_batch.shape, (64, STATE_SIZE))
+        self.assertEqual(len(set([s.tobytes() for s in state_batch])), 64) # no replacement
+        for j in range(64) :
+            s, a, r, ns, d = byState[state_batch[j].tobytes()]
+            self.assertTrue(np.array_equal(action_batch[j], a))
+            self.assertTrue(np.array_equal(next_state_batch[j], ns))
+            self.assertEqual(bool(done_batch[j]), d)
+
+        # the batch buffers are reused
+        self.assertTrue(mem.sample(64)[0] is state_batch)
+
+    def test_tailsOverflow(self):
+        # episodes shorter than the tails can cover, the observations losing their next_state are never sampled
+        mem = ReplayMemory(100, STATE_SIZE, ACTION_SIZE, tailCapacity=4)
+        obs = _genObservations(400, 3)
+        for o in obs :
+            mem.push(*o)
+
+        byState = { obs[i][0].tobytes() : obs[i] for i in range(300, 400) }
+        for k in range(20) :
+            state_batch, _, _, next_state_batch, _ = mem.sample(32)
+            for j in range(32) :
+                self.assertTrue(np.array_equal(next_state_batch[j], byState[state_batch[j].tobytes()][3]))
+
+    def test_sumTree(self):
+        tree = SumTree(100)
+        priorities = np.random.rand(100)
+        priorities[[3, 50]] = 0
+        tree.update(np.arange(100), priorities)
+        self.assertAlmostEqual(tree.total, priorities.sum())
+        self.assertAlmostEqual(tree.minimum, priorities[priorities >0].min())
+
+        tree.update([7, 7, 99], [5.0, 5.0, 0.25])
+        priorities[[7, 99]] = [5.0, 0.25]
+        self.assertAlmostEqual(tree.total, priorities.sum())
+
+        # find() is the prefix-sum search, the slots of zero priority are never found
+        values = np.random.rand(10000) * tree.total
+        self.assertTrue(np.array_equal(tree.find(values), np.searchsorted(np.cumsum(priorities), values, side='right')))
+        self.assertFalse(np.isin(tree.find(values), [3, 50]).any())
+        self.assertEqual(tree.find([tree.total *2])[0], 99)
+
+    def test_samplePrioritized(self):
+        mem = PrioritizedReplayMemory(200, STATE_SIZE, ACTION_SIZE, alpha=1.0, beta=0.5, betaIncrement=0.1)
+        obs = _genObservations(300, 23)
+        for o in obs :
+            mem.push(*o)
+
+        # the new observations take the max priority until updated
+        state_batch, _, _, _, _, idxs, weights = mem.samplePrioritized(50)
+        self.assertTrue(np.allclose(weights, 1.0))
+        self.assertAlmostEqual(mem.beta, 0.6)
+
+        # make slot 5 as likely as all the others together
+        tdErrors = np.full(200, 1.0)
+        tdErrors[5] = 199.0
+        mem.updatePriorities(np.arange(200), tdErrors)
+        cnt, draws = 0, 0
+        for k in range(100) :
+            state_batch, _, _, next_state_batch, _, idxs, weights = mem.samplePrioritized(20)
+            cnt += np.count_nonzero(idxs == 5)
+            draws += len(idxs)
+            self.assertTrue((state_batch[idxs == 5] == mem.columns()[0][5]).all())
+            self.assertTrue(weights.max() <= 1.0 +1e-6)
+            self.assertTrue((weights[idxs == 5] <= weights.min() +1e-6).all()) # the over-sampled one takes the least weight
+        self.assertTrue(0.4 < cnt / draws < 0.6)
+
+        # the observations losing their next_state are never sampled
+        mem = PrioritizedReplayMemory(100, STATE_SIZE, ACTION_SIZE, tailCapacity=4)
+        obs = _genObservations(400, 3)
+        for o in obs :
+            mem.push(*o)
+        byState = { obs[i][0].tobytes() : obs[i] for i in range(300, 400) }
+        for k in range(20) :
+            state_batch, _, _, next_state_batch, _, idxs, weights = mem.samplePrioritized(16)
+            for j in range(16) :
+                self.assertTrue(np.array_equal(next_state_batch[j], byState[state_batch[j].tobytes()][3]))
+
+    def test_benchmarkPrioritized(self):
+        # the sampling throughput against the uniform sampling
+        for cls in [ReplayMemory, PrioritizedReplayMemory] :
+            mem = cls(10240, STATE_SIZE, ACTION_SIZE)
+            for o in _genObservations(10240, 100) :
+                mem.push(*o)
+            rounds = 200
+            stampStart = time.time()
+            for k in range(rounds) :
+                if cls is ReplayMemory :
+                    mem.sample(128)
+                else :
+                    _, _, _, _, _, idxs, weights = mem.samplePrioritized(128)
+                    mem.updatePriorities(idxs, np.random.rand(128))
+            elapsed = time.time() - stampStart
+            print('%s: %.0f samples/sec' % (cls.__name__, rounds *128 / elapsed))
+
+        # the replayed batches to reach the reward of the Blind Cliffwalk against the uniform sampling
+        steps = { ReplayMemory: [], PrioritizedReplayMemory: [] }
+        for seed in range(5) :
+            for cls in steps.keys() :
+                random.seed(seed)
+                steps[cls].append(_cliffwalkSteps(cls(2048, 12, 2), 12))
+        print('batches to reach the reward: uniform %s, prioritized %s' % (steps[ReplayMemory], steps[PrioritizedReplayMemory]))
+        # the comparison varies by the seeds, so only printed as the benchmark
+        self.assertTrue(max(steps[PrioritizedReplayMemory]) < 5000)
+
+if __name__ == '__main__':
+    unittest.main()
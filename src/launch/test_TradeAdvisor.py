@@ -0,0 +1,136 @@
+import unittest
+
+from Application import Program
+from TradeAdvisor import *
+from MarketData import KLineData, TickData, EVENT_TICK, EVENT_KLINE_1MIN
+
+import time
+from datetime import datetime, timedelta
+
+SYMBOLS = ['SH600000', 'SZ000001', 'SH510050']
+
+class FakeRecorder(object) :
+    def __init__(self) :
+        self.rows = []
+
+    def registerCategory(self, category, params= {}) :
+        pass
+
+    def pushRow(self, category, row) :
+        self.rows.append((category, row))
+
+class EchoAdvisor(TradeAdvisor) :
+    '''
+    the advisor always advises LONG, and keeps the batches that it was called with and the events that it posted
+    '''
+    def __init__(self, program, **kwargs) :
+        super(EchoAdvisor, self).__init__(program, recorder=FakeRecorder(), objectives=list(SYMBOLS), intvSafeStore=0, **kwargs)
+        self.batches, self.posted = [], []
+
+    def generateAdviceOnMarketEvent(self, mdEvent, lastAdv=None):
+        adv = AdviceData(self.ident, mdEvent.data.symbol, 'SSE')
+        adv.price, adv.dirLONG = mdEvent.data.close if EVENT_KLINE_1MIN == mdEvent.type else mdEvent.data.price, 1.0
+        return adv
+
+    def generateAdvicesOnMarketEvents(self, mdEvents, lastAdvs):
+        self.batches.append([(ev.data.symbol, ev.data.asof) for ev in mdEvents])
+        return super(EchoAdvisor, self).generateAdvicesOnMarketEvents(mdEvents, lastAdvs)
+
+    def postEvent(self, ev):
+        self.posted.append((ev.type, ev.data.symbol, ev.data.asof))
+
+def _event(symbol, asof, type_=EVENT_KLINE_1MIN) :
+    d = KLineData('SSE', symbol) if EVENT_KLINE_1MIN == type_ else TickData('SSE', symbol)
+    d.datetime = asof
+    if EVENT_KLINE_1MIN == type_ :
+        d.open = d.high = d.low = d.close = 10.0
+    else :
+        d.price = 10.0
+    ev = Event(type_)
+    ev.setData(d)
+    return ev
+
+class TestTradeAdvisor(unittest.TestCase):
+
+    def __advisor(self, **kwargs) :
+        p = Program()
+        p._heartbeatInterval =-1
+        return EchoAdvisor(p, **kwargs)
+
+    def test_perEvent(self):
+        # the batch size 1 advises on each event as it comes
+        adv = self.__advisor(minimalInterval=0)
+        t0 = datetime(2020, 3, 2, 9, 30)
+        posted = []
+        for i in range(6) :
+            symbol, asof = SYMBOLS[i %3], t0 + timedelta(minutes=i)
+            adv.OnEvent(_event(symbol, asof))
+            posted.append((EVENT_ADVICE, symbol, asof))
+            self.assertEqual(adv.posted, posted)
+        self.assertEqual([len(b) for b in adv.batches], [1] *6)
+        self.assertEqual(len([r for r in adv.recorder.rows if EVENT_ADVICE == r[0]]), 6)
+
+    def test_flushBySize(self):
+        adv = self.__advisor(minimalInterval=0, **{'batch/size': 3, 'batch/msecWindow': 100000})
+        t0 = datetime(2020, 3, 2, 9, 30)
+        adv.OnEvent(_event(SYMBOLS[0], t0))
+        adv.OnEvent(_event(SYMBOLS[1], t0))
+        adv.OnEvent(_event(SYMBOLS[0], t0 + timedelta(minutes=1))) # only the latest of a symbol is kept
+        self.assertEqual(adv.posted, [])
+        adv.doAppStep()
+        self.assertEqual(adv.posted, [])
+
+        adv.OnEvent(_event(SYMBOLS[2], t0))
+        self.assertEqual(adv.batches, [[(SYMBOLS[0], t0 + timedelta(minutes=1)), (SYMBOLS[1], t0), (SYMBOLS[2], t0)]])
+        self.assertEqual(len(adv.posted), 3)
+        self.assertEqual(adv.batchHistograms[0], {3: 1})
+
+    def test_flushByWindow(self):
+        adv = self.__advisor(minimalInterval=0, **{'batch/size': 10, 'batch/msecWindow': 50})
+        t0 = datetime(2020, 3, 2, 9, 30)
+        adv.OnEvent(_event(SYMBOLS[0], t0))
+        adv.OnEvent(_event(SYMBOLS[1], t0))
+        adv.doAppStep()
+        self.assertEqual(adv.posted, [])
+
+        time.sleep(0.06)
+        adv.doAppStep()
+        self.assertEqual([s for _, s, _ in adv.posted], SYMBOLS[:2])
+        self.assertEqual(len(adv.batches), 1)
+        adv.doAppStep() # nothing more to flush
+        self.assertEqual(len(adv.batches), 1)
+
+        # the pending batch is flushed when stopping
+        adv.OnEvent(_event(SYMBOLS[2], t0))
+        adv.stop()
+        self.assertEqual([s for _, s, _ in adv.posted], SYMBOLS)
+
+    def test_minimalInterval(self):
+        for kwargs in [{}, {'batch/size': 2, 'batch/msecWindow': 100000}] :
+            adv = self.__advisor(minimalInterval=60, **kwargs)
+            t0 = datetime(2020, 3, 2, 9, 30)
+            adv.OnEvent(_event(SYMBOLS[0], t0))
+            adv.OnEvent(_event(SYMBOLS[1], t0))
+            adv.OnEvent(_event(SYMBOLS[0], t0 + timedelta(seconds=30))) # too soon after the advice
+            adv.OnEvent(_event(SYMBOLS[1], t0 + timedelta(seconds=59)))
+            adv.OnEvent(_event(SYMBOLS[0], t0 + timedelta(seconds=61)))
+            adv.OnEvent(_event(SYMBOLS[1], t0 + timedelta(seconds=70)))
+            self.assertEqual([(s, asof) for _, s, asof in adv.posted], [(SYMBOLS[0], t0), (SYMBOLS[1], t0),
+                (SYMBOLS[0], t0 + timedelta(seconds=61)), (SYMBOLS[1], t0 + timedelta(seconds=70))])
+
+    def test_tickRepeat(self):
+        for kwargs in [{}, {'batch/size': 2, 'batch/msecWindow': 100000}] :
+            adv = self.__advisor(minimalInterval=60, **kwargs)
+            t0 = datetime(2020, 3, 2, 9, 30)
+            adv.OnEvent(_event(SYMBOLS[0], t0, EVENT_TICK))
+            adv.OnEvent(_event(SYMBOLS[1], t0, EVENT_TICK))
+            self.assertEqual([(t, s) for t, s, _ in adv.posted], [(EVENT_TICK_OF_ADVICE, SYMBOLS[0]), (EVENT_ADVICE, SYMBOLS[0]), (EVENT_TICK_OF_ADVICE, SYMBOLS[1]), (EVENT_ADVICE, SYMBOLS[1])])
+
+            # the ticks following the advice are repeated for max 3 times, even if no advice is generated on them
+            del adv.posted[:]
+            for i in range(5) :
+                adv.OnEvent(_event(SYMBOLS[0], t0 + timedelta(seconds=i+1), EVENT_TICK))
+            self.assertEqual(adv.posted, [(EVENT_TICK_OF_ADVICE, SYMBOLS[0], t0 + timedelta(seconds=i+1)) for i in range(3)])
+
+if __name__ == '__main__':
+    unittest.main()